@@ -0,0 +1,145 @@
+"""
+Benchmarks every stage of the pipeline and the whole pipeline on the prints in './sample_inputs/', at
+their original resolution and upscaled to see how each stage scales with the image size.
+
+Every stage is timed on the outputs of the previous stages, which are computed once and not timed.
+The time of a stage for one image is the fastest of --repeat runs and the time reported for a scale
+is the median over the images.
+
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --threshold 0.2 --stage-threshold gabor_filter=0.5
+
+With --baseline the run fails (exit code 1) when a stage got slower than its baseline by more than its
+threshold, e.g. 0.2 allows 20% more time.
+"""
+import argparse
+import json
+import sys
+import time
+from glob import glob
+import cv2 as cv
+import numpy as np
+from finegerprint_pipline import fingerprint_features
+from utils import orientation
+from utils.crossing_number import calculate_minutiaes
+from utils.frequency import ridge_freq
+from utils.gabor_filter import gabor_filter
+from utils.normalization import normalize
+from utils.poincare import calculate_singularities
+from utils.segmentation import create_segmented_and_variance_images
+from utils.skeletonize import skeletonize, available_backends
+
+# (name, function of the input image and its features)
+STAGES = [
+    ('normalize', lambda img, f: normalize(img.copy(), float(100), float(100))),
+    ('create_segmented_and_variance_images', lambda img, f: create_segmented_and_variance_images(
+        f.normalized, f.block_size, 0.2)),
+    ('calculate_angles', lambda img, f: orientation.calculate_angles(f.normalized, W=f.block_size, smoth=False)),
+    ('ridge_freq', lambda img, f: ridge_freq(f.norm_img, f.mask, f.angles, f.block_size, kernel_size=5,
+                                             minWaveLength=5, maxWaveLength=15)),
+    ('gabor_filter', lambda img, f: gabor_filter(f.norm_img, f.angles, f.freq)),
+    ('skeletonize', lambda img, f: skeletonize(f.gabor, f.mask)),
+    # every thinning backend, to pick the fastest one on this host
+    *[('skeletonize[%s]' % backend, lambda img, f, backend=backend: skeletonize(f.gabor, f.mask, backend))
+      for backend in available_backends()],
+    ('calculate_minutiaes', lambda img, f: calculate_minutiaes(f.skeleton)),
+    ('calculate_singularities', lambda img, f: calculate_singularities(f.skeleton, f.angles, 1, f.block_size,
+                                                                       f.mask)),
+    ('pipeline', lambda img, f: fingerprint_features(img)),
+]
+
+
+def fastest(function, repeat):
+    """
+    :return: (outputs of the last run, fastest time of repeat runs)
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = function()
+        times.append(time.perf_counter() - start)
+    return outputs, min(times)
+
+
+def run_benchmark(images_paths, scales, repeat, stages=None):
+    """
+    :return: {'scale': {stage: median seconds}}
+    """
+    results = {}
+    for scale in scales:
+        timings = {name: [] for name, _ in STAGES if stages is None or name in stages}
+        for img_path in images_paths:
+            img = cv.imread(img_path, 0)
+            if scale != 1:
+                img = cv.resize(img, None, fx=scale, fy=scale, interpolation=cv.INTER_CUBIC)
+            features = fingerprint_features(img)
+            for name, stage in STAGES:
+                if name in timings:
+                    timings[name].append(fastest(lambda: stage(img, features), repeat)[1])
+        results[str(scale)] = {name: float(np.median(times)) for name, times in timings.items()}
+    return results
+
+
+def find_regressions(results, baseline, threshold, stage_thresholds):
+    """
+    :return: list of (scale, stage, baseline seconds, current seconds, allowed ratio)
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, seconds in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            if reference is None:
+                continue
+            allowed = 1 + stage_thresholds.get(stage, threshold)
+            if seconds > reference * allowed:
+                regressions.append((scale, stage, reference, seconds, allowed))
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = ['%-38s %6s %12s %12s %8s' % ('stage', 'scale', 'median', 'baseline', 'ratio')]
+    for scale, stages in results.items():
+        for stage, seconds in stages.items():
+            reference = (baseline or {}).get(scale, {}).get(stage)
+            lines.append('%-38s %6s %10.1fms %12s %8s' % (
+                stage, scale, 1000 * seconds, '%.1fms' % (1000 * reference) if reference else '-',
+                '%.2f' % (seconds / reference) if reference else '-'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='./sample_inputs/*.tif', help='glob pattern of the input images')
+    parser.add_argument('--limit', type=int, default=None, help='only use the first images')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2], help='synthetic upscaling factors')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--baseline', default=None, help='baseline JSON to compare against')
+    parser.add_argument('--save-baseline', default=None, help='store the results as a baseline JSON')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--stage-threshold', action='append', default=[], metavar='STAGE=THRESHOLD',
+                        help='allowed slowdown of a single stage')
+    args = parser.parse_args()
+
+    images_paths = sorted(glob(args.input))[:args.limit]
+    scales = [int(scale) if scale == int(scale) else scale for scale in args.scales]
+    results = run_benchmark(images_paths, scales, args.repeat, args.stages)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        stage_thresholds = {stage: float(value) for stage, value in
+                            (item.split('=') for item in args.stage_threshold)}
+        regressions = find_regressions(results, baseline, args.threshold, stage_thresholds)
+        for scale, stage, reference, seconds, allowed in regressions:
+            print('REGRESSION %s at scale %s: %.1fms > %.1fms x %.2f' % (
+                stage, scale, 1000 * seconds, 1000 * reference, allowed))
+        sys.exit(1 if regressions else 0)
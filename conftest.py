@@ -0,0 +1,9 @@
+"""
+The scripts of the repository root are imported by the tests the way they import each other, run from the root:
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -1,56 +1,191 @@
+import argparse
+import json
 import cv2 as cv
-from glob import glob
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from glob import iglob
 import os
 import numpy as np
-from utils.poincare import calculate_singularities
-from utils.segmentation import create_segmented_and_variance_images
-from utils.normalization import normalize
-from utils.gabor_filter import gabor_filter
+from utils.poincare import find_singularities, draw_singularities
+from utils.preprocessing import preprocess
+from utils.roi import roi_box, roi_margin, crop, uncrop, uncrop_blocks, shift_points
+from utils.gabor_filter import gabor_filter, filter_radius, load_filter_banks
+from utils.memory import float_dtype, set_float_dtype
 from utils.frequency import ridge_freq
+from utils.pyramid import pyramid_angles_and_coherence, pyramid_ridge_freq
 from utils import orientation
-from utils.crossing_number import calculate_minutiaes
+from utils.crossing_number import extract_minutiae, draw_minutiae, minutiae_inside_mask, refine_ridge_angles
 from tqdm import tqdm
-from utils.skeletonize import skeletonize
+from utils.skeletonize import skeletonize, available_backends, DEFAULT_THINNING
+from utils.template import Template, save_template, load_template, write_gallery
+from utils.instrumentation import Instrumentation, JsonLinesWriter, NULL_INSTRUMENTATION
+from utils.tiling import tile_executor
+from utils.stage_cache import open_stage_cache, NULL_STAGE_CACHE, DEFAULT_MAX_BYTES
+from utils.quality import segmentation_quality, frequency_validity, assess_quality, GateSummary, QualityPolicy, \
+    DEFAULT_POLICY
 
 
-def fingerprint_pipline(input_img):
-    block_size = 16
+# every intermediate a caller may need, no image is rendered to produce it
+# quality is the utils.quality.QualityReport when the quality gate is on; a rejected print stops after the
+# stage that rejected it and the features of the stages it skipped are None
+FingerprintFeatures = namedtuple('FingerprintFeatures', [
+    'normalized', 'segmented', 'norm_img', 'mask', 'angles', 'freq', 'gabor', 'skeleton', 'minutiae',
+    'singularities', 'block_size', 'quality'], defaults=[None])
+
+# names the stages are recorded under, in pipeline order
+PIPELINE_STAGES = ('preprocess', 'orientation', 'ridge_freq', 'gabor', 'skeletonize', 'minutiae', 'poincare')
+
+# tunable parameters of the stages
+# orientation_pyramid and frequency_pyramid > 0 estimate the orientations and the ridge frequencies on the
+# image downsampled that many times, see utils.pyramid
+PipelineParams = namedtuple('PipelineParams', [
+    'block_size', 'm0', 'v0', 'threshold', 'orientation_pyramid', 'frequency_pyramid', 'freq_kernel_size',
+    'min_wave_length', 'max_wave_length', 'kx', 'ky', 'angle_inc', 'minutiae_kernel_size', 'poincare_tolerance'],
+    defaults=[16, 100.0, 100.0, 0.2, 0, 0, 5, 5, 15, 0.65, 0.65, 3, 3, 1])
+DEFAULT_PARAMS = PipelineParams()
+
+
+def fingerprint_features(input_img, instrumentation=NULL_INSTRUMENTATION, roi=True, thinning=DEFAULT_THINNING,
+                         memory_budget=None, params=DEFAULT_PARAMS, cache=NULL_STAGE_CACHE, quality_policy=None,
+                         tile_workers=None):
+    """
+    Headless pipeline: computes the features of a print without any visualization work.
+    :param input_img: 2d uint8 image
+    :param instrumentation: utils.instrumentation.Instrumentation recording every stage
+    :param roi: run the stages after segmentation on the block aligned bounding box of the mask only, see
+    utils.roi. The features inside the mask are the same, orientations outside of the box are left at 0.
+    :param thinning: skeletonize backend, see utils.skeletonize.THINNING_BACKENDS
+    :param memory_budget: bytes of scratch memory for ridge_freq and gabor_filter, see utils.memory
+    :param params: PipelineParams
+    :param cache: utils.stage_cache.StageCache, a stage whose inputs and parameters did not change is loaded
+    from it instead of being run and is not recorded by the instrumentation
+    :param quality_policy: utils.quality.QualityPolicy, prints below it are rejected after orientation or
+    ridge_freq, see utils.quality; None runs every print through every stage
+    :param tile_workers: threads filtering bands of the image concurrently in the segmentation, orientation
+    and gabor stages, for large single scans, see utils.tiling. The features are the same.
+    :return: FingerprintFeatures
+    """
+    block_size = params.block_size
+    stage = instrumentation.call
+    executor = tile_executor(tile_workers)
+
+    def cached(name, key, function, *args, **kwargs):
+        outputs = cache.get(key)
+        if outputs is None:
+            outputs = stage(name, function, *args, **kwargs)
+            cache.put(key, outputs)
+        return outputs
 
     # pipe line picture re https://www.cse.iitk.ac.in/users/biometrics/pages/111.JPG
     # normalization -> orientation -> frequency -> mask -> filtering
 
     # normalization - removes the effects of sensor noise and finger pressure differences.
-    normalized_img = normalize(input_img.copy(), float(100), float(100))
+    # ROI and normalisation - both are fused into a single pass over the image
+    preprocess_key = cache.key(preprocess, cache.input_key(input_img), float(params.m0), float(params.v0),
+                               block_size, float(params.threshold))
+    (normalized_img, segmented_img, normim, mask) = cached('preprocess', preprocess_key, preprocess, input_img,
+                                                           float(params.m0), float(params.v0), block_size,
+                                                           params.threshold, executor=executor)
 
     # color threshold
     # threshold_img = normalized_img
     # _, threshold_im = cv.threshold(normalized_img,127,255,cv.THRESH_OTSU)
     # cv.imshow('color_threshold', normalized_img); cv.waitKeyEx()
 
-    # ROI and normalisation
-    (segmented_img, normim, mask) = create_segmented_and_variance_images(normalized_img, block_size, 0.2)
+    # everything downstream only sees the region of interest
+    # the margin is wider than the gabor filters of the lowest frequency ridge_freq can return
+    radius = filter_radius(np.round(100/params.max_wave_length)/100, params.kx, params.ky)
+    box = roi_box(mask, block_size, roi_margin(block_size, radius)) if roi else (0, mask.shape[0], 0, mask.shape[1])
+    (roi_normalized, roi_normim, roi_mask) = crop(box, normalized_img, normim, mask)
+
+    (y, x) = mask.shape
+    blocks_shape = (len(range(1, y, block_size)), len(range(1, x, block_size)))
 
     # orientations
-    angles = orientation.calculate_angles(normalized_img, W=block_size, smoth=False)
-    orientation_img = orientation.visualize_angles(segmented_img, mask, angles, W=block_size)
+    if params.orientation_pyramid:
+        orientation_key = cache.key(pyramid_angles_and_coherence, preprocess_key, box, params.orientation_pyramid)
+        (angles, coherence) = cached('orientation', orientation_key, pyramid_angles_and_coherence, roi_normalized,
+                                     block_size, params.orientation_pyramid)
+    else:
+        orientation_key = cache.key(orientation.calculate_angles_and_coherence, preprocess_key, box)
+        (angles, coherence) = cached('orientation', orientation_key, orientation.calculate_angles_and_coherence,
+                                     roi_normalized, W=block_size, smoth=False, executor=executor)
+
+    # quality gate, before the expensive stages
+    if quality_policy is not None:
+        metrics = stage('quality', segmentation_quality, normalized_img, mask, roi_mask, coherence, block_size)
+        quality = assess_quality(metrics, quality_policy, after='orientation')
+        if quality.reason is not None:
+            return FingerprintFeatures(normalized_img, segmented_img, normim, mask,
+                                       uncrop_blocks(angles, box, blocks_shape, block_size), None, None, None,
+                                       None, None, block_size, quality)
 
     # find the overall frequency of ridges in Wavelet Domain
-    freq = ridge_freq(normim, mask, angles, block_size, kernel_size=5, minWaveLength=5, maxWaveLength=15)
+    # memory_budget and the tiles are not part of the keys, the chunks give the same outputs
+    freq_args = (roi_normim, roi_mask, angles, block_size, params.freq_kernel_size, params.min_wave_length,
+                 params.max_wave_length)
+    if params.frequency_pyramid:
+        freq_key = cache.key(pyramid_ridge_freq, orientation_key, *freq_args[-3:], params.frequency_pyramid)
+        (freq, freq_map) = cached('ridge_freq', freq_key, pyramid_ridge_freq, *freq_args, params.frequency_pyramid,
+                                  return_map=True, memory_budget=memory_budget)
+    else:
+        freq_key = cache.key(ridge_freq, orientation_key, *freq_args[-3:], 'return_map')
+        (freq, freq_map) = cached('ridge_freq', freq_key, ridge_freq, *freq_args, return_map=True,
+                                  memory_budget=memory_budget)
+
+    if quality_policy is not None:
+        metrics = metrics._replace(frequency_validity=stage('quality_freq', frequency_validity, roi_mask,
+                                                            freq_map, block_size))
+        quality = assess_quality(metrics, quality_policy, after='ridge_freq')
+        if quality.reason is not None:
+            return FingerprintFeatures(normalized_img, segmented_img, normim, mask,
+                                       uncrop_blocks(angles, box, blocks_shape, block_size),
+                                       uncrop(freq, box, mask.shape), None, None, None, None, block_size, quality)
+    else:
+        quality = None
 
     # create gabor filter and do the actual filtering
-    gabor_img = gabor_filter(normim, angles, freq)
+    gabor_key = cache.key(gabor_filter, freq_key, float(params.kx), float(params.ky), params.angle_inc)
+    gabor_img = cached('gabor', gabor_key, gabor_filter, roi_normim, angles, freq, params.kx, params.ky,
+                       memory_budget=memory_budget, W=block_size, angleInc=params.angle_inc, executor=executor)
 
     # thinning oor skeletonize
-    thin_image = skeletonize(gabor_img)
+    skeleton_key = cache.key(skeletonize, gabor_key, thinning)
+    thin_image = cached('skeletonize', skeleton_key, skeletonize, gabor_img, roi_mask, thinning)
 
     # minutias
-    minutias = calculate_minutiaes(thin_image)
+    minutiae_key = cache.key(extract_minutiae, skeleton_key, params.minutiae_kernel_size)
+    minutiae = cached('minutiae', minutiae_key, extract_minutiae, thin_image, params.minutiae_kernel_size)
 
     # singularities
-    singularities_img = calculate_singularities(thin_image, angles, 1, block_size, mask)
+    singularities_key = cache.key(find_singularities, orientation_key, params.poincare_tolerance)
+    singularities = cached('poincare', singularities_key, find_singularities, angles, params.poincare_tolerance,
+                           block_size, roi_mask)
+
+    # back to full image coordinates
+    angles = uncrop_blocks(angles, box, blocks_shape, block_size)
+    freq = uncrop(freq, box, mask.shape)
+    gabor_img = uncrop(gabor_img, box, mask.shape, 255)
+    thin_image = uncrop(thin_image, box, mask.shape, 255)
+    minutiae = shift_points(minutiae, box)
+    singularities = shift_points(singularities, box)
+
+    return FingerprintFeatures(normalized_img, segmented_img, normim, mask, angles, freq, gabor_img, thin_image,
+                               minutiae, singularities, block_size, quality)
+
+
+def visualize_features(input_img, features):
+    """
+    Renders the pipeline stage by stage into a 2x4 mosaic.
+    """
+    block_size = features.block_size
+    orientation_img = orientation.visualize_angles(features.segmented, features.mask, features.angles, W=block_size)
+    minutias = draw_minutiae(features.skeleton, features.minutiae)
+    singularities_img = draw_singularities(features.skeleton, features.singularities, block_size)
 
     # visualize pipeline stage by stage
-    output_imgs = [input_img, normalized_img, segmented_img, orientation_img, gabor_img, thin_image, minutias, singularities_img]
+    output_imgs = [input_img, features.normalized, features.segmented, orientation_img, features.gabor,
+                   features.skeleton, minutias, singularities_img]
     for i in range(len(output_imgs)):
         if len(output_imgs[i].shape) == 2:
             output_imgs[i] = cv.cvtColor(output_imgs[i], cv.COLOR_GRAY2RGB)
@@ -59,19 +194,275 @@ def fingerprint_pipline(input_img):
     return results
 
 
-if __name__ == '__main__':
-    # open images
-    img_dir = './sample_inputs/*'
-    output_dir = './output/'
-    def open_images(directory):
-        images_paths = glob(directory)
-        return np.array([cv.imread(img_path,0) for img_path in images_paths])
+def fingerprint_template(features):
+    template_minutiae = minutiae_inside_mask(features.minutiae, features.mask, features.block_size)
+    template_minutiae = refine_ridge_angles(features.skeleton, template_minutiae)
+    return Template(template_minutiae, features.singularities, features.block_size, features.mask.shape)
+
+
+def fingerprint_pipline(input_img, return_template=False):
+    features = fingerprint_features(input_img)
+    results = visualize_features(input_img, features)
+
+    if return_template:
+        return results, fingerprint_template(features)
+    return results
+
+
+def iter_images_paths(pattern):
+    """
+    Lazily yields the image paths matching a glob pattern, nothing is loaded up front.
+    """
+    for img_path in iglob(pattern):
+        if os.path.isfile(img_path):
+            yield img_path
+
+
+def image_name(img_path):
+    return os.path.splitext(os.path.basename(img_path))[0]
+
+
+def process_image(img_path, visualize=True, profile=False, thinning=DEFAULT_THINNING, memory_budget=None,
+                  params=DEFAULT_PARAMS, cache_dir=None, cache_size=DEFAULT_MAX_BYTES, quality_policy=None,
+                  tile_workers=None):
+    """
+    Batch worker: reads one image and runs the pipeline on it.
+    :param cache_dir: directory of the stage cache shared by the workers, None to run every stage
+    :param quality_policy: utils.quality.QualityPolicy of the quality gate, None to accept every print
+    :return: (img_path, results, template, records, quality), results is None when visualize is off or the
+    print is rejected, template is None when it is rejected, records holds the instrumentation records when
+    profile or the quality gate is on and quality is the QualityReport of the gate
+    """
+    if profile:
+        instrumentation = Instrumentation()
+    else:
+        # the gate summary needs the stage times, memory is not traced
+        instrumentation = Instrumentation(trace_memory=False) if quality_policy is not None else NULL_INSTRUMENTATION
+    instrumentation.image = image_name(img_path)
+    cache = open_stage_cache(cache_dir, cache_size) if cache_dir else NULL_STAGE_CACHE
+
+    input_img = cv.imread(img_path, 0)
+    features = fingerprint_features(input_img, instrumentation, thinning=thinning, memory_budget=memory_budget,
+                                    params=params, cache=cache, quality_policy=quality_policy,
+                                    tile_workers=tile_workers)
+    records = getattr(instrumentation, 'records', [])
+    if features.quality is not None and features.quality.reason is not None:
+        return img_path, None, None, records, features.quality
+
+    results = visualize_features(input_img, features) if visualize else None
+    return img_path, results, fingerprint_template(features), records, features.quality
+
 
-    images = open_images(img_dir)
+def write_rejection(path, quality, quality_policy=None):
+    """
+    :param quality_policy: QualityPolicy that rejected the print, a resumed run only skips the print under
+    the same policy
+    """
+    with open(path, 'w') as f:
+        json.dump({'reason': quality.reason, 'score': quality.score, 'after': quality.after,
+                   'metrics': quality.metrics._asdict(),
+                   'policy': quality_policy._asdict() if quality_policy is not None else None}, f, indent=2)
 
-    # image pipeline
+
+def remove_outputs(output_dir, name, *extensions):
+    for extension in extensions:
+        path = os.path.join(output_dir, name + extension)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def write_outputs(output_dir, img_path, results, template, records=(), quality=None, instrumentation=None,
+                  gate_summary=None, quality_policy=None):
+    """
+    Writes the mosaic and the template of a print, or <name>.rejected.json with the reason code, the
+    metrics and the policy when the quality gate rejected it. The outputs of an earlier run of the print
+    that disagree with this one are removed first, so a rejected print never ends up in the gallery.
+    """
+    if instrumentation is not None:
+        instrumentation.extend(records)
+    if gate_summary is not None and quality is not None:
+        gate_summary.add(quality, records)
+
+    # written under a temporary name first, so an interrupted run never leaves a partial output behind
+    name = image_name(img_path)
+    if template is None:
+        remove_outputs(output_dir, name, '.fpt', '.png')
+        write_rejection(os.path.join(output_dir, name + '.part.rejected.json'), quality, quality_policy)
+        os.replace(os.path.join(output_dir, name + '.part.rejected.json'),
+                   os.path.join(output_dir, name + '.rejected.json'))
+        return
+    remove_outputs(output_dir, name, '.rejected.json')
+    if results is not None:
+        cv.imwrite(os.path.join(output_dir, name + '.part.png'), results)
+    save_template(os.path.join(output_dir, name + '.part.fpt'), template)
+    os.replace(os.path.join(output_dir, name + '.part.fpt'), os.path.join(output_dir, name + '.fpt'))
+    if results is not None:
+        os.replace(os.path.join(output_dir, name + '.part.png'), os.path.join(output_dir, name + '.png'))
+
+
+def read_rejection_policy(path):
+    """
+    :return: the policy dict a <name>.rejected.json was written under, None when it has none or is unreadable
+    """
+    try:
+        with open(path) as f:
+            return json.load(f).get('policy')
+    except (OSError, ValueError):
+        return None
+
+
+def is_done(output_dir, img_path, visualize=True, quality_policy=None):
+    """
+    :param quality_policy: QualityPolicy of the run, a rejection only counts as done under the policy that
+    wrote it, so a run without the gate or with another policy processes the rejected prints again
+    """
+    name = image_name(img_path)
+    rejection = os.path.join(output_dir, name + '.rejected.json')
+    if os.path.exists(rejection):
+        return quality_policy is not None and read_rejection_policy(rejection) == quality_policy._asdict()
+    return os.path.exists(os.path.join(output_dir, name + '.fpt')) and \
+        (not visualize or os.path.exists(os.path.join(output_dir, name + '.png')))
+
+
+def init_worker(filter_banks, dtype):
+    """
+    Pool initializer: every worker uses the float dtype of the parent and preloads the filter banks.
+    """
+    set_float_dtype(dtype)
+    if filter_banks:
+        load_filter_banks(filter_banks)
+
+
+def run_batch(images_paths, output_dir, workers=None, max_in_flight=None, resume=False, filter_banks=None,
+              visualize=True, instrumentation=None, thinning=DEFAULT_THINNING, memory_budget=None,
+              params=DEFAULT_PARAMS, cache_dir=None, cache_size=DEFAULT_MAX_BYTES, quality_policy=None,
+              gate_summary=None, tile_workers=None):
+    """
+    Fans the images out to a process pool. At most max_in_flight images are queued or being processed at
+    any time, so memory does not grow with the dataset. Outputs are keyed by the source file name and
+    written in input order; with resume, images whose outputs already exist are skipped.
+    :param images_paths: iterable of image paths, consumed lazily
+    :param workers: number of processes, defaults to the number of cores
+    :param max_in_flight: defaults to twice the number of workers
+    :param filter_banks: .npz of gabor filter banks loaded by every worker at startup
+    :param visualize: write the mosaic of every print, otherwise only its template
+    :param instrumentation: Instrumentation collecting the stage records of every image
+    :param thinning: skeletonize backend
+    :param memory_budget: bytes of scratch memory per stage, see utils.memory
+    :param params: PipelineParams
+    :param cache_dir: stage cache directory, see utils.stage_cache
+    :param cache_size: size limit of the stage cache in bytes
+    :param quality_policy: utils.quality.QualityPolicy, rejected prints get a <name>.rejected.json instead of
+    their mosaic and template
+    :param gate_summary: utils.quality.GateSummary collecting the rejections and the compute they saved
+    :param tile_workers: threads per worker process filtering bands of every image, see utils.tiling
+    :return: names of the images of this run in input order, processed or skipped by resume
+    """
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * workers
     os.makedirs(output_dir, exist_ok=True)
-    for i, img in enumerate(tqdm(images)):
-        results = fingerprint_pipline(img)
-        cv.imwrite(output_dir+str(i)+'.png', results)
-        # cv.imshow('image pipeline', results); cv.waitKeyEx()
+
+    names = []
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(filter_banks, float_dtype())) as pool:
+        in_flight = deque()
+        for img_path in images_paths:
+            names.append(image_name(img_path))
+            if resume and is_done(output_dir, img_path, visualize, quality_policy):
+                continue
+            if len(in_flight) >= max_in_flight:
+                write_outputs(output_dir, *in_flight.popleft().result(), instrumentation=instrumentation,
+                              gate_summary=gate_summary, quality_policy=quality_policy)
+            in_flight.append(pool.submit(process_image, img_path, visualize, instrumentation is not None,
+                                           thinning, memory_budget, params, cache_dir, cache_size, quality_policy,
+                                           tile_workers))
+
+        while in_flight:
+            write_outputs(output_dir, *in_flight.popleft().result(), instrumentation=instrumentation,
+                          gate_summary=gate_summary, quality_policy=quality_policy)
+
+    return names
+
+
+def parse_params(items, params=DEFAULT_PARAMS):
+    """
+    :param items: 'name=value' strings, e.g. ['kx=0.5', 'minutiae_kernel_size=5']
+    :param params: PipelineParams, or any namedtuple of numbers such as a QualityPolicy
+    :return: params with the items replaced, converted to the type of their default
+    """
+    fields = type(params)._fields
+    values = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        if name not in fields:
+            raise ValueError('unknown parameter %s, expected one of %s' % (name, ', '.join(fields)))
+        values[name] = type(getattr(params, name))(value)
+    return params._replace(**values)
+
+
+def pack_gallery(output_dir, gallery_path, names):
+    """
+    Packs the templates of a batch into one gallery, the templates other runs left in the output directory
+    are not part of it.
+    :param names: image names of the batch, see run_batch; the rejected prints have no template
+    """
+    templates_paths = [os.path.join(output_dir, name + '.fpt') for name in sorted(names)]
+    templates_paths = [path for path in templates_paths if os.path.exists(path)]
+    write_gallery(gallery_path, ((image_name(path), load_template(path)) for path in templates_paths))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the fingerprint pipeline over a directory of images.')
+    parser.add_argument('--input', default='./sample_inputs/*', help='glob pattern of the input images')
+    parser.add_argument('--output', default='./output/')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', help='skip images whose outputs already exist')
+    parser.add_argument('--filter-banks', default=None, help='.npz of gabor filter banks to preload in workers')
+    parser.add_argument('--headless', action='store_true', help='only extract features, skip the mosaics')
+    parser.add_argument('--profile', default=None, help='JSON-lines file receiving per stage timings and memory')
+    parser.add_argument('--thinning', default=DEFAULT_THINNING, choices=available_backends(),
+                        help='skeletonize backend')
+    parser.add_argument('--float64', action='store_true', help='compute in float64 instead of float32')
+    parser.add_argument('--memory-budget', type=float, default=None, metavar='MB',
+                        help='scratch memory of the ridge frequency and gabor stages per image')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='stage parameter, one of %s' % ', '.join(PipelineParams._fields))
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                        help='stage cache directory, stages whose inputs did not change are loaded from it')
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 2**20, metavar='MB',
+                        help='size limit of the stage cache, least recently used entries are evicted')
+    parser.add_argument('--quality-gate', action='store_true',
+                        help='reject low quality prints after orientation and ridge frequency, see utils.quality')
+    parser.add_argument('--quality', action='append', default=[], metavar='NAME=VALUE',
+                        help='quality gate threshold, one of %s, implies --quality-gate' % ', '.join(
+                            QualityPolicy._fields))
+    parser.add_argument('--tile-workers', type=int, default=None, metavar='N',
+                        help='threads filtering bands of every image, for large scans on few worker processes')
+    args = parser.parse_args()
+
+    if args.float64:
+        set_float_dtype(np.float64)
+    memory_budget = int(args.memory_budget * 2**20) if args.memory_budget else None
+    params = parse_params(args.param)
+    quality_policy = parse_params(args.quality, DEFAULT_POLICY) if args.quality_gate or args.quality else None
+    gate_summary = GateSummary(PIPELINE_STAGES) if quality_policy is not None else None
+
+    instrumentation = None
+    if args.profile:
+        instrumentation = Instrumentation([JsonLinesWriter(args.profile)])
+
+    # image pipeline, the mosaic and the minutiae template of each print are written next to each other
+    # and all the templates are packed into one gallery at the end
+    images_paths = tqdm(iter_images_paths(args.input), unit='img')
+    names = run_batch(images_paths, args.output, args.workers, args.max_in_flight, args.resume, args.filter_banks,
+              visualize=not args.headless, instrumentation=instrumentation, thinning=args.thinning,
+              memory_budget=memory_budget, params=params, cache_dir=args.cache,
+              cache_size=int(args.cache_size * 2**20), quality_policy=quality_policy, gate_summary=gate_summary,
+              tile_workers=args.tile_workers)
+    pack_gallery(args.output, os.path.join(args.output, 'gallery.fpg'), names)
+
+    if gate_summary is not None:
+        print(gate_summary.format())
+    if instrumentation is not None:
+        print(instrumentation.format_summary())
+        print(instrumentation.format_memory_report())
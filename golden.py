@@ -0,0 +1,321 @@
+"""
+Golden output equivalence harness: records the outputs of every stage of the pipeline on the prints in
+'./sample_inputs/' and checks other implementations of the stages against them.
+
+    python golden.py record --archive golden.npz
+    python golden.py check --archive golden.npz --stage orientation=my_module:calculate_angles_and_coherence
+
+record runs the reference stages, the functions the pipeline calls, on every print and stores their
+outputs, the paths and digests of the input images, the parameters and the stage times in one compressed
+.npz, about 8MB for the sample prints. The stages after preprocess run on the region of interest, as in
+the pipeline, and so are their outputs.
+
+check runs every stage on the recorded outputs of the stages before it, so the differences of one stage
+do not add up with the ones before, both with the reference function and with the alternative given by
+--stage NAME=MODULE:FUNCTION, which takes the arguments of the reference. Without --stage a stage is
+checked with the reference itself, i.e. the implementation currently in the tree against the outputs it
+was recorded with. For every stage the report holds, over the prints:
+    ref ms / new ms  time of the reference and of the alternative, the fastest of --repeat runs
+    speedup          total reference time over total alternative time
+    recorded ms      time of the stage when the archive was recorded
+    metrics          the worst value over the prints of the metrics of its outputs:
+                     disagreement   fraction of the pixels that differ, normalized image, mask, gabor, skeleton
+                     error          largest absolute difference of the background normalized image
+                     angle_error    largest orientation difference in degrees
+                     freq_error     largest relative difference of the ridge frequency, a pixel or block
+                                    with a frequency in only one of the two counts as 1
+                     precision / recall  of the minutiae and singular points within --radius pixels of one
+                                    of the same type, see utils.matching.minutiae_agreement
+A stage whose metrics are past the --tolerance of one of them fails the check (exit code 1).
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from glob import glob
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+from benchmark import fastest
+from finegerprint_pipline import image_name, parse_params, DEFAULT_PARAMS
+from utils.crossing_number import extract_minutiae
+from utils.frequency import ridge_freq
+from utils.gabor_filter import gabor_filter, filter_radius
+from utils.matching import minutiae_agreement
+from utils.memory import float_dtype, set_float_dtype
+from utils.orientation import calculate_angles_and_coherence
+from utils.poincare import find_singularities
+from utils.preprocessing import preprocess
+from utils.roi import roi_box, roi_margin, crop
+from utils.skeletonize import skeletonize, available_backends, DEFAULT_THINNING
+
+# name: the stage name of the pipeline
+# reference: the function the pipeline calls
+# call: call(function, golden, params, thinning) runs function on the recorded outputs of the stages before
+# outputs: name under which every output of the function is recorded, None for the ones not recorded
+GoldenStage = namedtuple('GoldenStage', ['name', 'reference', 'call', 'outputs'])
+
+
+def roi(golden, params, *names):
+    """
+    :return: the recorded full image outputs names cropped to the region of interest of the pipeline
+    """
+    radius = filter_radius(np.round(100/params.max_wave_length)/100, params.kx, params.ky)
+    box = roi_box(golden['mask'], params.block_size, roi_margin(params.block_size, radius))
+    return crop(box, *(golden[name] for name in names))
+
+
+STAGES = [
+    GoldenStage('preprocess', preprocess, lambda f, g, p, t: f(
+        g['image'], float(p.m0), float(p.v0), p.block_size, p.threshold), ('normalized', None, 'norm_img', 'mask')),
+    GoldenStage('orientation', calculate_angles_and_coherence, lambda f, g, p, t: f(
+        *roi(g, p, 'normalized'), p.block_size), ('angles', None)),
+    GoldenStage('ridge_freq', ridge_freq, lambda f, g, p, t: f(
+        *roi(g, p, 'norm_img', 'mask'), g['angles'], p.block_size, p.freq_kernel_size, p.min_wave_length,
+        p.max_wave_length, return_map=True), ('freq', 'freq_map')),
+    GoldenStage('gabor', gabor_filter, lambda f, g, p, t: f(
+        *roi(g, p, 'norm_img'), g['angles'], g['freq'], p.kx, p.ky, W=p.block_size, angleInc=p.angle_inc),
+        ('gabor',)),
+    GoldenStage('skeletonize', skeletonize, lambda f, g, p, t: f(g['gabor'], *roi(g, p, 'mask'), t),
+                ('skeleton',)),
+    GoldenStage('minutiae', extract_minutiae, lambda f, g, p, t: f(g['skeleton'], p.minutiae_kernel_size),
+                ('minutiae',)),
+    GoldenStage('poincare', find_singularities, lambda f, g, p, t: f(
+        g['angles'], p.poincare_tolerance, p.block_size, *roi(g, p, 'mask')), ('singularities',)),
+]
+
+# metric of every recorded output
+METRICS = {'normalized': 'disagreement', 'norm_img': 'error', 'mask': 'disagreement', 'angles': 'angle_error',
+           'freq': 'freq_error', 'freq_map': 'freq_error', 'gabor': 'disagreement', 'skeleton': 'disagreement',
+           'minutiae': ('precision', 'recall'), 'singularities': ('precision', 'recall')}
+
+# largest error, or smallest precision and recall, a stage passes with
+TOLERANCES = {'disagreement': 1e-3, 'error': 1e-4, 'angle_error': 1e-3, 'freq_error': 1e-3, 'precision': .99,
+              'recall': .99}
+
+
+def stage_outputs(stage, outputs):
+    """
+    :return: {name: output} of the recorded outputs of a stage
+    """
+    if not isinstance(outputs, tuple):
+        outputs = (outputs,)
+    return {name: output for name, output in zip(stage.outputs, outputs) if name is not None}
+
+
+def compare(name, output, golden, radius=2):
+    """
+    :return: {metric: value} of an output against its recorded value
+    """
+    metric = METRICS[name]
+    if metric == 'disagreement':
+        if name == 'mask':
+            output, golden = output > 0, golden > 0
+        return {metric: float(np.count_nonzero(output != golden)) / max(golden.size, 1)}
+    if metric == 'error':
+        return {metric: float(np.abs(output.astype(np.float64) - golden).max(initial=0))}
+    if metric == 'angle_error':
+        difference = np.degrees(np.abs((output - golden + np.pi/2) % np.pi - np.pi/2))
+        return {metric: float(difference.max(initial=0))}
+    if metric == 'freq_error':
+        positive = golden > 0
+        error = np.where(positive, np.abs(output - golden) / np.where(positive, golden, 1), output > 0)
+        return {metric: float(error.max(initial=0))}
+    precision, recall = minutiae_agreement(output, golden, radius)
+    return {'precision': precision, 'recall': recall}
+
+
+def worst(metric, values):
+    return min(values) if metric in ('precision', 'recall') else max(values)
+
+
+def read_image(img_path, digest=None):
+    """
+    :param digest: sha1 the image was recorded with, the image must not have changed since
+    :return: (2d uint8 image, sha1 of its pixels)
+    """
+    img = cv.imread(img_path, 0)
+    if img is None:
+        raise ValueError('cannot read %s' % img_path)
+    img_digest = hashlib.sha1(img.tobytes()).hexdigest()
+    if digest is not None and img_digest != digest:
+        raise ValueError('%s changed since the golden outputs were recorded' % img_path)
+    return img, img_digest
+
+
+def pack_outputs(golden):
+    """
+    :param golden: {output: value} of one image
+    :return: the arrays to store: a uint8 normalized image has 256 values at most, so the background
+    normalized image is stored as the lookup table reproducing it when there is one
+    """
+    arrays = dict(golden)
+    normalized, norm_img = golden['normalized'], golden['norm_img']
+    if normalized.dtype == np.uint8:
+        lut = np.zeros(256, norm_img.dtype)
+        lut[normalized] = norm_img
+        if np.array_equal(lut[normalized], norm_img):
+            del arrays['norm_img']
+            arrays['norm_img_lut'] = lut
+    return arrays
+
+
+def unpack_outputs(arrays):
+    """
+    Inverse of pack_outputs.
+    """
+    golden = dict(arrays)
+    if 'norm_img_lut' in golden:
+        golden['norm_img'] = golden.pop('norm_img_lut')[golden['normalized']]
+    return golden
+
+
+def record(images_paths, archive, params=DEFAULT_PARAMS, thinning=DEFAULT_THINNING):
+    """
+    Runs the reference stages on every image and stores their outputs in archive. The images are not
+    stored, only their paths and digests.
+    """
+    arrays = {}
+    digests = []
+    seconds = np.zeros(len(STAGES))
+    for img_path in tqdm(images_paths, unit='img'):
+        name = image_name(img_path)
+        img, digest = read_image(img_path)
+        digests.append(digest)
+        golden = {'image': img}
+        for i, stage in enumerate(STAGES):
+            start = time.perf_counter()
+            outputs = stage.call(stage.reference, golden, params, thinning)
+            seconds[i] += time.perf_counter() - start
+            golden.update(stage_outputs(stage, outputs))
+        del golden['image']
+        arrays.update({'%s/%s' % (name, output): value for output, value in pack_outputs(golden).items()})
+
+    arrays['images'] = np.array(list(images_paths))
+    arrays['digests'] = np.array(digests)
+    arrays['seconds'] = seconds / max(len(images_paths), 1)
+    arrays['settings'] = np.array(json.dumps({'params': params._asdict(), 'thinning': thinning,
+                                              'dtype': np.dtype(float_dtype()).name}))
+    np.savez_compressed(archive, **arrays)
+
+
+def load_alternative(spec):
+    """
+    :param spec: 'module:function'
+    """
+    module, _, function = spec.partition(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def check(archive, alternatives=None, repeat=1, radius=2, stages=None):
+    """
+    Runs the reference and the alternative of every stage on the recorded inputs.
+    :param alternatives: {stage name: function}, the reference is checked for the other stages
+    :param stages: names of the stages to check, all of them by default
+    :return: {stage: {'reference': seconds, 'alternative': seconds, 'recorded': seconds,
+    'metrics': {metric: (worst value, image)}}}
+    """
+    alternatives = alternatives or {}
+    with np.load(archive) as golden_archive:
+        settings = json.loads(str(golden_archive['settings']))
+        params = DEFAULT_PARAMS._replace(**settings['params'])
+        set_float_dtype(np.dtype(settings['dtype']).type)
+        recorded = golden_archive['seconds']
+        images = [str(path) for path in golden_archive['images']]
+        digests = [str(digest) for digest in golden_archive['digests']]
+
+        results = {stage.name: {'reference': 0., 'alternative': 0., 'recorded': recorded[i] * len(images),
+                                'metrics': {}}
+                   for i, stage in enumerate(STAGES) if stages is None or stage.name in stages}
+        for img_path, digest in tqdm(list(zip(images, digests)), unit='img'):
+            name = image_name(img_path)
+            prefix = name + '/'
+            golden = unpack_outputs({key[len(prefix):]: golden_archive[key] for key in golden_archive.files
+                                     if key.startswith(prefix)})
+            golden['image'] = read_image(img_path, digest)[0]
+            for stage in STAGES:
+                if stage.name not in results:
+                    continue
+                result = results[stage.name]
+                function = alternatives.get(stage.name, stage.reference)
+                _, seconds = fastest(lambda: stage.call(stage.reference, golden, params, settings['thinning']),
+                                     repeat)
+                result['reference'] += seconds
+                outputs, seconds = fastest(lambda: stage.call(function, golden, params, settings['thinning']),
+                                           repeat)
+                result['alternative'] += seconds
+
+                for output, value in stage_outputs(stage, outputs).items():
+                    for metric, measured in compare(output, value, golden[output], radius).items():
+                        key = '%s %s' % (output, metric)
+                        previous = result['metrics'].get(key)
+                        if previous is None or worst(metric, [measured, previous[0]]) != previous[0]:
+                            result['metrics'][key] = (measured, name)
+    return results
+
+
+def failures(results, tolerances=TOLERANCES):
+    """
+    :return: list of (stage, output metric, worst value, image, tolerance)
+    """
+    failed = []
+    for stage, result in results.items():
+        for key, (value, image) in result['metrics'].items():
+            metric = key.split(' ', 1)[1]
+            tolerance = tolerances[metric]
+            if (value < tolerance if metric in ('precision', 'recall') else value > tolerance):
+                failed.append((stage, key, value, image, tolerance))
+    return failed
+
+
+def format_check(results, alternatives=()):
+    lines = ['%-12s %-5s %9s %9s %8s %12s  %s' % ('stage', 'impl', 'ref ms', 'new ms', 'speedup', 'recorded ms',
+                                                 'metrics (worst over the prints)')]
+    for stage, result in results.items():
+        metrics = ', '.join('%s %.4g' % (key, value) for key, (value, _) in result['metrics'].items())
+        lines.append('%-12s %-5s %9.2f %9.2f %7.2fx %12.2f  %s' % (
+            stage, 'new' if stage in alternatives else 'ref', 1000 * result['reference'],
+            1000 * result['alternative'], result['reference'] / max(result['alternative'], 1e-12),
+            1000 * result['recorded'], metrics))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['record', 'check'])
+    parser.add_argument('--archive', default='golden.npz', help='compressed archive of the golden outputs')
+    parser.add_argument('--input', default='./sample_inputs/*', help='glob pattern of the recorded images')
+    parser.add_argument('--float64', action='store_true', help='record in float64 instead of float32')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='stage parameter the outputs are recorded with')
+    parser.add_argument('--thinning', default=DEFAULT_THINNING, choices=available_backends())
+    parser.add_argument('--stage', action='append', default=[], metavar='NAME=MODULE:FUNCTION',
+                        help='alternative implementation of a stage, one of %s' % ', '.join(
+                            stage.name for stage in STAGES))
+    parser.add_argument('--only', nargs='+', default=None, metavar='STAGE', help='only check these stages')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--radius', type=float, default=2., help='pixels within which minutiae agree')
+    parser.add_argument('--tolerance', action='append', default=[], metavar='METRIC=VALUE',
+                        help='largest error, or smallest precision or recall, of %s' % ', '.join(TOLERANCES))
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        if args.float64:
+            set_float_dtype(np.float64)
+        images_paths = sorted(path for path in glob(args.input) if os.path.isfile(path))
+        record(images_paths, args.archive, parse_params(args.param), args.thinning)
+        sys.exit(0)
+
+    alternatives = {name: load_alternative(spec) for name, spec in (item.split('=', 1) for item in args.stage)}
+    tolerances = dict(TOLERANCES, **{metric: float(value) for metric, value in
+                                     (item.rsplit('=', 1) for item in args.tolerance)})
+    results = check(args.archive, alternatives, args.repeat, args.radius, args.only)
+    print(format_check(results, alternatives))
+    failed = failures(results, tolerances)
+    for stage, key, value, image, tolerance in failed:
+        print('MISMATCH %s %s: %.4g on %s, tolerance %.4g' % (stage, key, value, image, tolerance))
+    sys.exit(1 if failed else 0)
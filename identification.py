@@ -0,0 +1,87 @@
+"""
+1:N identification over the prints in './sample_inputs/' (10 fingers x 8 impressions, 101_1 ... 110_8).
+Every print is searched against the gallery of all the other prints and is counted as identified when
+the best candidate is another impression of the same finger.
+
+    python identification.py
+    python identification.py --gallery ./output/gallery.fpg
+"""
+import argparse
+import os
+import sys
+import time
+from glob import glob
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+from finegerprint_pipline import fingerprint_features, fingerprint_template
+from utils.matching import PairIndex, identify
+from utils.template import Gallery, write_gallery
+
+
+def enroll(img_dir, gallery_path):
+    images_paths = sorted(glob(img_dir))
+
+    def templates():
+        for img_path in tqdm(images_paths):
+            template = fingerprint_template(fingerprint_features(cv.imread(img_path, 0)))
+            yield os.path.splitext(os.path.basename(img_path))[0], template
+
+    write_gallery(gallery_path, templates())
+
+
+def search_all(templates, index, fingers, candidates=10):
+    """
+    Searches every template against all the others.
+    :param fingers: finger of every template, an identification is right when the best candidate is the
+    same finger
+    :return: (number of prints identified at rank 1, candidate scores of the same finger, candidate scores
+    of other fingers)
+    """
+    identified, genuine, impostor = 0, [], []
+    for i, probe in enumerate(templates):
+        positions, scores = identify(probe, index, templates, candidates=candidates, exclude=i)
+        if len(positions) and fingers[positions[0]] == fingers[i]:
+            identified += 1
+        same = fingers[positions] == fingers[i]
+        genuine.extend(scores[same]); impostor.extend(scores[~same])
+    return identified, genuine, impostor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='./sample_inputs/*')
+    parser.add_argument('--gallery', default=None, help='existing gallery, otherwise one is enrolled from --input')
+    parser.add_argument('--candidates', type=int, default=10)
+    args = parser.parse_args()
+
+    gallery_path = args.gallery
+    if gallery_path is None:
+        os.makedirs('./output/', exist_ok=True)
+        gallery_path = './output/identification_gallery.fpg'
+        enroll(args.input, gallery_path)
+
+    gallery = Gallery(gallery_path)
+    fingers = np.array([template_id.split('_')[0] for template_id in gallery.ids])
+
+    start = time.perf_counter()
+    templates = list(gallery)
+    index = PairIndex(templates)
+    index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    identified, genuine, impostor = search_all(templates, index, fingers, args.candidates)
+    search_time = time.perf_counter() - start
+
+    searches = len(templates)
+    print('gallery: %d templates, %d indexed pairs, index built in %.3fs' % (len(templates), len(index.keys), index_time))
+    if not searches:
+        sys.exit(0)
+    print('rank-1 identification rate: %.3f (%d/%d)' % (identified / searches, identified, searches))
+    print('mean candidate score: genuine %.4f, impostor %.4f' % (np.mean(genuine or [0]), np.mean(impostor or [0])))
+    # only the candidates of the pair index are scored, every one of them has a genuine or an impostor score
+    scored = len(genuine) + len(impostor)
+    print('search: %.1f ms per probe, %.0f scored comparisons/s (%.1f candidates per probe), '
+          'effective gallery scan %.0f templates/s'
+          % (1000 * search_time / searches, scored / search_time, scored / searches,
+             searches * (len(templates) - 1) / search_time))
@@ -0,0 +1,118 @@
+"""
+Compares the pyramid mode of utils.pyramid against the full resolution orientation and ridge frequency
+estimates on the prints in './sample_inputs/', to pick orientation_pyramid and frequency_pyramid.
+
+    python pyramid_comparison.py --levels 1 2
+    python pyramid_comparison.py --levels 1 --identification
+
+For every level the report holds, over the blocks inside the mask of every print:
+    angle err    mean and 90th percentile of the orientation difference in degrees
+    freq err     median and largest relative difference of the median ridge frequency, the only frequency
+                 the gabor stage uses. The pyramid frequencies are estimated with the full resolution
+                 orientations, so the two errors are measured separately.
+    freq blocks  fraction of the blocks with a frequency, full resolution / pyramid
+    speedup      of the orientation and of the ridge frequency stage, the fastest of --repeat runs
+With --identification every combination of the levels is also scored with the 1:N identification of
+sweep.py.
+"""
+import argparse
+import itertools
+import os
+from glob import glob
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+from benchmark import fastest
+from finegerprint_pipline import DEFAULT_PARAMS
+from sweep import run_sweep, format_results
+from utils.frequency import ridge_freq
+from utils.orientation import calculate_angles_and_coherence
+from utils.preprocessing import preprocess
+from utils.pyramid import pyramid_angles_and_coherence, pyramid_ridge_freq
+from utils.quality import block_coverage
+
+
+def angle_difference(a, b):
+    """
+    :return: absolute difference of two orientations in degrees, in [0, 90]
+    """
+    return np.degrees(np.abs((a - b + np.pi/2) % np.pi - np.pi/2))
+
+
+def compare_image(img, levels, params=DEFAULT_PARAMS, repeat=3):
+    """
+    :return: one dict of metrics per level
+    """
+    W = params.block_size
+    normalized, _, normim, mask = preprocess(img, float(params.m0), float(params.v0), W, params.threshold)
+    freq_args = (W, params.freq_kernel_size, params.min_wave_length, params.max_wave_length)
+
+    (angles, _), angles_seconds = fastest(lambda: calculate_angles_and_coherence(normalized, W), repeat)
+    (freq, freq_map), freq_seconds = fastest(
+        lambda: ridge_freq(normim, mask, angles, *freq_args, return_map=True), repeat)
+    inside_angles = block_coverage(mask, W, angles.shape, offset=1) > .5
+    inside_freq = block_coverage(mask, W, freq_map.shape) > .5
+    median = freq[mask > 0].max(initial=0)
+
+    results = []
+    for level in levels:
+        (pyramid_angles, _), pyramid_angles_seconds = fastest(
+            lambda: pyramid_angles_and_coherence(normalized, W, level), repeat)
+        (pyramid_freq, pyramid_map), pyramid_freq_seconds = fastest(
+            lambda: pyramid_ridge_freq(normim, mask, angles, *freq_args, level, return_map=True), repeat)
+
+        errors = angle_difference(angles, pyramid_angles)[inside_angles]
+        pyramid_median = pyramid_freq[mask > 0].max(initial=0)
+        results.append({
+            'angle_mean': float(errors.mean()) if len(errors) else 0.,
+            'angle_p90': float(np.percentile(errors, 90)) if len(errors) else 0.,
+            'freq_error': abs(pyramid_median - median) / median if median > 0 else float('nan'),
+            'freq_blocks': float((freq_map[inside_freq] > 0).mean()) if inside_freq.any() else 0.,
+            'pyramid_freq_blocks': float((pyramid_map[inside_freq] > 0).mean()) if inside_freq.any() else 0.,
+            'angles_seconds': angles_seconds, 'pyramid_angles_seconds': pyramid_angles_seconds,
+            'freq_seconds': freq_seconds, 'pyramid_freq_seconds': pyramid_freq_seconds})
+    return results
+
+
+def format_comparison(levels, results):
+    """
+    :param results: per image, the list of compare_image
+    """
+    lines = ['%5s %15s %13s %17s %13s %15s %13s' % (
+        'level', 'angle err mean', 'angle err p90', 'orient speedup', 'freq err p50', 'freq blocks',
+        'freq speedup')]
+    for i, level in enumerate(levels):
+        metrics = [image_results[i] for image_results in results]
+        mean = lambda name: np.mean([m[name] for m in metrics])
+        freq_errors = np.array([m['freq_error'] for m in metrics])
+        freq_errors = freq_errors[~np.isnan(freq_errors)]
+        lines.append('%5d %14.2fd %12.2fd %16.2fx %5.1f%% (max %3.0f%%) %6.2f / %-6.2f %12.2fx' % (
+            level, mean('angle_mean'), mean('angle_p90'), mean('angles_seconds') / mean('pyramid_angles_seconds'),
+            100 * np.median(freq_errors), 100 * freq_errors.max(), mean('freq_blocks'), mean('pyramid_freq_blocks'),
+            mean('freq_seconds') / mean('pyramid_freq_seconds')))
+    first = [image_results[0] for image_results in results]
+    lines.append('full resolution: orientation %.1fms, ridge frequency %.1fms per print' % (
+        1000 * np.mean([m['angles_seconds'] for m in first]), 1000 * np.mean([m['freq_seconds'] for m in first])))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='./sample_inputs/*', help='glob pattern of the input images')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--identification', action='store_true',
+                        help='also run the 1:N identification for every combination of the levels')
+    args = parser.parse_args()
+
+    images_paths = sorted(path for path in glob(args.input) if os.path.isfile(path))
+    results = [compare_image(cv.imread(img_path, 0), args.levels, repeat=args.repeat)
+               for img_path in tqdm(images_paths, unit='img')]
+    print(format_comparison(args.levels, results))
+
+    if args.identification:
+        names = ['orientation_pyramid', 'frequency_pyramid']
+        configurations = [DEFAULT_PARAMS._replace(orientation_pyramid=orientation_levels,
+                                                  frequency_pyramid=frequency_levels)
+                          for orientation_levels, frequency_levels in itertools.product([0] + args.levels, repeat=2)]
+        print(format_results(run_sweep(images_paths, configurations)[0], names))
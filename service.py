@@ -0,0 +1,427 @@
+"""
+Long running local service around the pipeline, so other processes get features or templates without
+starting Python and importing scipy, skimage and OpenCV for every print.
+
+    python service.py serve --address tcp://127.0.0.1:5555 --workers 4
+    python service.py bench --serve --input './sample_inputs/*' --clients 8
+
+The service keeps a pool of warm worker processes, their gabor filter banks preloaded, behind a zmq
+ROUTER socket. Requests arriving together are grouped into micro-batches: a batch is dispatched to a
+worker when it holds --max-batch requests or its oldest request waited --batch-window ms, and at most one
+batch per worker is in flight, so the requests queue in the service rather than in the pool. The service
+answers with an error instead of queueing more than --max-queue requests. When a worker process dies, the
+requests of the batches in flight are answered with an error and a new pool replaces the broken one.
+
+A request is a multipart message [header, image]:
+    header   JSON {"op": "template" | "features" | "stats", "shape": [height, width], "params": {...}}
+    image    an encoded image file (.tif, .png, ...) or, when "shape" is set, the raw uint8 pixels
+"params" overrides PipelineParams fields. The reply is [header, payload...] where header is JSON with "ok"
+and, on failure, "error":
+    template   the binary template of utils.template
+    features   one .npy per FingerprintFeatures array field, the names are in header["fields"]
+    stats      header["stats"]: latency percentiles over the last requests, queue depth, batch sizes
+
+ServiceClient wraps the protocol.
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from glob import glob
+import cv2 as cv
+import numpy as np
+import zmq
+from finegerprint_pipline import fingerprint_features, fingerprint_template, init_worker, parse_params, \
+    FingerprintFeatures, DEFAULT_PARAMS
+from utils.gabor_filter import filter_bank_cache
+from utils.instrumentation import PERCENTILES
+from utils.memory import float_dtype
+from utils.skeletonize import DEFAULT_THINNING
+from utils.template import template_to_bytes, template_from_bytes
+
+DEFAULT_ADDRESS = 'tcp://127.0.0.1:5555'
+OPS = ('template', 'features', 'stats')
+# arrays of FingerprintFeatures sent back by a features request
+FEATURE_FIELDS = [field for field in FingerprintFeatures._fields if field not in ('block_size', 'quality')]
+
+
+def warm_up(params=DEFAULT_PARAMS):
+    """
+    Worker warm up: builds the filter banks of every rounded frequency ridge_freq can return.
+    """
+    low = np.round(100/params.max_wave_length)
+    high = np.round(100/params.min_wave_length)
+    for frequency in np.arange(low, high + 1) / 100:
+        filter_bank_cache.get(frequency, params.kx, params.ky, params.angle_inc)
+    return os.getpid()
+
+
+def init_service_worker(filter_banks, dtype):
+    """
+    Pool initializer: init_worker, then warm_up when no filter banks are preloaded, so every worker process
+    is warm before it takes its first batch.
+    """
+    init_worker(filter_banks, dtype)
+    if not filter_banks:
+        warm_up()
+
+
+def decode_image(payload, shape=None):
+    """
+    :param payload: encoded image file bytes, or raw uint8 pixels when shape is given
+    :return: 2d uint8 image
+    """
+    if shape is not None:
+        return np.frombuffer(payload, np.uint8).reshape(shape)
+    image = cv.imdecode(np.frombuffer(payload, np.uint8), cv.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError('cannot decode the image')
+    return image
+
+
+def array_to_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def process_requests(requests, thinning=DEFAULT_THINNING):
+    """
+    Batch worker: runs the pipeline on every request of a micro-batch.
+    :param requests: list of (header dict, image bytes)
+    :return: list of (reply header dict, list of payload bytes), failures are replied one by one
+    """
+    replies = []
+    for header, payload in requests:
+        try:
+            params = parse_params(['%s=%s' % item for item in header.get('params', {}).items()])
+            image = decode_image(payload, header.get('shape'))
+            features = fingerprint_features(image, thinning=thinning, params=params)
+            if header['op'] == 'template':
+                replies.append(({'ok': True}, [template_to_bytes(fingerprint_template(features))]))
+            else:
+                replies.append(({'ok': True, 'fields': FEATURE_FIELDS},
+                                [array_to_bytes(getattr(features, field)) for field in FEATURE_FIELDS]))
+        except Exception as error:
+            replies.append(({'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}, []))
+    return replies
+
+
+class PipelineService:
+
+    def __init__(self, address=DEFAULT_ADDRESS, workers=None, max_batch=8, batch_window=0.005, max_queue=256,
+                 filter_banks=None, thinning=DEFAULT_THINNING, history=10000):
+        """
+        :param workers: number of worker processes, defaults to the number of cores
+        :param max_batch: largest number of requests sent to a worker at once
+        :param batch_window: seconds a request may wait for others to join its batch
+        :param max_queue: requests waiting or being processed above which new ones are refused
+        :param filter_banks: .npz of gabor filter banks loaded by every worker at startup, otherwise the
+        banks of the default parameters are built
+        :param history: number of latest requests the latency percentiles are computed over
+        """
+        self.address = address
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.filter_banks = filter_banks
+        self.thinning = thinning
+
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.served = 0
+        self.errors = 0
+        self.refused = 0
+        self.max_depth = 0
+        self.started = None
+        self._stopped = threading.Event()
+        self._done_address = 'inproc://pipeline-service-done-%d' % id(self)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _notify(self, future):
+        # runs in the thread of the pool completing the future, which must not touch the service sockets
+        socket = zmq.Context.instance().socket(zmq.PUSH)
+        socket.connect(self._done_address)
+        socket.send(b'')
+        socket.close()
+
+    def stats(self, pending, in_flight):
+        latencies = np.array(self.latencies, np.float64)
+        depth = len(pending) + sum(len(batch) for batch in in_flight.values())
+        return {
+            'served': self.served, 'errors': self.errors, 'refused': self.refused,
+            'queue_depth': depth, 'waiting': len(pending), 'max_queue_depth': self.max_depth,
+            'batches_in_flight': len(in_flight), 'workers': self.workers,
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            'latency_ms': {'p%d' % p: float(np.percentile(latencies, p)) * 1000 if len(latencies) else None
+                           for p in PERCENTILES},
+            'uptime': time.perf_counter() - self.started,
+        }
+
+    def serve(self, ready=None):
+        """
+        Serves until stop() is called.
+        :param ready: threading.Event set once the socket is bound and the workers are warm
+        """
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.ROUTER)
+        socket.bind(self.address)
+        done = context.socket(zmq.PULL)
+        done.bind(self._done_address)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(done, zmq.POLLIN)
+
+        # (client envelope, header, image bytes, arrival time)
+        pending = deque()
+        # future -> the requests of its batch
+        in_flight = {}
+        pool = self._start_pool()
+        try:
+            # starts the workers, each one warms up in the pool initializer
+            for future in [pool.submit(os.getpid) for _ in range(self.workers)]:
+                future.result()
+            self.started = time.perf_counter()
+            if ready is not None:
+                ready.set()
+
+            while not self._stopped.is_set():
+                if pending and len(in_flight) < self.workers:
+                    timeout = max(0, pending[0][3] + self.batch_window - time.perf_counter()) * 1000
+                else:
+                    timeout = 100
+                events = dict(poller.poll(timeout))
+
+                if done in events:
+                    while done.poll(0):
+                        done.recv()
+                if socket in events:
+                    while socket.poll(0):
+                        self._receive(socket, socket.recv_multipart(), pending, in_flight)
+
+                # replies of the finished batches
+                broken = None
+                for future in [future for future in in_flight if future.done()]:
+                    batch = in_flight.pop(future)
+                    try:
+                        replies = future.result()
+                    except Exception as error:
+                        # a worker died or the batch could not be sent to it, every request of it fails
+                        if isinstance(error, BrokenProcessPool):
+                            broken = error
+                        replies = [self._error(error)] * len(batch)
+                    self._reply(socket, batch, replies)
+
+                if broken is not None:
+                    pool = self._replace_pool(pool, socket, in_flight, broken)
+
+                # dispatch full batches, or the oldest requests once their window is over
+                while pending and len(in_flight) < self.workers and \
+                        (len(pending) >= self.max_batch or time.perf_counter() >= pending[0][3] + self.batch_window):
+                    batch = [pending.popleft() for _ in range(min(self.max_batch, len(pending)))]
+                    try:
+                        future = pool.submit(process_requests, [(header, image) for _, header, image, _ in batch],
+                                             self.thinning)
+                    except BrokenProcessPool as error:
+                        self._reply(socket, batch, [self._error(error)] * len(batch))
+                        pool = self._replace_pool(pool, socket, in_flight, error)
+                        continue
+                    in_flight[future] = batch
+                    self.batch_sizes.append(len(batch))
+                    future.add_done_callback(self._notify)
+        finally:
+            pool.shutdown()
+            socket.close()
+            done.close()
+
+    def _start_pool(self):
+        return ProcessPoolExecutor(self.workers, initializer=init_service_worker,
+                                   initargs=(self.filter_banks, float_dtype()))
+
+    def _replace_pool(self, pool, socket, in_flight, error):
+        """
+        A worker of pool died: the batches still in flight are lost with it, they are answered with error
+        and a new pool takes the next batches.
+        :return: the new pool
+        """
+        for batch in in_flight.values():
+            self._reply(socket, batch, [self._error(error)] * len(batch))
+        in_flight.clear()
+        pool.shutdown(wait=False)
+        return self._start_pool()
+
+    @staticmethod
+    def _error(error):
+        return {'ok': False, 'error': '%s: %s' % (type(error).__name__, error)}, []
+
+    def _reply(self, socket, batch, replies):
+        """
+        Sends the reply of every request of a batch.
+        """
+        for (envelope, _, _, arrival), (header, payload) in zip(batch, replies):
+            socket.send_multipart(envelope + [json.dumps(header).encode()] + payload)
+            self.latencies.append(time.perf_counter() - arrival)
+            self.served += 1
+            self.errors += not header['ok']
+
+    def _receive(self, socket, frames, pending, in_flight):
+        # ROUTER frames: identity, empty delimiter from REQ clients, header, image
+        delimiter = frames.index(b'') + 1 if b'' in frames[:2] else 1
+        envelope, message = frames[:delimiter], frames[delimiter:]
+        try:
+            header = json.loads(message[0])
+            if header.get('op') not in OPS:
+                raise ValueError('op must be one of %s' % ', '.join(OPS))
+        except (ValueError, IndexError) as error:
+            socket.send_multipart(envelope + [json.dumps({'ok': False, 'error': str(error)}).encode()])
+            self.errors += 1
+            return
+
+        if header['op'] == 'stats':
+            socket.send_multipart(envelope + [json.dumps({'ok': True, 'stats': self.stats(pending, in_flight)})
+                                              .encode()])
+            return
+
+        depth = len(pending) + sum(len(batch) for batch in in_flight.values())
+        if depth >= self.max_queue:
+            socket.send_multipart(envelope + [json.dumps({'ok': False, 'error': 'queue full'}).encode()])
+            self.refused += 1
+            return
+        pending.append((envelope, header, message[1] if len(message) > 1 else b'', time.perf_counter()))
+        self.max_depth = max(self.max_depth, depth + 1)
+
+
+class ServiceClient:
+    """
+    Synchronous client, one request at a time; use one client per thread.
+
+        client = ServiceClient()
+        template = client.template(open('101_1.tif', 'rb').read())
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        """
+        :param timeout: seconds to wait for a reply, None waits forever
+        """
+        self.socket = zmq.Context.instance().socket(zmq.REQ)
+        if timeout is not None:
+            self.socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+        self.socket.connect(address)
+
+    def request(self, op, image=None, **params):
+        """
+        :param image: encoded image file bytes or a 2d uint8 array
+        :return: (reply header, payload frames), raises RuntimeError when the service failed
+        """
+        header = {'op': op, 'params': params}
+        payload = b''
+        if isinstance(image, np.ndarray):
+            header['shape'] = list(image.shape)
+            payload = np.ascontiguousarray(image, np.uint8).tobytes()
+        elif image is not None:
+            payload = bytes(image)
+        self.socket.send_multipart([json.dumps(header).encode(), payload])
+
+        frames = self.socket.recv_multipart()
+        reply = json.loads(frames[0])
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        return reply, frames[1:]
+
+    def template(self, image, **params):
+        _, frames = self.request('template', image, **params)
+        return template_from_bytes(frames[0])
+
+    def features(self, image, **params):
+        """
+        :return: {field: array}
+        """
+        reply, frames = self.request('features', image, **params)
+        return {field: np.load(io.BytesIO(frame)) for field, frame in zip(reply['fields'], frames)}
+
+    def stats(self):
+        return self.request('stats')[0]['stats']
+
+    def close(self):
+        self.socket.close()
+
+
+def run_clients(address, images_paths, clients, repeat=1):
+    """
+    Sends every image repeat times from concurrent clients, one thread each.
+    :return: latencies in seconds seen by the clients
+    """
+    payloads = [open(img_path, 'rb').read() for img_path in images_paths] * repeat
+    latencies, lock = [], threading.Lock()
+
+    def run(start):
+        client = ServiceClient(address)
+        for payload in payloads[start::clients]:
+            begin = time.perf_counter()
+            client.template(payload)
+            with lock:
+                latencies.append(time.perf_counter() - begin)
+        client.close()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('--address', default=DEFAULT_ADDRESS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--batch-window', type=float, default=5, metavar='MS')
+    parser.add_argument('--max-queue', type=int, default=256)
+    parser.add_argument('--filter-banks', default=None, help='.npz of gabor filter banks to preload in workers')
+    parser.add_argument('--serve', action='store_true', help='bench: start the service in this process')
+    parser.add_argument('--input', default='./sample_inputs/*', help='bench: glob pattern of the images sent')
+    parser.add_argument('--clients', type=int, default=8, help='bench: number of concurrent clients')
+    parser.add_argument('--repeat', type=int, default=1, help='bench: number of times every image is sent')
+    args = parser.parse_args()
+
+    service = PipelineService(args.address, args.workers, args.max_batch, args.batch_window / 1000, args.max_queue,
+                              args.filter_banks)
+    if args.command == 'serve':
+        print('serving on %s' % args.address)
+        try:
+            service.serve()
+        except KeyboardInterrupt:
+            pass
+    else:
+        if args.serve:
+            ready = threading.Event()
+            thread = threading.Thread(target=service.serve, args=(ready,))
+            thread.start()
+            ready.wait()
+
+        images_paths = sorted(path for path in glob(args.input) if os.path.isfile(path))
+        start = time.perf_counter()
+        latencies = np.array(run_clients(args.address, images_paths, args.clients, args.repeat))
+        elapsed = time.perf_counter() - start
+
+        print('%d requests from %d clients in %.2fs, %.1f requests/s' % (
+            len(latencies), args.clients, elapsed, len(latencies) / elapsed))
+        print('client latency: %s' % ', '.join('p%d %.1fms' % (p, 1000 * np.percentile(latencies, p))
+                                               for p in PERCENTILES))
+        client = ServiceClient(args.address)
+        print('service: %s' % json.dumps(client.stats()))
+        client.close()
+
+        if args.serve:
+            service.stop()
+            thread.join()
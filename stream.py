@@ -0,0 +1,343 @@
+"""
+Live capture mode: a sensor delivers bursts of near identical frames of the same finger, the stream
+processor keeps the state of the last frame and only recomputes what a new frame changes.
+
+    python stream.py --input './sample_inputs/*' --burst 8 --fps 15
+    python stream.py --burst 8 --verify
+
+Every frame is compared block by block with the frame the state was computed from: a block changed when
+the mean absolute difference of its pixels is above --change-threshold gray levels, so sensor noise alone
+changes nothing. A frame is then processed as
+    keyframe     the whole pipeline, when there is no state yet, when more than --max-changed of the
+                 blocks changed or a block outside the region of interest did (the finger moved or was
+                 lifted), and every --keyframe-interval frames so the state never drifts far
+    incremental  the mask, the normalization statistics, the ridge frequency and so the gabor filter bank
+                 of the keyframe are kept. The changed blocks are normalized with the lookup tables of the
+                 keyframe, only their orientation blocks are estimated again and only the pixels within
+                 the filter radius of them are gabor filtered; thinning, minutiae and singular points run on
+                 the whole region of interest
+    unchanged    no block changed, the features of the previous frame are returned as they are
+The outputs inside the changed blocks are the ones the pipeline gives for the state image, the frame with
+the unchanged blocks left as they were in the state. --verify runs every frame through the full pipeline
+as well and reports how far the minutiae of the two are with utils.matching.minutiae_agreement.
+
+process_stream reads the frames on a thread into a queue of --queue-size frames: when the processing falls
+behind, the oldest queued frames are replaced and frames older than --max-latency ms are dropped, so a
+result is always about a recent frame. replay_frames turns the sample prints into such a stream: --burst
+frames per print with sensor noise and a pressure patch that moves from frame to frame.
+"""
+import argparse
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from glob import glob
+import cv2 as cv
+import numpy as np
+import scipy.ndimage
+from finegerprint_pipline import fingerprint_features, parse_params, FingerprintFeatures, DEFAULT_PARAMS, \
+    PipelineParams
+from utils.crossing_number import extract_minutiae
+from utils.gabor_filter import gabor_filter, filter_radius
+from utils.instrumentation import PERCENTILES
+from utils.matching import minutiae_agreement
+from utils.normalization import uint8_mean_std, normalize_values
+from utils.orientation import block_gradient_sums, angles_and_coherence
+from utils.poincare import find_singularities
+from utils.pyramid import pyramid_angles_and_coherence
+from utils.roi import roi_box, roi_margin, crop, uncrop, shift_points
+from utils.segmentation import block_sums, background_lut, mean_std
+from utils.skeletonize import skeletonize, available_backends, DEFAULT_THINNING
+
+KINDS = ('keyframe', 'incremental', 'unchanged')
+
+# kind: one of KINDS, changed: fraction of the blocks that changed, latency: seconds from the arrival of the
+# frame to its result, seconds: processing time, dropped: frames skipped since the previous result
+StreamResult = namedtuple('StreamResult', ['index', 'features', 'kind', 'changed', 'latency', 'seconds',
+                                           'dropped'])
+
+
+class StreamProcessor:
+    """
+    Stateful pipeline over consecutive frames of one sensor, see the module docstring.
+    """
+
+    def __init__(self, params=DEFAULT_PARAMS, thinning=DEFAULT_THINNING, change_threshold=6., max_changed=.25,
+                 keyframe_interval=30, memory_budget=None):
+        """
+        :param params: PipelineParams
+        :param change_threshold: mean absolute difference in gray levels above which a block changed
+        :param max_changed: fraction of changed blocks above which a frame is a keyframe
+        :param keyframe_interval: frames after which a keyframe is forced
+        """
+        self.params = params
+        self.thinning = thinning
+        self.change_threshold = change_threshold
+        self.max_changed = max_changed
+        self.keyframe_interval = keyframe_interval
+        self.memory_budget = memory_budget
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the state, the next frame is a keyframe.
+        """
+        self.reference = None
+        self.features = None
+        self.since_keyframe = 0
+
+    def process(self, frame):
+        """
+        :param frame: 2d uint8 image
+        :return: (FingerprintFeatures, kind, fraction of changed blocks)
+        """
+        W = self.params.block_size
+        if self.reference is None or frame.shape != self.reference.shape:
+            return self.keyframe(frame), 'keyframe', 1.
+
+        diff = block_sums(cv.absdiff(frame, self.reference), W)
+        changed = diff[0] / diff[2] > self.change_threshold
+        fraction = float(changed.mean())
+        if not changed.any():
+            self.since_keyframe += 1
+            return self.features, 'unchanged', 0.
+
+        top, bottom, left, right = self.box
+        inside = np.zeros(changed.shape, bool)
+        inside[top // W:-(-bottom // W), left // W:-(-right // W)] = True
+        if fraction > self.max_changed or (changed & ~inside).any() or \
+                self.since_keyframe + 1 >= self.keyframe_interval:
+            return self.keyframe(frame), 'keyframe', fraction
+
+        self.since_keyframe += 1
+        self.features = self.incremental(frame, changed)
+        return self.features, 'incremental', fraction
+
+    def keyframe(self, frame):
+        """
+        Runs the whole pipeline on frame and keeps the state the incremental frames reuse.
+        """
+        params = self.params
+        features = fingerprint_features(frame, thinning=self.thinning, memory_budget=self.memory_budget,
+                                        params=params)
+
+        # the lookup tables normalize and preprocess use for this frame
+        (m,), (std,) = uint8_mean_std(frame[None])
+        self.normalize_lut = normalize_values(np.arange(256), float(params.m0), float(params.v0), m,
+                                              std ** 2).astype(np.uint8)
+        (mean,), (std,) = mean_std(features.normalized[None])
+        self.background_lut = background_lut(features.normalized, features.mask, mean, std)
+
+        # the region of interest of the pipeline
+        self.radius = filter_radius(np.round(100/params.max_wave_length)/100, params.kx, params.ky)
+        self.box = roi_box(features.mask, params.block_size, roi_margin(params.block_size, self.radius))
+
+        self.reference = frame.copy()
+        self.features = features
+        self.since_keyframe = 0
+        return features
+
+    def incremental(self, frame, changed):
+        """
+        :param changed: block map of the blocks that changed since the state, inside the region of interest
+        :return: FingerprintFeatures of the state updated with the changed blocks of frame
+        """
+        params, features = self.params, self.features
+        W = params.block_size
+        (y, x) = frame.shape
+        top, bottom, left, right = self.box
+
+        # normalization and segmentation of the changed pixels with the statistics of the keyframe
+        pixels = np.repeat(np.repeat(changed, W, axis=0), W, axis=1)[:y, :x]
+        self.reference[pixels] = frame[pixels]
+        normalized, segmented, normim = features.normalized.copy(), features.segmented.copy(), \
+            features.norm_img.copy()
+        normalized[pixels] = self.normalize_lut[frame[pixels]]
+        segmented[pixels] = normalized[pixels] * features.mask[pixels]
+        normim[pixels] = self.background_lut[normalized[pixels]]
+        (roi_normalized, roi_normim, roi_mask, roi_freq) = crop(self.box, normalized, normim, features.mask,
+                                                                features.freq)
+        roi_changed = changed[top // W:-(-bottom // W), left // W:-(-right // W)]
+
+        # orientation blocks start at pixel 1, the gradients of a changed block reach the block before it
+        angles = features.angles.copy()
+        roi_angles = angles[top // W:top // W + len(range(1, bottom - top, W)),
+                            left // W:left // W + len(range(1, right - left, W))]
+        if params.orientation_pyramid:
+            roi_angles[:] = pyramid_angles_and_coherence(roi_normalized, W, params.orientation_pyramid)[0]
+        else:
+            rows, cols = np.nonzero(roi_changed)
+            row0, row1 = max(rows.min() - 1, 0), min(rows.max() + 1, roi_angles.shape[0])
+            col0, col1 = max(cols.min() - 1, 0), min(cols.max() + 1, roi_angles.shape[1])
+            sums = block_gradient_sums(roi_normalized[row0*W:row1*W + 2, col0*W:col1*W + 2], W)
+            roi_angles[row0:row1, col0:col1] = angles_and_coherence(
+                *(block_sums[:row1 - row0, :col1 - col0] for block_sums in sums))[0]
+
+        # gabor only reads the pixels within the filter radius, orientation blocks are aligned to pixel 0 there
+        margin = self.radius // W + 1
+        dirty = scipy.ndimage.binary_dilation(roi_changed, np.ones((2*margin + 1, 2*margin + 1), bool))
+        dirty = np.repeat(np.repeat(dirty, W, axis=0), W, axis=1)[:bottom - top, :right - left]
+        roi_gabor = crop(self.box, features.gabor)[0].copy()
+        partial = gabor_filter(roi_normim, roi_angles, roi_freq * dirty, params.kx, params.ky,
+                               memory_budget=self.memory_budget, W=W, angleInc=params.angle_inc)
+        roi_gabor[dirty] = partial[dirty]
+
+        thin_image = skeletonize(roi_gabor, roi_mask, self.thinning)
+        minutiae = extract_minutiae(thin_image, params.minutiae_kernel_size)
+        singularities = find_singularities(roi_angles, params.poincare_tolerance, W, roi_mask)
+
+        return FingerprintFeatures(normalized, segmented, normim, features.mask, angles, features.freq,
+                                   uncrop(roi_gabor, self.box, (y, x), 255), uncrop(thin_image, self.box, (y, x), 255),
+                                   shift_points(minutiae, self.box), shift_points(singularities, self.box), W)
+
+
+def process_stream(frames, processor, max_latency=None, queue_size=2):
+    """
+    Generator of the results of a live stream, frames are read on a thread while the previous one is
+    processed.
+    :param frames: iterable of 2d uint8 frames, paced like the sensor
+    :param processor: StreamProcessor
+    :param max_latency: seconds after which a queued frame is dropped, None to keep every queued frame
+    :param queue_size: frames waiting at most, the oldest is replaced when a new one arrives
+    :return: generator of StreamResult
+    """
+    queue = deque(maxlen=queue_size)
+    condition = threading.Condition()
+    reader = {'done': False, 'error': None}
+
+    def read():
+        try:
+            for index, frame in enumerate(frames):
+                with condition:
+                    queue.append((index, time.perf_counter(), frame))
+                    condition.notify()
+        except Exception as error:
+            reader['error'] = error
+        with condition:
+            reader['done'] = True
+            condition.notify()
+
+    threading.Thread(target=read, name='stream-reader', daemon=True).start()
+    last = -1
+    while True:
+        with condition:
+            while not queue and not reader['done']:
+                condition.wait()
+            if not queue:
+                break
+            index, arrival, frame = queue.popleft()
+        if max_latency is not None and time.perf_counter() - arrival > max_latency:
+            continue
+
+        start = time.perf_counter()
+        features, kind, changed = processor.process(frame)
+        end = time.perf_counter()
+        yield StreamResult(index, features, kind, changed, end - arrival, end - start, index - last - 1)
+        last = index
+
+    if reader['error'] is not None:
+        raise reader['error']
+
+
+def replay_frames(images_paths, burst=8, noise=2., pressure=.3, fps=None, seed=0):
+    """
+    Synthetic sensor stream: burst frames per image, each with gaussian sensor noise, and after the first
+    one a patch pressed harder, darker by up to pressure, at a new place inside the print every frame.
+    :param fps: frames per second the stream is paced at, None for as fast as they are consumed
+    :return: generator of 2d uint8 frames
+    """
+    rng = np.random.default_rng(seed)
+    start = time.perf_counter()
+    count = 0
+    for img_path in images_paths:
+        img = cv.imread(img_path, 0).astype(np.float64)
+        (y, x) = img.shape
+        rows, cols = np.mgrid[:y, :x]
+        for i in range(burst):
+            frame = img + rng.normal(0, noise, img.shape)
+            if i:
+                center_y, center_x = rng.uniform(.25, .75) * y, rng.uniform(.25, .75) * x
+                sigma = rng.uniform(.04, .08) * min(y, x)
+                frame *= 1 - pressure * np.exp(-((rows - center_y)**2 + (cols - center_x)**2) / (2 * sigma**2))
+            if fps:
+                time.sleep(max(start + count / fps - time.perf_counter(), 0))
+            count += 1
+            yield np.clip(np.round(frame), 0, 255).astype(np.uint8)
+
+
+def format_summary(results, frames):
+    """
+    :param results: list of StreamResult
+    :param frames: number of frames in the stream
+    """
+    lines = ['%d frames: %s, %d dropped' % (frames, ', '.join(
+        '%d %s' % (sum(result.kind == kind for result in results), kind) for kind in KINDS),
+        frames - len(results))]
+    latencies = np.array([result.latency for result in results])
+    lines.append('latency %s ms' % ', '.join('p%d %.1f' % (p, 1000 * np.percentile(latencies, p))
+                                               for p in PERCENTILES) if len(latencies) else 'latency -')
+    for kind in KINDS:
+        selected = [result for result in results if result.kind == kind]
+        if selected:
+            lines.append('%-12s %7.1f ms/frame, %4.1f%% of the blocks changed' % (
+                kind, 1000 * np.mean([result.seconds for result in selected]),
+                100 * np.mean([result.changed for result in selected])))
+    return '\n'.join(lines)
+
+
+def verify(frames, processor):
+    """
+    Processes every frame with processor and with the full pipeline.
+    :return: (results, agreement) with agreement a list of (precision, recall) of the minutiae of every
+    incremental frame against the full pipeline
+    """
+    results, agreement = [], []
+    for index, frame in enumerate(frames):
+        start = time.perf_counter()
+        features, kind, changed = processor.process(frame)
+        seconds = time.perf_counter() - start
+        results.append(StreamResult(index, features, kind, changed, seconds, seconds, 0))
+        if kind == 'incremental':
+            reference = fingerprint_features(frame, thinning=processor.thinning, params=processor.params)
+            agreement.append(minutiae_agreement(features.minutiae, reference.minutiae))
+    return results, agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='./sample_inputs/*', help='glob pattern of the replayed images')
+    parser.add_argument('--burst', type=int, default=8, help='frames per image')
+    parser.add_argument('--noise', type=float, default=2., help='standard deviation of the sensor noise')
+    parser.add_argument('--pressure', type=float, default=.3, help='darkening of the pressure patches')
+    parser.add_argument('--fps', type=float, default=15., help='frame rate of the replay, 0 for no pacing')
+    parser.add_argument('--max-latency', type=float, default=None, metavar='MS',
+                        help='drop the frames that waited longer')
+    parser.add_argument('--queue-size', type=int, default=2)
+    parser.add_argument('--change-threshold', type=float, default=6.)
+    parser.add_argument('--max-changed', type=float, default=.25)
+    parser.add_argument('--keyframe-interval', type=int, default=30)
+    parser.add_argument('--thinning', default=DEFAULT_THINNING, choices=available_backends())
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='stage parameter, one of %s' % ', '.join(PipelineParams._fields))
+    parser.add_argument('--verify', action='store_true',
+                        help='process every frame, unpaced, and compare with the full pipeline')
+    args = parser.parse_args()
+
+    images_paths = sorted(path for path in glob(args.input) if os.path.isfile(path))
+    processor = StreamProcessor(parse_params(args.param), args.thinning, args.change_threshold, args.max_changed,
+                                args.keyframe_interval)
+    frames = len(images_paths) * args.burst
+
+    if args.verify:
+        results, agreement = verify(replay_frames(images_paths, args.burst, args.noise, args.pressure), processor)
+        print(format_summary(results, frames))
+        if agreement:
+            precision, recall = np.array(agreement).T
+            print('minutiae of the incremental frames against the full pipeline: precision %.3f (min %.3f), '
+                  'recall %.3f (min %.3f)' % (precision.mean(), precision.min(), recall.mean(), recall.min()))
+    else:
+        max_latency = args.max_latency / 1000 if args.max_latency else None
+        results = list(process_stream(
+            replay_frames(images_paths, args.burst, args.noise, args.pressure, args.fps or None, seed=0),
+            processor, max_latency, args.queue_size))
+        print(format_summary(results, frames))
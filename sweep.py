@@ -0,0 +1,169 @@
+"""
+Parameter sweep over the prints in './sample_inputs/'. Every combination of the --grid values is run on
+every print and scored with the 1:N identification of identification.py.
+
+    python sweep.py --grid kx=0.5,0.65 ky=0.5,0.65 angle_inc=3,6
+    python sweep.py --grid block_size=12,16 threshold=0.1,0.2 min_wave_length=3,5 max_wave_length=15,20
+
+The stages form a DAG through their cache keys (see utils.stage_cache): a stage only depends on its own
+parameters and on its upstream stages, so for every print each distinct upstream prefix of the grid is
+computed once and its outputs are shared by all the configurations below it, e.g. a grid over kx and ky
+runs preprocess, orientation and ridge_freq once per print and gabor once per (kx, ky). The stages after
+segmentation run on the region of interest, whose margin grows with the gabor filter radius, so the
+parameters widening the filters (max_wave_length, kx, ky) may rerun orientation as well.
+
+For every configuration the report holds:
+    ms/img    time of all its stages per print, shared stages included, i.e. the cost of running it alone
+    rank-1    rank-1 identification rate
+    d'        separation of the genuine and impostor candidate scores, (mean difference) / (pooled std)
+    minutiae  mean number of template minutiae per print
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from glob import glob
+import cv2 as cv
+import numpy as np
+from tqdm import tqdm
+from finegerprint_pipline import fingerprint_features, fingerprint_template, image_name, parse_params, \
+    PipelineParams, DEFAULT_PARAMS
+from identification import search_all
+from utils.instrumentation import Instrumentation
+from utils.matching import PairIndex
+from utils.stage_cache import MemoryStageCache
+
+
+class SweepCache(MemoryStageCache):
+    """
+    MemoryStageCache that also records how long every entry took to compute and which keys were read
+    since the last reset, so the cost of a configuration includes the stages it shares.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.seconds = {}
+        self.used = []
+        self._start = None
+
+    def get(self, key):
+        self.used.append(key)
+        outputs = super().get(key)
+        if outputs is None:
+            self._start = time.perf_counter()
+        return outputs
+
+    def put(self, key, outputs):
+        self.seconds[key] = time.perf_counter() - self._start
+        super().put(key, outputs)
+
+    def clear(self):
+        super().clear()
+        self.seconds.clear()
+        self.used = []
+
+
+def parse_grid(items):
+    """
+    :param items: 'name=value,value..' strings, the names are PipelineParams fields
+    :return: (swept names, one PipelineParams per combination). The names are taken in pipeline order, so
+    consecutive configurations share the longest upstream prefix.
+    """
+    grid = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        grid[name] = [getattr(parse_params(['%s=%s' % (name, value)]), name) for value in values.split(',')]
+    names = sorted(grid, key=PipelineParams._fields.index)
+
+    configurations = [DEFAULT_PARAMS._replace(**dict(zip(names, combination)))
+                      for combination in itertools.product(*(grid[name] for name in names))]
+    return names, configurations
+
+
+def separation(genuine, impostor):
+    """
+    :return: d', difference of the means over the pooled standard deviation, nan without both kinds
+    """
+    if len(genuine) < 2 or len(impostor) < 2:
+        return float('nan')
+    genuine, impostor = np.asarray(genuine), np.asarray(impostor)
+    pooled = np.sqrt((genuine.var() + impostor.var()) / 2)
+    return float((genuine.mean() - impostor.mean()) / pooled) if pooled > 0 else float('nan')
+
+
+def run_sweep(images_paths, configurations, candidates=10):
+    """
+    :return: (one result dict per configuration, Instrumentation holding every stage that actually ran,
+    seconds spent in those stages)
+    """
+    cache = SweepCache()
+    instrumentation = Instrumentation(trace_memory=False)
+    seconds = np.zeros(len(configurations))
+    computed = 0
+    templates = [[] for _ in configurations]
+
+    for img_path in tqdm(images_paths, unit='img'):
+        instrumentation.image = image_name(img_path)
+        input_img = cv.imread(img_path, 0)
+        for i, params in enumerate(configurations):
+            cache.used = []
+            features = fingerprint_features(input_img, instrumentation, params=params, cache=cache)
+            templates[i].append(fingerprint_template(features))
+            seconds[i] += sum(cache.seconds[key] for key in cache.used)
+        # the outputs of a print are not shared with the next one
+        computed += sum(cache.seconds.values())
+        cache.clear()
+
+    fingers = np.array([image_name(img_path).split('_')[0] for img_path in images_paths])
+    results = []
+    for params, config_templates, config_seconds in zip(configurations, templates, seconds):
+        identified, genuine, impostor = search_all(config_templates, PairIndex(config_templates), fingers,
+                                                   candidates)
+        results.append({'params': params._asdict(),
+                        'ms_per_image': 1000 * config_seconds / len(images_paths),
+                        'rank1': identified / len(images_paths),
+                        'separation': separation(genuine, impostor),
+                        'minutiae': float(np.mean([len(template.minutiae) for template in config_templates]))})
+    return results, instrumentation, computed
+
+
+def format_results(results, names):
+    """
+    :return: one line per configuration, the best rank-1 rate first
+    """
+    configs = [' '.join('%s=%s' % (name, result['params'][name]) for name in names) for result in results]
+    width = max(len(config) for config in configs + [' '.join(names)])
+    lines = ['%-*s %10s %8s %8s %9s' % (width, ' '.join(names), 'ms/img', 'rank-1', "d'", 'minutiae')]
+    order = sorted(range(len(results)), key=lambda i: (-results[i]['rank1'], -np.nan_to_num(results[i]['separation'])))
+    for i in order:
+        result = results[i]
+        lines.append('%-*s %8.1fms %8.3f %8.2f %9.1f' % (width, configs[i], result['ms_per_image'], result['rank1'],
+                                                        result['separation'], result['minutiae']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default='./sample_inputs/*', help='glob pattern of the input images')
+    parser.add_argument('--grid', nargs='+', required=True, metavar='NAME=VALUE,VALUE',
+                        help='values of a parameter, one of %s' % ', '.join(PipelineParams._fields))
+    parser.add_argument('--candidates', type=int, default=10)
+    parser.add_argument('--output', default=None, help='JSON file receiving the results')
+    args = parser.parse_args()
+
+    images_paths = sorted(path for path in glob(args.input) if os.path.isfile(path))
+    names, configurations = parse_grid(args.grid)
+
+    results, instrumentation, computed = run_sweep(images_paths, configurations, args.candidates)
+
+    print(format_results(results, names))
+    runs = {stage: metrics['count'] / len(images_paths) for stage, metrics in instrumentation.summary().items()}
+    print('%d configurations, stage runs per print: %s' % (
+        len(configurations), ', '.join('%s %.1f' % (stage, count) for stage, count in runs.items())))
+    print('stages: %.1fs, %.1fs if every configuration ran alone' % (
+        computed, sum(result['ms_per_image'] for result in results) * len(images_paths) / 1000))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,72 @@
+"""
+The golden outputs, the batch and the tiled stages against the single image reference, see golden.py,
+the *_batch functions and utils.tiling
+"""
+import os
+from glob import glob
+import cv2 as cv
+import numpy as np
+import pytest
+import golden
+from finegerprint_pipline import fingerprint_features, DEFAULT_PARAMS
+from utils.frequency import ridge_freq, ridge_freq_batch
+from utils.memory import float_precision
+from utils.normalization import normalize, normalize_batch
+from utils.orientation import calculate_angles, calculate_angles_batch
+from utils.segmentation import create_segmented_and_variance_images, create_segmented_and_variance_images_batch
+
+SAMPLE_INPUTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample_inputs', '*')
+
+# two fingers
+IMAGES_PATHS = [path for path in sorted(glob(SAMPLE_INPUTS)) if os.path.basename(path).split('.')[0] in
+                ('101_1', '102_1')]
+
+DTYPES = [np.float32, np.float64]
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_golden_check(tmp_path, dtype):
+    archive = str(tmp_path / 'golden.npz')
+    with float_precision(dtype):
+        golden.record(IMAGES_PATHS, archive)
+        results = golden.check(archive)
+
+    assert len(IMAGES_PATHS) == 2
+    assert set(results) == set(stage.name for stage in golden.STAGES)
+    assert golden.failures(results) == []
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_batch_stages(dtype):
+    params = DEFAULT_PARAMS
+    ims = np.stack([cv.imread(path, 0) for path in IMAGES_PATHS])
+    with float_precision(dtype):
+        normalized = normalize_batch(ims, params.m0, params.v0)
+        segmented, norm_imgs, masks = create_segmented_and_variance_images_batch(normalized, params.block_size,
+                                                                                 params.threshold)
+        angles = calculate_angles_batch(normalized, params.block_size)
+        freqs = ridge_freq_batch(norm_imgs, masks, angles, params.block_size, params.freq_kernel_size,
+                                 params.min_wave_length, params.max_wave_length)
+
+        for i, im in enumerate(ims):
+            np.testing.assert_array_equal(normalized[i], normalize(im, params.m0, params.v0))
+            for batch, single in zip((segmented, norm_imgs, masks), create_segmented_and_variance_images(
+                    normalized[i], params.block_size, params.threshold)):
+                np.testing.assert_array_equal(batch[i], single)
+            np.testing.assert_array_equal(angles[i], calculate_angles(normalized[i], params.block_size))
+            np.testing.assert_array_equal(freqs[i], ridge_freq(
+                norm_imgs[i], masks[i], angles[i], params.block_size, params.freq_kernel_size,
+                params.min_wave_length, params.max_wave_length))
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+def test_tiled_features(dtype):
+    # upscaled, so the image is higher than the bands of every tiled filter
+    img = cv.resize(cv.imread(IMAGES_PATHS[0], 0), None, fx=2, fy=2)
+    with float_precision(dtype):
+        features = fingerprint_features(img)
+        tiled = fingerprint_features(img, tile_workers=4)
+
+    for name in ('normalized', 'segmented', 'norm_img', 'mask', 'angles', 'freq', 'gabor', 'skeleton', 'minutiae',
+                 'singularities'):
+        np.testing.assert_array_equal(getattr(tiled, name), getattr(features, name), err_msg=name)
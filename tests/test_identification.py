@@ -0,0 +1,44 @@
+"""
+1:N identification over the sample prints, see identification.py
+"""
+import os
+import numpy as np
+import pytest
+from identification import enroll, search_all
+from utils.crossing_number import MINUTIAE_DTYPE
+from utils.matching import PairIndex, identify
+from utils.template import Gallery, write_gallery
+
+SAMPLE_INPUTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sample_inputs', '*')
+
+# the sample prints identify 52 of 80 at rank 1, a change of the features or of the matcher that loses more
+# than 4 of them fails
+RANK1_FLOOR = 0.6
+
+
+@pytest.fixture(scope='module')
+def gallery(tmp_path_factory):
+    gallery_path = str(tmp_path_factory.mktemp('identification') / 'gallery.fpg')
+    enroll(SAMPLE_INPUTS, gallery_path)
+    return Gallery(gallery_path)
+
+
+def test_rank1_floor(gallery):
+    templates = list(gallery)
+    fingers = np.array([id.split('_')[0] for id in gallery.ids])
+    identified, genuine, impostor = search_all(templates, PairIndex(templates), fingers)
+    assert len(templates) == 80
+    assert identified / len(templates) >= RANK1_FLOOR
+    assert np.median(genuine) > np.median(impostor)
+
+
+def test_empty_gallery(tmp_path, gallery):
+    gallery_path = str(tmp_path / 'empty.fpg')
+    write_gallery(gallery_path, [])
+    templates = list(Gallery(gallery_path))
+    index = PairIndex(templates)
+
+    assert len(templates) == 0
+    for probe in (gallery[0], gallery[0]._replace(minutiae=np.zeros(0, MINUTIAE_DTYPE))):
+        positions, scores = identify(probe, index, templates)
+        assert len(positions) == 0 and len(scores) == 0
@@ -47,20 +47,155 @@ def minutiae_at(pixels, i, j, kernel_size):
     return "none"
 
 
-def calculate_minutiaes(im, kernel_size=3):
-    biniry_image = np.zeros_like(im)
-    biniry_image[im<10] = 1.0
-    biniry_image = biniry_image.astype(np.int8)
+# compact minutiae record, x/y in pixels, angle in radians
+MINUTIAE_DTYPE = np.dtype([('x', '<u2'), ('y', '<u2'), ('type', 'u1'), ('angle', '<f4')])
+ENDING = 1
+BIFURCATION = 2
+MINUTIAE_TYPES = {ENDING: "ending", BIFURCATION: "bifurcation"}
+
+# (column, row) offsets of the pixels on the boundary of the kernel, walked as a closed path
+RING_CELLS = {
+    3: [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)],
+    5: [(-2, -2), (-2, -1), (-2, 0), (-2, 1), (-2, 2), (-1, 2), (0, 2), (1, 2),
+        (2, 2), (2, 1), (2, 0), (2, -1), (2, -2), (1, -2), (0, -2), (-1, -2)],
+}
+
+
+def crossing_number_lut(kernel_size):
+    """
+    Crossing number of every possible boundary code. Bit k of a code is the value of the k-th
+    pixel of RING_CELLS[kernel_size].
+    :param kernel_size: 3 or 5
+    :return: uint8 array with 2**len(ring) entries
+    """
+    ring_length = len(RING_CELLS[kernel_size])
+    codes = np.arange(2 ** ring_length, dtype=np.uint32)
+    values = (codes[:, None] >> np.arange(ring_length + 1, dtype=np.uint32) % ring_length) & 1
+    crossings = np.abs(np.diff(values.astype(np.int8), axis=1)).sum(axis=1) // 2
+    return crossings.astype(np.uint8)
+
+
+def ridge_angle_lut():
+    """
+    Ridge direction of every 3x3 boundary code: the direction from the centre towards the mean of the
+    ridge pixels around it, atan2(dy, dx) in image coordinates. For an ending this is the direction of
+    the ridge leaving the minutia.
+    :return: float32 array with 256 entries
+    """
+    offsets = np.array(RING_CELLS[3], dtype=np.float64)
+    codes = np.arange(256, dtype=np.uint32)
+    values = (codes[:, None] >> np.arange(8, dtype=np.uint32)) & 1
+    dx, dy = values @ offsets[:, 0], values @ offsets[:, 1]
+    return np.arctan2(dy, dx).astype(np.float32)
+
+
+CROSSING_NUMBER_LUTS = {kernel_size: crossing_number_lut(kernel_size) for kernel_size in RING_CELLS}
+RIDGE_ANGLE_LUT = ridge_angle_lut()
+
+
+def ring_codes(binary_image, kernel_size, rows, cols):
+    """
+    Boundary code of every pixel in rows x cols. Offsets falling before the first row or column wrap
+    around, like negative indices did in minutiae_at.
+    :return: uint8 codes for the 3x3 ring, uint16 for the 5x5 one
+    """
+    pad = kernel_size // 2
+    dtype = np.uint8 if len(RING_CELLS[kernel_size]) <= 8 else np.uint16
+    padded = np.pad(binary_image, pad, mode='wrap').astype(dtype)
+    codes = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype)
+    for bit, (k, l) in enumerate(RING_CELLS[kernel_size]):
+        codes |= padded[rows.start + l + pad:rows.stop + l + pad, cols.start + k + pad:cols.stop + k + pad] << bit
+    return codes
+
+
+def extract_minutiae(im, kernel_size=3):
+    """
+    Crossing number minutiae without visiting pixels in python: every 3x3 (or 5x5) boundary is turned
+    into a code and classified through CROSSING_NUMBER_LUTS, see minutiae_at for the definition.
+    :param im: skeleton image, ridges are the dark pixels
+    :param kernel_size: 3 or 5
+    :return: MINUTIAE_DTYPE array ordered by x then y
+    """
+    biniry_image = (im < 10).astype(np.uint8)
 
     (y, x) = im.shape
+    rows, cols = slice(1, y - kernel_size//2), slice(1, x - kernel_size//2)
+    codes = ring_codes(biniry_image, kernel_size, rows, cols)
+    crossings = CROSSING_NUMBER_LUTS[kernel_size][codes]
+    center = biniry_image[rows, cols] == 1
+
+    types = np.zeros(crossings.shape, np.uint8)
+    types[center & (crossings == 1)] = ENDING
+    types[center & (crossings == 3)] = BIFURCATION
+
+    # transposed so the minutiae come out column by column, the order they were drawn in
+    xs, ys = np.nonzero(types.T)
+    xs = xs + cols.start; ys = ys + rows.start
+
+    minutiae = np.zeros(len(xs), MINUTIAE_DTYPE)
+    minutiae['x'] = xs
+    minutiae['y'] = ys
+    minutiae['type'] = types[ys - rows.start, xs - cols.start]
+    ring = codes if kernel_size == 3 else ring_codes(biniry_image, 3, rows, cols)
+    minutiae['angle'] = RIDGE_ANGLE_LUT[ring[ys - rows.start, xs - cols.start]]
+
+    return minutiae
+
+
+def refine_ridge_angles(im, minutiae, radius=5):
+    """
+    The 3x3 lookup table only knows 8 directions. This replaces the angle of every minutia by the direction
+    from the minutia towards the mean of the ridge pixels connected to it within a (2*radius + 1) window,
+    which follows the ridge over a few pixels. All windows are grown from their centre at once.
+    :param im: skeleton image, ridges are the dark pixels
+    :param minutiae: MINUTIAE_DTYPE array
+    :param radius: half size of the window, should stay below the ridge spacing
+    :return: copy of minutiae with refined angles
+    """
+    minutiae = minutiae.copy()
+    if len(minutiae) == 0:
+        return minutiae
+
+    size = 2*radius + 1
+    padded = np.pad(im < 10, radius)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (size, size))[minutiae['y'], minutiae['x']]
+
+    # grow the ridge connected to the centre one pixel per step, 8-connected
+    reached = np.zeros_like(windows)
+    reached[:, radius, radius] = True
+    for _ in range(2*radius):
+        grown = np.pad(reached, ((0, 0), (1, 1), (1, 1)))
+        grown = np.max([grown[:, 1 + dy:size + 1 + dy, 1 + dx:size + 1 + dx]
+                        for dy in (-1, 0, 1) for dx in (-1, 0, 1)], axis=0)
+        reached = grown & windows
+    reached[:, radius, radius] = False
+
+    offsets = np.arange(-radius, radius + 1)
+    dx = (reached * offsets[None, None, :]).sum(axis=(1, 2))
+    dy = (reached * offsets[None, :, None]).sum(axis=(1, 2))
+    minutiae['angle'] = np.arctan2(dy, dx)
+    return minutiae
+
+
+def minutiae_inside_mask(minutiae, mask, margin):
+    """
+    Drops the minutiae closer than margin pixels to the border of the mask. Ridges are cut off along the
+    border of the segmented area, so most endings found there are not real minutiae.
+    """
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*margin + 1, 2*margin + 1))
+    inner_mask = cv.erode(mask.astype(np.uint8), kernel, borderType=cv.BORDER_CONSTANT, borderValue=0)
+    return minutiae[inner_mask[minutiae['y'], minutiae['x']] > 0]
+
+
+def draw_minutiae(im, minutiae):
     result = cv.cvtColor(im, cv.COLOR_GRAY2RGB)
-    colors = {"ending" : (150, 0, 0), "bifurcation" : (0, 150, 0)}
+    colors = {ENDING : (150, 0, 0), BIFURCATION : (0, 150, 0)}
 
-    # iterate each pixel minutia
-    for i in range(1, x - kernel_size//2):
-        for j in range(1, y - kernel_size//2):
-            minutiae = minutiae_at(biniry_image, j, i, kernel_size)
-            if minutiae != "none":
-                cv.circle(result, (i,j), radius=2, color=colors[minutiae], thickness=2)
+    for minutia in minutiae:
+        cv.circle(result, (int(minutia['x']), int(minutia['y'])), radius=2, color=colors[minutia['type']], thickness=2)
 
     return result
+
+
+def calculate_minutiaes(im, kernel_size=3):
+    return draw_minutiae(im, extract_minutiae(im, kernel_size))
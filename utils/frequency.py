@@ -1,6 +1,8 @@
 import numpy as np
 import math
 import scipy.ndimage
+import scipy.special
+from utils.memory import float_dtype, chunk_length, BATCH_MEMORY_BUDGET
 
 
 def frequest(im, orientim, kernel_size, minWaveLength, maxWaveLength):
@@ -49,26 +51,154 @@ def frequest(im, orientim, kernel_size, minWaveLength, maxWaveLength):
     return(freq_block)
 
 
-def ridge_freq(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength):
-    # Function to estimate the fingerprint ridge frequency across a
-    # fingerprint image.
-    rows,cols = im.shape
-    freq = np.zeros((rows,cols))
-
-    for row in range(0, rows - block_size, block_size):
-        for col in range(0, cols - block_size, block_size):
-            image_block = im[row:row + block_size][:, col:col + block_size]
-            angle_block = orient[row // block_size][col // block_size]
-            if angle_block:
-                freq[row:row + block_size][:, col:col + block_size] = frequest(image_block, angle_block, kernel_size,
-                                                                               minWaveLength, maxWaveLength)
-
-    freq = freq*mask
-    freq_1d = np.reshape(freq,(1,rows*cols))
-    ind = np.where(freq_1d>0)
-    ind = np.array(ind)
-    ind = ind[1,:]
-    non_zero_elems_in_freq = freq_1d[0][ind]
-    medianfreq = np.median(non_zero_elems_in_freq) * mask
+def frequest_batch(blocks, orients, kernel_size, minWaveLength, maxWaveLength):
+    """
+    Vectorized frequest over a stack of blocks: all the blocks are rotated with a single spline
+    interpolation of the whole stack, then projected and searched for peaks together.
+    Interpolating the (N, rows, cols) stack at integer block indices gives the same values as rotating
+    every block on its own, so the result matches frequest block by block up to round off.
+    The rotated blocks are in float_dtype(), the coordinates and the frequencies in float64.
+    :param blocks: (N, rows, cols) image blocks
+    :param orients: (N,) block orientations
+    :return: (N,) ridge frequency of every block, 0 where none was found
+    """
+    count, rows, cols = blocks.shape
+    if count == 0:
+        return np.zeros(0)
+    dtype = float_dtype()
+
+    # mean orientation of the block and the rotation that makes its ridges vertical
+    block_orient = np.arctan2(np.sin(2*orients), np.cos(2*orients))/2
+    angle = block_orient/np.pi*180 + 90
+    c, s = scipy.special.cosdg(angle), scipy.special.sindg(angle)
+
+    # same affine mapping as scipy.ndimage.rotate, only evaluated on the crop without invalid regions
+    cropsze = int(np.fix(rows/np.sqrt(2)))
+    offset = int(np.fix((rows-cropsze)/2))
+    center = (rows - 1) / 2
+    out_row, out_col = np.meshgrid(np.arange(offset, offset + cropsze), np.arange(offset, offset + cropsze),
+                                   indexing='ij')
+    out_row, out_col = out_row - center, out_col - center
+    in_row = c[:, None, None]*out_row + s[:, None, None]*out_col + center
+    in_col = -s[:, None, None]*out_row + c[:, None, None]*out_col + center
+    index = np.broadcast_to(np.arange(count, dtype=np.float64)[:, None, None], in_row.shape)
+    rotim = scipy.ndimage.map_coordinates(blocks.astype(dtype), [index, in_row, in_col], output=dtype, order=3,
+                                          mode='nearest')
+
+    # Sum down the columns to get a projection of the grey values down the ridges.
+    ridge_sum = np.sum(rotim, axis=1)
+    dilation = scipy.ndimage.grey_dilation(ridge_sum, structure=np.ones((1, kernel_size)))
+    ridge_noise = np.abs(dilation - ridge_sum); peak_thresh = 2
+    maxpts = (ridge_noise < peak_thresh) & (ridge_sum > np.mean(ridge_sum, axis=1, keepdims=True))
+
+    # wavelength is the distance between the first and last peaks divided by (No of peaks-1)
+    no_of_peaks = maxpts.sum(axis=1)
+    first_peak = np.argmax(maxpts, axis=1)
+    last_peak = cropsze - 1 - np.argmax(maxpts[:, ::-1], axis=1)
+    waveLength = (last_peak - first_peak) / np.maximum(no_of_peaks - 1, 1)
+
+    valid = (no_of_peaks >= 2) & (waveLength >= minWaveLength) & (waveLength <= maxWaveLength)
+    freq = np.zeros(count)
+    freq[valid] = 1/np.double(waveLength[valid])
+    return freq
+
+
+def frequest_batch_bytes(block_size):
+    """
+    :return: approximate scratch bytes frequest_batch needs per block: map_coordinates pads the block by 12
+    pixels on every side and computes its float64 spline coefficients, and the float64 coordinates are
+    stacked into one more array
+    """
+    cropsze = int(np.fix(block_size/np.sqrt(2)))
+    return 2*8*(block_size + 24)**2 + 6*8*cropsze**2
+
+
+def ridge_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength, memory_budget=None):
+    """
+    Ridge frequency of every block. Only blocks with a non zero orientation that overlap the mask are
+    estimated and all of them are gathered into stacks for frequest_batch.
+    :param im: 2d image, or a (N, H, W) stack of images whose blocks are all gathered together
+    :param memory_budget: bytes of scratch memory for one frequest_batch call, the blocks are estimated in
+    as many stacks as needed
+    :return: (rows // block_size, cols // block_size) array per image, 0 where no frequency was estimated
+    """
+    rows, cols = im.shape[-2:]
+    lead = im.shape[:-2]
+    block_rows, block_cols = len(range(0, rows - block_size, block_size)), len(range(0, cols - block_size, block_size))
 
+    blocks = im[..., :block_rows*block_size, :block_cols*block_size]
+    blocks = blocks.reshape(lead + (block_rows, block_size, block_cols, block_size)).swapaxes(-3, -2)
+    block_mask = mask[..., :block_rows*block_size, :block_cols*block_size]
+    block_mask = block_mask.reshape(lead + (block_rows, block_size, block_cols, block_size)).any(axis=(-3, -1))
+    block_orient = np.asarray(orient)[..., :block_rows, :block_cols]
+
+    selected = np.nonzero((block_orient != 0) & block_mask)
+    freq = np.zeros(lead + (rows // block_size, cols // block_size))
+    chunk = chunk_length(memory_budget, frequest_batch_bytes(block_size), len(selected[0]))
+    for start in range(0, len(selected[0]), chunk):
+        index = tuple(selected_axis[start:start + chunk] for selected_axis in selected)
+        freq[index] = frequest_batch(blocks[index], block_orient[index], kernel_size, minWaveLength, maxWaveLength)
+    return freq
+
+
+def median_frequency(mask, freq_map, block_size):
+    """
+    The median is taken over the block map, every block weighted by its number of mask pixels, which is the
+    median of the per pixel frequency image without building it.
+    :return: median frequency of the masked blocks times the mask, in float_dtype()
+    """
+    # mask pixels of every block of the map
+    covered = np.asarray(mask[:freq_map.shape[0]*block_size, :freq_map.shape[1]*block_size] > 0)
+    weights = covered.reshape(freq_map.shape[0], block_size, freq_map.shape[1], block_size).sum(axis=(1, 3))
+
+    valid = (freq_map > 0) & (weights > 0)
+    values, weights = freq_map[valid], weights[valid]
+    order = np.argsort(values, kind='stable')
+    values, ends = values[order], np.cumsum(weights[order])
+    count = ends[-1] if len(ends) else 0
+    if count:
+        # the two middle pixels of the sorted frequencies, the same one when count is odd
+        middle = values[np.searchsorted(ends, [(count - 1) // 2, count // 2], side='right')]
+        median = middle[0] if count % 2 else np.mean(middle)
+    else:
+        median = np.nan
+    return np.multiply(mask, median, dtype=float_dtype())
+
+
+def ridge_freq(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength, return_map=False,
+               memory_budget=None):
+    """
+    Function to estimate the fingerprint ridge frequency across a fingerprint image.
+    :param return_map: also return the per block frequency map from ridge_freq_map
+    :param memory_budget: see ridge_freq_map
+    :return: median frequency of the masked blocks times the mask, in float_dtype(), see median_frequency,
+    and the block map if return_map is set
+    """
+    freq_map = ridge_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength,
+                              memory_budget)
+    medianfreq = median_frequency(mask, freq_map, block_size)
+
+    if return_map:
+        return medianfreq, freq_map
     return medianfreq
+
+
+def ridge_freq_batch(ims, masks, orients, block_size, kernel_size, minWaveLength, maxWaveLength, return_map=False,
+                     memory_budget=BATCH_MEMORY_BUDGET):
+    """
+    ridge_freq over a (N, H, W) stack of images of the same shape: the blocks of all the images are
+    estimated together in the frequest_batch stacks, then every image takes its own median.
+    :param masks: (N, H, W) masks
+    :param orients: (N, rows, cols) block orientations
+    :param memory_budget: see ridge_freq_map, None for a single frequest_batch call over all the blocks
+    :return: (N, H, W) frequency images, and the (N, rows, cols) block maps if return_map is set
+    """
+    freq_maps = ridge_freq_map(np.asarray(ims), np.asarray(masks), orients, block_size, kernel_size,
+                               minWaveLength, maxWaveLength, memory_budget)
+    medianfreqs = np.stack([median_frequency(mask, freq_map, block_size)
+                            for mask, freq_map in zip(masks, freq_maps)]) if len(freq_maps) else \
+        np.zeros(np.shape(ims), float_dtype())
+
+    if return_map:
+        return medianfreqs, freq_maps
+    return medianfreqs
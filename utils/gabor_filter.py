@@ -9,43 +9,33 @@ the base filters in the direction and local frequency from the two directional a
 https://airccj.org/CSCP/vol7/csit76809.pdf pg.91
 """
 
+import threading
+from collections import OrderedDict
 import numpy as np
 import scipy
-def gabor_filter(im, orient, freq, kx=0.65, ky=0.65):
+import cv2 as cv
+from utils.memory import float_dtype, chunk_length
+from utils.tiling import row_tiles
+
+
+def create_filter_bank(frequency, kx, ky, angleInc):
     """
-    Gabor filter is a linear filter used for edge detection. Gabor filter can be viewed as a sinusoidal plane of
-    particular frequency and orientation, modulated by a Gaussian envelope.
-    :param im:
-    :param orient:
-    :param freq:
+    Reference gabor filter for a single ridge frequency and its rotations in 'angleInc' increments.
+    :param frequency: ridge frequency rounded to the nearest 0.01
     :param kx:
     :param ky:
-    :return:
+    :param angleInc: angle increment between two filters in degrees
+    :return: (180//angleInc, 2*radius + 1, 2*radius + 1) array of filters
     """
-    angleInc = 3
-    im = np.double(im)
-    rows, cols = im.shape
-    return_img = np.zeros((rows,cols))
-
-    # Round the array of frequencies to the nearest 0.01 to reduce the
-    # number of distinct frequencies we have to deal with.
-    freq_1d = freq.flatten()
-    frequency_ind = np.array(np.where(freq_1d>0))
-    non_zero_elems_in_freq = freq_1d[frequency_ind]
-    non_zero_elems_in_freq = np.double(np.round((non_zero_elems_in_freq*100)))/100
-    unfreq = np.unique(non_zero_elems_in_freq)
-
-    # Generate filters corresponding to these distinct frequencies and
-    # orientations in 'angleInc' increments.
-    sigma_x = 1/unfreq*kx
-    sigma_y = 1/unfreq*ky
+    sigma_x = 1/frequency*kx
+    sigma_y = 1/frequency*ky
     block_size = np.round(3*np.max([sigma_x,sigma_y]))
     block_size = int(block_size)
     array = np.linspace(-block_size,block_size,(2*block_size + 1))
     x, y = np.meshgrid(array, array)
 
     # gabor filter equation
-    reffilter = np.exp(-(((np.power(x,2))/(sigma_x*sigma_x) + (np.power(y,2))/(sigma_y*sigma_y)))) * np.cos(2*np.pi*unfreq[0]*x)
+    reffilter = np.exp(-(((np.power(x,2))/(sigma_x*sigma_x) + (np.power(y,2))/(sigma_y*sigma_y)))) * np.cos(2*np.pi*frequency*x)
     filt_rows, filt_cols = reffilter.shape
     gabor_filter = np.array(np.zeros((180//angleInc, filt_rows, filt_cols)))
 
@@ -54,27 +44,183 @@ def gabor_filter(im, orient, freq, kx=0.65, ky=0.65):
         rot_filt = scipy.ndimage.rotate(reffilter,-(degree*angleInc + 90),reshape = False)
         gabor_filter[degree] = rot_filt
 
+    return gabor_filter
+
+
+class FilterBankCache:
+    """
+    Bounded LRU cache of gabor filter banks keyed by (rounded frequency, kx, ky, angleInc).
+    The banks can be saved to a .npz archive (one .npy entry per bank) and loaded back by worker
+    processes at startup so that no worker has to regenerate the rotated kernels.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._banks = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(frequency, kx, ky, angleInc):
+        return (round(float(frequency), 2), float(kx), float(ky), int(angleInc))
+
+    def get(self, frequency, kx, ky, angleInc):
+        key = self.key(frequency, kx, ky, angleInc)
+        with self._lock:
+            bank = self._banks.get(key)
+            if bank is not None:
+                self._banks.move_to_end(key)
+                self.hits += 1
+                return bank
+            self.misses += 1
+
+        bank = create_filter_bank(key[0], kx, ky, angleInc)
+        self.put(key, bank)
+        return bank
+
+    def put(self, key, bank):
+        with self._lock:
+            self._banks[key] = bank
+            self._banks.move_to_end(key)
+            while len(self._banks) > self.maxsize:
+                self._banks.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._banks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._banks), "maxsize": self.maxsize}
+
+    def save(self, path):
+        """
+        :param path: .npz archive, 'keys' holds one (frequency, kx, ky, angleInc) row per bank
+        """
+        with self._lock:
+            keys = list(self._banks)
+            banks = {'bank_%d' % i: self._banks[key] for i, key in enumerate(keys)}
+        np.savez(path, keys=np.array(keys, dtype=np.float64).reshape(-1, 4), **banks)
+
+    def load(self, path):
+        with np.load(path) as archive:
+            for i, key in enumerate(archive['keys']):
+                self.put(self.key(*key), archive['bank_%d' % i])
+
+
+# shared by every gabor_filter call in the process
+filter_bank_cache = FilterBankCache()
+
+
+def load_filter_banks(path):
+    """
+    Preload the process wide filter bank cache, e.g. as a multiprocessing Pool initializer.
+    """
+    filter_bank_cache.load(path)
+
+
+def filter_radius(frequency, kx, ky):
+    """
+    :return: radius in pixels of the filters create_filter_bank makes for a rounded frequency
+    """
+    return int(np.round(3*max(1/frequency*kx, 1/frequency*ky)))
+
+
+def gabor_filter(im, orient, freq, kx=0.65, ky=0.65, cache=None, memory_budget=None, W=16, angleInc=3,
+                 executor=None):
+    """
+    Gabor filter is a linear filter used for edge detection. Gabor filter can be viewed as a sinusoidal plane of
+    particular frequency and orientation, modulated by a Gaussian envelope.
+    The image and the filters are in float_dtype(). Only the sign of the response is kept, so no image
+    sized response is ever allocated.
+    :param im:
+    :param orient:
+    :param freq:
+    :param kx:
+    :param ky:
+    :param cache: FilterBankCache, defaults to the process wide filter_bank_cache
+    :param memory_budget: bytes of filter response held at once, every orientation is filtered in bands of
+    rows that fit in it
+    :param W: block size of the orientation grid
+    :param angleInc: angle increment between two filters in degrees
+    :param executor: thread pool filtering the orientations and their bands concurrently, see utils.tiling.
+    Every band is convolved with the filter radius around it and only the pixels of its orientation in it
+    are written, so the tiles are disjoint and the result does not depend on them.
+    :return:
+    """
+    dtype = float_dtype()
+    im = np.asarray(im, dtype)
+    rows, cols = im.shape
+    gabor_img = np.full((rows, cols), 255, np.uint8)
+    cache = filter_bank_cache if cache is None else cache
+
+    # Round the array of frequencies to the nearest 0.01 to reduce the
+    # number of distinct frequencies we have to deal with, the filters of the lowest one are used.
+    positive = freq > 0
+    if not positive.any():
+        return gabor_img
+    lowest = float(np.min(freq, where=positive, initial=np.inf))
+
+    # Generate filters corresponding to these distinct frequencies and
+    # orientations in 'angleInc' increments.
+    gabor_filter = cache.get(np.round(lowest*100)/100, kx, ky, angleInc).astype(dtype, copy=False)
+    block_size = gabor_filter.shape[1] // 2
+
     # Convert orientation matrix values from radians to an index value that corresponds to round(degrees/angleInc)
     maxorientindex = np.round(180/angleInc)
     orientindex = np.round(orient/np.pi*180/angleInc)
-    for i in range(0,rows//16):
-        for j in range(0,cols//16):
-            if(orientindex[i][j] < 1):
-                orientindex[i][j] = orientindex[i][j] + maxorientindex
-            if(orientindex[i][j] > maxorientindex):
-                orientindex[i][j] = orientindex[i][j] - maxorientindex
-
-    # Find indices of matrix points greater than maxsze from the image boundary
-    block_size = int(block_size)
-    valid_row, valid_col = np.where(freq>0)
-    finalind = \
-        np.where((valid_row>block_size) & (valid_row<rows - block_size) & (valid_col>block_size) & (valid_col<cols - block_size))
+    wrapped = orientindex[:rows//W, :cols//W]
+    wrapped[wrapped < 1] += maxorientindex
+    wrapped[wrapped > maxorientindex] -= maxorientindex
+    filter_index = orientindex.astype(int) - 1
+
+    # Only filter the points greater than maxsze from the image boundary
+    positive[:block_size + 1] = False
+    positive[max(rows - block_size, 0):] = False
+    positive[:, :block_size + 1] = False
+    positive[:, max(cols - block_size, 0):] = False
+
+    # blocks of the orientation grid holding pixels to filter
+    grid_rows, grid_cols = filter_index.shape
+    occupied = np.zeros((grid_rows*W, grid_cols*W), bool)
+    occupied[:min(rows, grid_rows*W), :min(cols, grid_cols*W)] = positive[:grid_rows*W, :grid_cols*W]
+    occupied = occupied.reshape(grid_rows, W, grid_cols, W).any(axis=(1, 3))
+
+    # filter the image once per orientation that is actually used and keep the sign of the response of the
+    # pixels using it
+    bands = []
+    for index in np.unique(filter_index[occupied]):
+        uses_filter = filter_index == index
+        block_rows, block_cols = np.nonzero(occupied & uses_filter)
+        top, bottom = block_rows.min()*W, min(rows, (block_rows.max() + 1)*W)
+        left, right = block_cols.min()*W, min(cols, (block_cols.max() + 1)*W)
+
+        # bands of rows, each one convolved with the filter radius around it
+        row_bytes = (min(right + block_size, cols) - max(left - block_size, 0)) * dtype.itemsize
+        band = chunk_length(memory_budget and max(memory_budget - 2*block_size*row_bytes, 0), row_bytes,
+                            bottom - top)
+        bands += [(index, uses_filter, band_top, band_bottom, left, right)
+                  for band_top, band_bottom in row_tiles(bottom, band, start=top)]
+
+    def filter_band(band):
+        (index, uses_filter, band_top, band_bottom, left, right) = band
+        crop_left, crop_right = max(left - block_size, 0), min(right + block_size, cols)
+        crop_top, crop_bottom = max(band_top - block_size, 0), min(band_bottom + block_size, rows)
+        response = cv.filter2D(im[crop_top:crop_bottom, crop_left:crop_right], -1, gabor_filter[index],
+                               borderType=cv.BORDER_CONSTANT)
+        response = response[band_top - crop_top:band_bottom - crop_top, left - crop_left:right - crop_left]
 
-    for k in range(0, np.shape(finalind)[1]):
-        r = valid_row[finalind[0][k]]; c = valid_col[finalind[0][k]]
-        img_block = im[r-block_size:r+block_size + 1][:,c-block_size:c+block_size + 1]
-        return_img[r][c] = np.sum(img_block * gabor_filter[int(orientindex[r//16][c//16]) - 1])
+        # the bands of an orientation are disjoint and so are the pixels of two orientations
+        selected = positive[band_top:band_bottom, left:right] & \
+            uses_filter[np.arange(band_top, band_bottom)[:, None]//W, np.arange(left, right)[None, :]//W]
+        gabor_img[band_top:band_bottom, left:right][selected & (response < 0)] = 0
 
-    gabor_img = 255 - np.array((return_img < 0)*255).astype(np.uint8)
+    if executor is None:
+        for band in bands:
+            filter_band(band)
+    else:
+        list(executor.map(filter_band, bands))
 
     return gabor_img
@@ -0,0 +1,158 @@
+"""
+Per stage instrumentation of the pipeline. Every stage call goes through Instrumentation.call, which
+records the wall time, the CPU time, the peak number of bytes allocated while the stage ran and the
+shape, dtype and size of the arrays it returned. Records are handed to registered callbacks, e.g. a
+JsonLinesWriter, and can be summarized as percentiles over a batch.
+
+Peak memory comes from tracemalloc, which sees every numpy allocation (including the arrays OpenCV
+returns) but not the scratch buffers OpenCV allocates internally.
+
+When instrumentation is off the pipeline uses NULL_INSTRUMENTATION, whose call is a plain function
+call, so the overhead is a single method dispatch per stage.
+"""
+import json
+import time
+import tracemalloc
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+METRICS = ('wall', 'cpu', 'peak_bytes')
+
+
+def describe_outputs(outputs):
+    if not isinstance(outputs, tuple):
+        outputs = (outputs,)
+    return [{'shape': list(output.shape), 'dtype': str(output.dtype), 'nbytes': output.nbytes}
+            for output in outputs if isinstance(output, np.ndarray)]
+
+
+class NullInstrumentation:
+    enabled = False
+    image = None
+
+    def call(self, stage, function, *args, **kwargs):
+        return function(*args, **kwargs)
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class Instrumentation:
+
+    enabled = True
+
+    def __init__(self, callbacks=(), trace_memory=True):
+        """
+        :param callbacks: functions called with every record
+        :param trace_memory: measure peak allocated bytes with tracemalloc, it slows numpy allocations down
+        """
+        self.callbacks = list(callbacks)
+        self.trace_memory = trace_memory
+        self.records = []
+        # name of the image being processed, added to every record
+        self.image = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def call(self, stage, function, *args, **kwargs):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # python < 3.9: dropping the traces resets the peak, the stage is then counted from 0 bytes
+                tracemalloc.clear_traces()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        outputs = function(*args, **kwargs)
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes if self.trace_memory else None
+        self.add({'image': self.image, 'stage': stage, 'wall': wall, 'cpu': cpu, 'peak_bytes': peak_bytes,
+                  'outputs': describe_outputs(outputs)})
+        return outputs
+
+    def add(self, record):
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def extend(self, records):
+        """
+        Adds the records collected by another Instrumentation, e.g. in a worker process.
+        """
+        for record in records:
+            self.add(record)
+
+    def summary(self):
+        """
+        :return: {stage: {metric: {'p50': .., 'p90': .., 'p99': .., 'mean': .., 'max': ..}, 'count': n}}
+        in the order the stages first ran
+        """
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record['stage'], []).append(record)
+
+        summary = {}
+        for stage, records in stages.items():
+            summary[stage] = {'count': len(records)}
+            for metric in METRICS:
+                values = np.array([record[metric] for record in records if record[metric] is not None], np.float64)
+                if len(values) == 0:
+                    continue
+                summary[stage][metric] = dict({'p%d' % p: float(np.percentile(values, p)) for p in PERCENTILES},
+                                              mean=float(values.mean()), max=float(values.max()))
+        return summary
+
+    def format_summary(self):
+        lines = ['%-14s %6s %10s %10s %10s %10s %12s' % ('stage', 'count', 'wall p50', 'wall p90', 'wall p99',
+                                                         'cpu p50', 'peak MB p99')]
+        for stage, metrics in self.summary().items():
+            wall, cpu, peak = metrics['wall'], metrics['cpu'], metrics.get('peak_bytes')
+            lines.append('%-14s %6d %9.1fms %9.1fms %9.1fms %9.1fms %12s' % (
+                stage, metrics['count'], 1000 * wall['p50'], 1000 * wall['p90'], 1000 * wall['p99'],
+                1000 * cpu['p50'], '%.2f' % (peak['p99'] / 2**20) if peak else '-'))
+        return '\n'.join(lines)
+
+    def format_memory_report(self):
+        """
+        Where peak memory goes: for every stage the median and largest peak, the image it was reached on,
+        the bytes of the arrays the stage returned and its largest peak relative to the largest of all stages.
+        """
+        stages = {}
+        for record in self.records:
+            if record['peak_bytes'] is not None:
+                stages.setdefault(record['stage'], []).append(record)
+        if not stages:
+            return 'no memory records, trace_memory is off'
+
+        largest = max(record['peak_bytes'] for records in stages.values() for record in records)
+        lines = ['%-14s %12s %12s %12s %8s  %s' % ('stage', 'peak MB p50', 'peak MB max', 'output MB', 'share',
+                                                   'largest on')]
+        for stage, records in stages.items():
+            peaks = np.array([record['peak_bytes'] for record in records], np.float64)
+            worst = records[int(np.argmax(peaks))]
+            output_bytes = sum(output.get('nbytes', 0) for output in worst['outputs'])
+            lines.append('%-14s %12.2f %12.2f %12.2f %7.0f%%  %s' % (
+                stage, np.percentile(peaks, 50) / 2**20, peaks.max() / 2**20, output_bytes / 2**20,
+                100 * peaks.max() / max(largest, 1), worst['image']))
+        return '\n'.join(lines)
+
+
+class JsonLinesWriter:
+    """
+    Callback appending every record to a JSON-lines file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def __call__(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
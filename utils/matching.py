@@ -0,0 +1,208 @@
+"""
+1:N identification over minutiae templates.
+
+Every template is described by pairs of neighbouring minutiae. A pair is invariant to rotation and
+translation once it is expressed as its length and the angles of both minutiae relative to the line
+that joins them, so pairs are hashed on those three values (and the two minutiae types) into one
+sorted index for the whole gallery.
+
+A search looks up every probe pair in the index. Each hit is a correspondence between a probe pair and
+a gallery pair and it fixes a rotation and a translation; hits are voted into (template, rotation,
+translation) bins and the templates with the strongest bins become the candidates. Only the candidates
+are scored: the probe is aligned with the best transforms of the candidate and the minutiae that
+fall on each other (position and angle) are counted.
+"""
+import numpy as np
+import scipy.spatial
+from utils.crossing_number import MINUTIAE_DTYPE
+
+PAIR_NEIGHBOURS = 6
+DISTANCE_STEP = 8
+ANGLE_BINS = 8
+
+ROTATION_STEP = np.radians(10)
+TRANSLATION_STEP = 10
+
+MATCH_RADIUS = 10
+MATCH_ANGLE = np.pi/4
+
+
+def wrap_angles(angles):
+    return np.mod(angles + np.pi, 2*np.pi) - np.pi
+
+
+def minutiae_pairs(minutiae, neighbours=PAIR_NEIGHBOURS):
+    """
+    Pairs every minutia with its nearest neighbours.
+    :param minutiae: MINUTIAE_DTYPE array
+    :return: (keys, origins, directions), the hash of every pair, the position of its first minutia and
+    the direction of the line from the first to the second minutia
+    """
+    n = len(minutiae)
+    k = min(neighbours, n - 1)
+    if k < 1:
+        return np.zeros(0, np.int64), np.zeros((0, 2)), np.zeros(0)
+
+    xy = np.stack([minutiae['x'], minutiae['y']], axis=1).astype(np.float64)
+    distances = np.linalg.norm(xy[:, None] - xy[None], axis=2)
+    np.fill_diagonal(distances, np.inf)
+
+    first = np.repeat(np.arange(n), k)
+    second = np.argpartition(distances, k - 1, axis=1)[:, :k].ravel()
+
+    vector = xy[second] - xy[first]
+    directions = np.arctan2(vector[:, 1], vector[:, 0])
+    length = (distances[first, second] // DISTANCE_STEP).astype(np.int64)
+
+    def angle_bin(angles):
+        return np.floor((wrap_angles(angles) + np.pi) / (2*np.pi) * ANGLE_BINS).astype(np.int64) % ANGLE_BINS
+
+    first_angle = angle_bin(minutiae['angle'][first] - directions)
+    second_angle = angle_bin(minutiae['angle'][second] - directions)
+    types = minutiae['type'][first].astype(np.int64) * 4 + minutiae['type'][second]
+
+    keys = ((length * ANGLE_BINS + first_angle) * ANGLE_BINS + second_angle) * 16 + types
+    return keys, xy[first], directions
+
+
+class PairIndex:
+    """
+    Minutiae pairs of a whole gallery sorted by their hash, with the template each one comes from.
+    """
+
+    def __init__(self, templates):
+        # the pairs of no minutiae, so an empty gallery gives an empty index
+        keys, origins, directions = ([pairs] for pairs in minutiae_pairs(np.zeros(0, MINUTIAE_DTYPE)))
+        owners = [np.zeros(0, np.int64)]
+        for i, template in enumerate(templates):
+            pair_keys, pair_origins, pair_directions = minutiae_pairs(template.minutiae)
+            keys.append(pair_keys)
+            owners.append(np.full(len(pair_keys), i, np.int64))
+            origins.append(pair_origins)
+            directions.append(pair_directions)
+
+        keys = np.concatenate(keys)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.owners = np.concatenate(owners)[order]
+        self.origins = np.concatenate(origins)[order]
+        self.directions = np.concatenate(directions)[order]
+        self.size = len(templates)
+
+    def lookup(self, keys):
+        """
+        :return: (query, entry) index arrays, one element per index entry sharing a key with a query
+        """
+        low = np.searchsorted(self.keys, keys, 'left')
+        counts = np.searchsorted(self.keys, keys, 'right') - low
+        query = np.repeat(np.arange(len(keys)), counts)
+        starts = np.cumsum(counts) - counts
+        entry = np.repeat(low, counts) + np.arange(counts.sum()) - np.repeat(starts, counts)
+        return query, entry
+
+
+def alignment_votes(probe, index):
+    """
+    Votes every pair correspondence between the probe and the gallery into a (template, rotation,
+    translation) bin.
+    :return: (bins, rotation, tx, ty, owner) one bin id and transform per correspondence, bins are
+    comparable across templates
+    """
+    keys, origins, directions = minutiae_pairs(probe.minutiae)
+    query, entry = index.lookup(keys)
+
+    rotation = wrap_angles(index.directions[entry] - directions[query])
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    px, py = origins[query, 0], origins[query, 1]
+    tx = index.origins[entry, 0] - (cos*px - sin*py)
+    ty = index.origins[entry, 1] - (sin*px + cos*py)
+
+    rotation_bin = np.floor(rotation / ROTATION_STEP).astype(np.int64) + 64
+    tx_bin = np.clip(np.floor(tx / TRANSLATION_STEP).astype(np.int64) + 512, 0, 1023)
+    ty_bin = np.clip(np.floor(ty / TRANSLATION_STEP).astype(np.int64) + 512, 0, 1023)
+    owner = index.owners[entry]
+    bins = ((owner * 128 + rotation_bin) * 1024 + tx_bin) * 1024 + ty_bin
+
+    return bins, rotation, tx, ty, owner
+
+
+def match_score(probe, template, rotation, tx, ty):
+    """
+    Aligns the probe minutiae with the template and counts the minutiae that fall on each other.
+    :return: matched^2 / (probe minutiae * template minutiae), between 0 and 1
+    """
+    p, g = probe.minutiae, template.minutiae
+    if len(p) == 0 or len(g) == 0:
+        return 0.0
+
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    px, py = p['x'].astype(np.float64), p['y'].astype(np.float64)
+    x = cos*px - sin*py + tx
+    y = sin*px + cos*py + ty
+
+    distance = np.hypot(x[:, None] - g['x'][None, :], y[:, None] - g['y'][None, :])
+    angle = np.abs(wrap_angles(g['angle'][None, :] - p['angle'][:, None] - rotation))
+    same_type = p['type'][:, None] == g['type'][None, :]
+    paired = (distance < MATCH_RADIUS) & (angle < MATCH_ANGLE) & same_type
+
+    matched = min(paired.any(axis=1).sum(), paired.any(axis=0).sum())
+    return matched**2 / (len(p) * len(g))
+
+
+def minutiae_agreement(found, reference, radius=MATCH_RADIUS):
+    """
+    Agreement of two minutiae sets of the same image, no alignment: a minutia is matched when the other set
+    has one of the same type within radius pixels.
+    :return: (precision, recall), the matched fractions of found and of reference, 1 for an empty set
+    """
+    precision, recall = np.ones(len(found), bool), np.ones(len(reference), bool)
+    for kind in np.union1d(found['type'], reference['type']):
+        f, r = found['type'] == kind, reference['type'] == kind
+        if not f.any() or not r.any():
+            precision[f], recall[r] = False, False
+            continue
+        tree = scipy.spatial.cKDTree(np.stack([reference['x'][r], reference['y'][r]], axis=1).astype(np.float64))
+        precision[f] = np.isfinite(tree.query(np.stack([found['x'][f], found['y'][f]], axis=1).astype(np.float64),
+                                              distance_upper_bound=radius)[0])
+        tree = scipy.spatial.cKDTree(np.stack([found['x'][f], found['y'][f]], axis=1).astype(np.float64))
+        recall[r] = np.isfinite(tree.query(np.stack([reference['x'][r], reference['y'][r]], axis=1).astype(np.float64),
+                                           distance_upper_bound=radius)[0])
+    return (float(precision.mean()) if len(found) else 1.), (float(recall.mean()) if len(reference) else 1.)
+
+
+def identify(probe, index, gallery, candidates=10, transforms=3, exclude=None):
+    """
+    1:N search of a probe template.
+    :param index: PairIndex built over gallery
+    :param gallery: sequence of templates, e.g. a template.Gallery
+    :param candidates: number of templates that are scored after the index search
+    :param transforms: number of alignments tried per candidate
+    :param exclude: gallery position to leave out, e.g. the probe itself
+    :return: (positions, scores) of the candidates, best first
+    """
+    bins, rotation, tx, ty, owner = alignment_votes(probe, index)
+    if exclude is not None:
+        keep = owner != exclude
+        bins, rotation, tx, ty, owner = bins[keep], rotation[keep], tx[keep], ty[keep], owner[keep]
+    if len(bins) == 0:
+        return np.zeros(0, np.int64), np.zeros(0)
+
+    unique_bins, bin_of_vote, votes = np.unique(bins, return_inverse=True, return_counts=True)
+    bin_owner = unique_bins // (128 * 1024 * 1024)
+
+    strongest = np.zeros(index.size, np.int64)
+    np.maximum.at(strongest, bin_owner, votes)
+    shortlist = np.argsort(-strongest, kind='stable')[:candidates]
+    shortlist = shortlist[strongest[shortlist] > 0]
+
+    scores = np.zeros(len(shortlist))
+    for i, position in enumerate(shortlist):
+        owned = np.nonzero(bin_owner == position)[0]
+        for best in owned[np.argsort(-votes[owned], kind='stable')[:transforms]]:
+            selected = bin_of_vote == best
+            angle = np.angle(np.exp(1j*rotation[selected]).mean())
+            score = match_score(probe, gallery[position], angle, tx[selected].mean(), ty[selected].mean())
+            scores[i] = max(scores[i], score)
+
+    order = np.argsort(-scores, kind='stable')
+    return shortlist[order], scores[order]
@@ -0,0 +1,60 @@
+"""
+Memory policy of the pipeline.
+
+Float dtype: every image sized floating point array the stages create (the normalized image, the
+frequency image, the gabor input and responses, the stacks of ridge frequency blocks) uses float_dtype(),
+float32 unless float64 is asked for with set_float_dtype or float_precision. Per block maps (angles,
+coherence, block frequencies) and the statistics and sums the stages reduce to stay in float64: they are
+a few hundred values and several of them are compared against exact thresholds.
+
+Memory budget: the stages that work on a stack or a crop as large as the image (ridge_freq, gabor_filter)
+take a memory_budget in bytes and split their work into chunks whose scratch arrays fit in it. The
+inputs and outputs of a stage are not part of the budget. The batch functions over (N, H, W) stacks
+default to BATCH_MEMORY_BUDGET: reducing a whole stack at once is memory bound, chunks whose scratch
+arrays stay in the cache are faster.
+"""
+from contextlib import contextmanager
+import numpy as np
+
+FLOAT_DTYPES = (np.dtype(np.float32), np.dtype(np.float64))
+BATCH_MEMORY_BUDGET = 4 * 2**20
+
+# process wide, set it in every worker process, e.g. from a pool initializer
+_float_dtype = np.dtype(np.float32)
+
+
+def float_dtype():
+    return _float_dtype
+
+
+def set_float_dtype(dtype):
+    global _float_dtype
+    dtype = np.dtype(dtype)
+    if dtype not in FLOAT_DTYPES:
+        raise ValueError('float dtype must be float32 or float64, got %s' % dtype)
+    _float_dtype = dtype
+
+
+@contextmanager
+def float_precision(dtype):
+    """
+        with float_precision(np.float64):
+            features = fingerprint_features(img)
+    """
+    previous = _float_dtype
+    set_float_dtype(dtype)
+    try:
+        yield
+    finally:
+        set_float_dtype(previous)
+
+
+def chunk_length(memory_budget, item_bytes, total):
+    """
+    :param memory_budget: bytes, None for no limit
+    :param item_bytes: scratch bytes needed per item
+    :return: number of items to process at once, at least 1
+    """
+    if memory_budget is None or total == 0:
+        return max(total, 1)
+    return int(min(total, max(1, memory_budget // max(item_bytes, 1))))
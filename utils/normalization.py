@@ -6,6 +6,8 @@ ridges to facilitate subsequent processing steps
 """
 from math import sqrt
 import numpy as np
+import cv2 as cv
+from utils.memory import float_dtype
 
 
 def normalize_pixel(x, v0, v, m, m0):
@@ -23,13 +25,65 @@ def normalize_pixel(x, v0, v, m, m0):
     dev_coeff = sqrt((v0 * ((x - m)**2)) / v)
     return m0 + dev_coeff if x > m else m0 - dev_coeff
 
-def normalize(im, m0, v0):
-    m = np.mean(im)
-    v = np.std(im) ** 2
-    (y, x) = im.shape
-    normilize_image = im.copy()
-    for i in range(x):
-        for j in range(y):
-            normilize_image[j, i] = normalize_pixel(im[j, i], v0, v, m, m0)
+def uint8_mean_std(ims):
+    """
+    Mean and standard deviation of every image of a uint8 stack from exact integer sums. The mean is the
+    one np.mean returns and the standard deviation is correctly rounded, where np.std may be off by an ulp.
+    :param ims: (N, H, W) uint8 stack
+    :return: (means, stds), lists of N floats
+    """
+    n = ims.shape[1] * ims.shape[2]
+    values = ims.reshape(len(ims), n)
+    sums = values.sum(axis=1, dtype=np.int64).tolist()
+    sqsums = np.square(values, dtype=np.uint16).sum(axis=1, dtype=np.int64).tolist()
+    # the variance is a ratio of python integers, which cannot overflow and is rounded once
+    return [s / n for s in sums], [sqrt((n*sq - s*s) / (n*n)) for s, sq in zip(sums, sqsums)]
+
+
+def normalize_values(values, m0, v0, m, v):
+    """
+    normalize_pixel as an array expression, m and v may be arrays broadcasting against values
+    """
+    dev_coeff = np.sqrt((v0 * ((values - m)**2)) / v)
+    return np.where(values > m, m0 + dev_coeff, m0 - dev_coeff)
+
+
+def normalize(im, m0, v0, dtype=np.uint8):
+    """
+    normalize_pixel applied to the whole image as one array expression. A uint8 image only has 256 distinct
+    values, so they are normalized once in float64 and looked up, with no image sized float array.
+    :param im: 2d image
+    :param m0: desired mean
+    :param v0: desired variance
+    :param dtype: output dtype, uint8 truncates like the per pixel version, float32 keeps the fraction
+    :return: normilized image
+    """
+    if im.dtype == np.uint8:
+        (m,), (std,) = uint8_mean_std(im[None])
+        return cv.LUT(im, normalize_values(np.arange(256), m0, v0, m, std ** 2).astype(dtype))
+    m = float(np.mean(im))
+    v = float(np.std(im)) ** 2
+    return normalize_values(im.astype(float_dtype(), copy=False), m0, v0, m, v).astype(dtype)
+
+
+def normalize_batch(ims, m0, v0, dtype=np.uint8):
+    """
+    normalize over a stack of images of the same shape, every image with its own mean and variance.
+    The statistics of all the images are reduced at once and the 256 normalized values of every uint8
+    image come from one (N, 256) array expression, so the result is the same as normalize image by image.
+    :param ims: (N, H, W) stack
+    :return: (N, H, W) normilized images
+    """
+    ims = np.asarray(ims)
+    if ims.dtype == np.uint8:
+        m, std = uint8_mean_std(ims)
+        luts = normalize_values(np.arange(256)[None, :], m0, v0, np.array(m)[:, None],
+                                np.array(std)[:, None] ** 2).astype(dtype)
+        normalized = np.empty(ims.shape, dtype)
+        for im, lut, out in zip(ims, luts, normalized):
+            cv.LUT(im, lut, dst=out)
+        return normalized
 
-    return normilize_image
+    m = np.mean(ims, axis=(1, 2))[:, None, None]
+    v = np.std(ims, axis=(1, 2))[:, None, None] ** 2
+    return normalize_values(ims.astype(float_dtype(), copy=False), m0, v0, m, v).astype(dtype)
@@ -1,61 +1,116 @@
 import math
 import numpy as np
 import cv2 as cv
+from utils.memory import float_dtype, chunk_length, BATCH_MEMORY_BUDGET
+from utils.tiling import map_row_tiles
 
 
-def calculate_angles(im, W, smoth=False):
+def block_gradient_sums(im, W, executor=None):
     """
-    anisotropy orientation estimate, based on equations 5 from:
-    https://pdfs.semanticscholar.org/6e86/1d0b58bdf7e2e2bb0ecbf274cee6974fe13f.pdf
-    :param im:
-    :param W: int width of the ridge
-    :return: array
+    Per block sums of the squared gradient terms used by the orientation estimate.
+    Blocks follow the grid of the original per-pixel loop: they start at pixel 1 and the last row and
+    column of the image are never part of a block. Gradients are rounded to integers before squaring,
+    so the sums are exact integers. Gradients and their products fit in int32, only the block sums are
+    int64.
+    A (N, H, W) stack is filtered as one (N*H, W) image: the rows where two images meet are the first and
+    last rows of an image, whose gradients are never used.
+    :param im: 2d image or (N, H, W) stack of images
+    :param W: int block size
+    :param executor: thread pool filtering bands of rows concurrently, see utils.tiling
+    :return: (Gxy, Gxx_yy, Gxx_plus_yy) block sums, each of shape (len(range(1, y, W)), len(range(1, x, W)))
+    per image
     """
-    j1 = lambda x, y: 2 * x * y
-    j2 = lambda x, y: x ** 2 - y ** 2
-    j3 = lambda x, y: x ** 2 + y ** 2
-
-    (y, x) = im.shape
+    (y, x) = im.shape[-2:]
+    lead = im.shape[:-2]
 
     sobelOperator = [[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]
     ySobel = np.array(sobelOperator).astype(np.int_)
     xSobel = np.transpose(ySobel).astype(np.int_)
 
-    result = [[] for i in range(1, y, W)]
-
-    Gx_ = cv.filter2D(im/125,-1, ySobel)*125
-    Gy_ = cv.filter2D(im/125,-1, xSobel)*125
-
-    for j in range(1, y, W):
-        for i in range(1, x, W):
-            nominator = 0
-            denominator = 0
-            for l in range(j, min(j + W, y - 1)):
-                for k in range(i, min(i + W , x - 1)):
-                    Gx = round(Gx_[l, k])  # horizontal gradients at l, k
-                    Gy = round(Gy_[l, k])  # vertial gradients at l, k
-                    nominator += j1(Gx, Gy)
-                    denominator += j2(Gx, Gy)
-
-            # nominator = round(np.sum(Gy_[j:min(j + W, y - 1), i:min(i + W , x - 1)]))
-            # denominator = round(np.sum(Gx_[j:min(j + W, y - 1), i:min(i + W , x - 1)]))
-            if nominator or denominator:
-                angle = (math.pi + math.atan2(nominator, denominator)) / 2
-                orientation = np.pi/2 + math.atan2(nominator,denominator)/2
-                result[int((j-1) // W)].append(angle)
-            else:
-                result[int((j-1) // W)].append(0)
-
-            # segment image
-            # focus_img = im[j:min(j + W, y - 1), i:min(i + W , x - 1)]
-            # segmentator = -1 if segmentator/W*W < np.max(focus_img)*
-
-    result = np.array(result)
+    # the sobel response of a uint8 image is an exact integer in float32 already
+    depth = cv.CV_32F if im.dtype == np.uint8 or float_dtype() == np.float32 else cv.CV_64F
+    rows_im = np.ascontiguousarray(im).reshape(-1, x)
+    Gx_ = np.round(map_row_tiles(executor, lambda rows: cv.filter2D(rows, depth, ySobel), rows_im, 1, align=W))
+    Gy_ = np.round(map_row_tiles(executor, lambda rows: cv.filter2D(rows, depth, xSobel), rows_im, 1, align=W))
+    Gx_ = Gx_.astype(np.int32).reshape(im.shape)
+    Gy_ = Gy_.astype(np.int32).reshape(im.shape)
+
+    # pad the inner region [1:y-1, 1:x-1] with zeros up to a whole number of blocks
+    rows, cols = len(range(1, y, W)), len(range(1, x, W))
+    Gx = np.zeros(lead + (rows * W, cols * W), np.int32)
+    Gy = np.zeros(lead + (rows * W, cols * W), np.int32)
+    Gx[..., :y - 2, :x - 2] = Gx_[..., 1:y - 1, 1:x - 1]
+    Gy[..., :y - 2, :x - 2] = Gy_[..., 1:y - 1, 1:x - 1]
+
+    def block_sum(values):
+        return values.reshape(lead + (rows, W, cols, W)).sum(axis=(-3, -1), dtype=np.int64)
+
+    return block_sum(2 * Gx * Gy), block_sum(Gx ** 2 - Gy ** 2), block_sum(Gx ** 2 + Gy ** 2)
+
+
+def angles_and_coherence(nominator, denominator, magnitude):
+    """
+    :param nominator: Gxy block sums
+    :param denominator: Gxx - Gyy block sums
+    :param magnitude: Gxx + Gyy block sums
+    :return: (angles, coherence), angles are 0 where both sums are 0
+    """
+    angles = (np.pi + np.arctan2(nominator, denominator)) / 2
+    angles[(nominator == 0) & (denominator == 0)] = 0
+
+    coherence = np.zeros(angles.shape)
+    valid = magnitude > 0
+    coherence[valid] = np.hypot(nominator[valid], denominator[valid]) / magnitude[valid]
+    return angles, coherence
+
+
+def calculate_angles_and_coherence(im, W, smoth=False, executor=None):
+    """
+    Vectorized block orientation engine. The Gxy and Gxx - Gyy sums of every block are computed with
+    one reshape reduction instead of visiting each pixel.
+    The angles are the same as the per-pixel loop reference up to floating point round off: the block
+    sums are exact integers, so the two agree to within 1e-12 rad.
+    Coherence is sqrt(Gxy^2 + (Gxx - Gyy)^2) / (Gxx + Gyy) per block, 1 for a perfectly oriented block
+    and 0 for a flat or isotropic one.
+    :param im: 2d image, or a (N, H, W) stack of images for (N, rows, cols) results
+    :param W: int width of the block
+    :param smoth: apply smooth_angles to the angle field
+    :param executor: thread pool for the Sobel filters, see block_gradient_sums
+    :return: (angles, coherence) arrays with one value per block
+    """
+    angles, coherence = angles_and_coherence(*block_gradient_sums(im, W, executor))
 
     if smoth:
-        result = smooth_angles(result)
+        angles = np.array([smooth_angles(a) for a in angles]) if angles.ndim == 3 else smooth_angles(angles)
 
-    return result
+    return angles, coherence
+
+
+def calculate_angles(im, W, smoth=False):
+    """
+    anisotropy orientation estimate, based on equations 5 from:
+    https://pdfs.semanticscholar.org/6e86/1d0b58bdf7e2e2bb0ecbf274cee6974fe13f.pdf
+    :param im:
+    :param W: int width of the ridge
+    :return: array
+    """
+    angles, _ = calculate_angles_and_coherence(im, W, smoth)
+    return angles
+
+
+def calculate_angles_batch(ims, W, smoth=False, memory_budget=BATCH_MEMORY_BUDGET):
+    """
+    calculate_angles over a (N, H, W) stack of images of the same shape, the gradients of as many images
+    as fit in memory_budget are filtered and summed at once
+    :param memory_budget: bytes of scratch memory, about 40 per pixel, None for the whole stack
+    :return: (N, rows, cols) array
+    """
+    ims = np.asarray(ims)
+    chunk = chunk_length(memory_budget, 40 * ims[0].size if len(ims) else 0, len(ims))
+    angles = [calculate_angles_and_coherence(ims[start:start + chunk], W, smoth)[0]
+              for start in range(0, len(ims), chunk)]
+    return np.concatenate(angles) if angles else np.zeros((0,) + tuple(
+        len(range(1, size, W)) for size in ims.shape[1:]))
 
 
 def gauss(x, y):
@@ -39,25 +39,94 @@ def poincare_index_at(i, j, angles, tolerance):
     return "none"
 
 
-def calculate_singularities(im, angles, tolerance, W, mask):
+# singular points, x/y is the top left corner of the block
+SINGULARITY_DTYPE = np.dtype([('x', '<u2'), ('y', '<u2'), ('type', 'u1')])
+LOOP = 1
+DELTA = 2
+WHORL = 3
+SINGULARITY_TYPES = {LOOP: "loop", DELTA: "delta", WHORL: "whorl"}
+
+
+def poincare_index(angles):
+    """
+    poincare_index_at for every block of the grid at once. The 8 neighbours are read from shifted
+    copies of the angle grid, in degrees, and the wrapped differences are summed in the same order.
+    :return: poincare index of the blocks [1:-1, 1:-1] of the grid
+    """
+    cells = [(-1, -1), (-1, 0), (-1, 1),         # p1 p2 p3
+            (0, 1),  (1, 1),  (1, 0),            # p8    p4
+            (1, -1), (0, -1), (-1, -1)]          # p7 p6 p5
+
+    degrees = np.degrees(np.asarray(angles, dtype=np.float64))
+    rows, cols = degrees.shape
+    # neighbour angles[i - k][j - l] of every inner block
+    around = [degrees[1 - k:rows - 1 - k, 1 - l:cols - 1 - l] for k, l in cells]
+
+    index = np.zeros((rows - 2, cols - 2))
+    for k in range(0, 8):
+        difference = around[k] - around[k + 1]
+        difference = np.where(difference > 90, difference - 180, np.where(difference < -90, difference + 180, difference))
+        index += difference
+    return index
+
+
+def find_singularities(angles, tolerance, W, mask):
+    """
+    Loops (cores), deltas and whorls of the orientation field. Only blocks whose 5x5 block neighbourhood is
+    fully inside the mask are considered; the coverage of every neighbourhood comes from one summed-area
+    table of the mask.
+    :return: SINGULARITY_DTYPE array ordered by row then column
+    """
+    rows, cols = np.shape(angles)
+    singularities = np.zeros(0, SINGULARITY_DTYPE)
+    if rows < 6 or cols < 6:
+        return singularities
+
+    index = poincare_index(angles)
+
+    # mask any singularity outside of the mask
+    (y, x) = mask.shape
+    mask_sum = cv.integral(mask.astype(np.uint8), sdepth=cv.CV_32S)
+    i = np.arange(3, rows - 2)[:, None]
+    j = np.arange(3, cols - 2)[None, :]
+    top, bottom = np.clip((i-2)*W, 0, y), np.clip((i+3)*W, 0, y)
+    left, right = np.clip((j-2)*W, 0, x), np.clip((j+3)*W, 0, x)
+    mask_flag = mask_sum[bottom, right] - mask_sum[top, right] - mask_sum[bottom, left] + mask_sum[top, left]
+    inside = mask_flag == (W*5)**2
+
+    index = index[2:rows - 3, 2:cols - 3]
+    types = np.zeros(index.shape, np.uint8)
+    # assigned in reverse priority, a loop wins over a delta which wins over a whorl
+    types[(360 - tolerance <= index) & (index <= 360 + tolerance)] = WHORL
+    types[(-180 - tolerance <= index) & (index <= -180 + tolerance)] = DELTA
+    types[(180 - tolerance <= index) & (index <= 180 + tolerance)] = LOOP
+    types[~inside] = 0
+
+    found_i, found_j = np.nonzero(types)
+    singularities = np.zeros(len(found_i), SINGULARITY_DTYPE)
+    singularities['x'] = (found_j + 3)*W
+    singularities['y'] = (found_i + 3)*W
+    singularities['type'] = types[found_i, found_j]
+    return singularities
+
+
+def draw_singularities(im, singularities, W):
     result = cv.cvtColor(im, cv.COLOR_GRAY2RGB)
 
     # DELTA: RED, LOOP:ORAGNE, whorl:INK
-    colors = {"loop" : (0, 0, 255), "delta" : (0, 128, 255), "whorl": (255, 153, 255)}
-
-    for i in range(3, len(angles) - 2):             # Y
-        for j in range(3, len(angles[i]) - 2):      # x
-            # mask any singularity outside of the mask
-            mask_slice = mask[(i-2)*W:(i+3)*W, (j-2)*W:(j+3)*W]
-            mask_flag = np.sum(mask_slice)
-            if mask_flag == (W*5)**2:
-                singularity = poincare_index_at(i, j, angles, tolerance)
-                if singularity != "none":
-                    cv.rectangle(result, ((j+0)*W, (i+0)*W), ((j+1)*W, (i+1)*W), colors[singularity], 3)
+    colors = {LOOP : (0, 0, 255), DELTA : (0, 128, 255), WHORL: (255, 153, 255)}
+
+    for singularity in singularities:
+        x, y = int(singularity['x']), int(singularity['y'])
+        cv.rectangle(result, (x, y), (x + W, y + W), colors[singularity['type']], 3)
 
     return result
 
 
+def calculate_singularities(im, angles, tolerance, W, mask):
+    return draw_singularities(im, find_singularities(angles, tolerance, W, mask), W)
+
+
 if __name__ == '__main__':
     img = cv.imread('../test_img.png', 0)
     cv.imshow('original', img)
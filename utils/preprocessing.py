@@ -0,0 +1,32 @@
+"""
+Normalization and segmentation fused into one stage. The normalized image is computed with a single
+array expression and everything segmentation needs (the global standard deviation and the standard
+deviation of every block) comes from one pass of block sums over it.
+"""
+import numpy as np
+from utils.normalization import normalize
+from utils.segmentation import block_sums, block_std, segment
+
+
+def preprocess(im, m0, v0, w, threshold=.2, dtype=np.uint8, executor=None):
+    """
+    :param im: 2d image
+    :param m0: desired mean of the normalized image
+    :param v0: desired variance of the normalized image
+    :param w: size of the segmentation block
+    :param threshold: std threshold of the segmentation, relative to the global std
+    :param dtype: dtype of the normalized image, uint8 or float32
+    :param executor: thread pool for the mask smoothing, see utils.tiling
+    :return: (normalized_img, segmented_img, norm_img, mask)
+    """
+    normalized_img = normalize(im, m0, v0, dtype)
+
+    (y, x) = normalized_img.shape
+    sums = block_sums(normalized_img, w)
+    mean = sums[0].sum() / (y * x)
+    global_std = np.sqrt(max(sums[1].sum() / (y * x) - mean**2, 0))
+
+    block_stddev = block_std(normalized_img, w, sums)
+    segmented_img, norm_img, mask = segment(normalized_img, w, threshold, block_stddev, global_std, executor)
+
+    return normalized_img, segmented_img, norm_img, mask
@@ -0,0 +1,109 @@
+"""
+Coarse to fine estimation of the orientation field and of the ridge frequency map. Both vary slowly across
+a print, so they are estimated on the image downsampled `levels` times with cv.pyrDown and resampled to
+the block grids the full resolution stages use: the orientation grid of gabor_filter and the poincare
+index (blocks starting at pixel 1) and the frequency grid of ridge_freq (blocks starting at pixel 0).
+
+The coarse blocks keep the block size in coarse pixels, so a coarse block covers 2**levels full blocks
+per side and there are 4**levels times fewer blocks to estimate. The orientation is interpolated
+bilinearly from the coarse gradient sums, i.e. the doubled angle vectors are averaged, never the angles.
+A coarse ridge frequency is only valid or not, it is taken from the nearest coarse block.
+
+Ridges get 2**levels times closer in the coarse image, one level keeps the 5 px shortest wavelength
+above the 2 px the pyramid can represent. `python pyramid_comparison.py` measures the errors against the
+full resolution estimates and the speedup.
+"""
+import cv2 as cv
+import numpy as np
+import scipy.ndimage
+from utils.frequency import ridge_freq_map, median_frequency
+from utils.orientation import block_gradient_sums, angles_and_coherence
+
+
+def downsample(im, levels):
+    """
+    :return: im after levels cv.pyrDown, (ceil(y / 2**levels), ceil(x / 2**levels))
+    """
+    for _ in range(levels):
+        im = cv.pyrDown(im)
+    return im
+
+
+def block_centers(count, W, factor, offset, target_offset):
+    """
+    :param count: number of blocks of a grid whose first block starts at pixel offset
+    :param factor: size of the pixels of the target grid in pixels of the grid
+    :param target_offset: first pixel of the target grid, in its own pixels
+    :return: fractional position of the center of every block in blocks of the target grid, both grids
+    have blocks of W pixels
+    """
+    centers = offset + np.arange(count)*W + (W - 1)/2
+    return (centers/factor - target_offset - (W - 1)/2)/W
+
+
+def nearest_blocks(count, W, factor, offset, target_offset, target_count):
+    """
+    :return: index of the target block nearest to the center of every block, see block_centers
+    """
+    index = np.floor(block_centers(count, W, factor, offset, target_offset) + .5).astype(int)
+    return np.clip(index, 0, target_count - 1)
+
+
+def pyramid_angles_and_coherence(im, W, levels=1):
+    """
+    calculate_angles_and_coherence on the image downsampled levels times, resampled to the full grid
+    :return: (angles, coherence) of shape (len(range(1, y, W)), len(range(1, x, W)))
+    """
+    factor = 2**levels
+    sums = block_gradient_sums(downsample(im, levels), W)
+
+    (y, x) = im.shape
+    rows = block_centers(len(range(1, y, W)), W, factor, 1, 1)
+    cols = block_centers(len(range(1, x, W)), W, factor, 1, 1)
+    coordinates = np.meshgrid(rows, cols, indexing='ij')
+    return angles_and_coherence(*(scipy.ndimage.map_coordinates(block_sums.astype(np.float64), coordinates,
+                                                                order=1, mode='nearest')
+                                  for block_sums in sums))
+
+
+def pyramid_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength, levels=1,
+                     memory_budget=None):
+    """
+    ridge_freq_map on the image downsampled levels times, resampled to the full frequency grid
+    :param orient: block orientations of the full grid, the coarse blocks take the nearest one
+    :return: (rows // block_size, cols // block_size) array in cycles per full resolution pixel
+    """
+    factor = 2**levels
+    coarse, coarse_mask = downsample(im, levels), mask[::factor, ::factor]
+
+    # orientation of every coarse block
+    orient = np.asarray(orient)
+    (coarse_y, coarse_x) = coarse.shape
+    rows = nearest_blocks(coarse_y // block_size, block_size, 1/factor, 0, 1, orient.shape[0])
+    cols = nearest_blocks(coarse_x // block_size, block_size, 1/factor, 0, 1, orient.shape[1])
+    coarse_orient = orient[np.ix_(rows, cols)]
+
+    # the dilation finding the peaks shrinks with the ridges, but keeps 3 pixels
+    coarse_kernel = max(3, kernel_size // factor | 1)
+    coarse_map = ridge_freq_map(coarse, coarse_mask, coarse_orient, block_size, coarse_kernel,
+                                minWaveLength/factor, maxWaveLength/factor, memory_budget)
+
+    (y, x) = im.shape
+    rows = nearest_blocks(y // block_size, block_size, factor, 0, 0, coarse_map.shape[0])
+    cols = nearest_blocks(x // block_size, block_size, factor, 0, 0, coarse_map.shape[1])
+    return coarse_map[np.ix_(rows, cols)] / factor
+
+
+def pyramid_ridge_freq(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength, levels=1,
+                       return_map=False, memory_budget=None):
+    """
+    ridge_freq with the block map of pyramid_freq_map
+    :return: median frequency of the masked blocks times the mask, and the block map if return_map is set
+    """
+    freq_map = pyramid_freq_map(im, mask, orient, block_size, kernel_size, minWaveLength, maxWaveLength, levels,
+                                memory_budget)
+    medianfreq = median_frequency(mask, freq_map, block_size)
+
+    if return_map:
+        return medianfreq, freq_map
+    return medianfreq
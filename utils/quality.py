@@ -0,0 +1,154 @@
+"""
+Quality assessment of a print, run after segmentation and orientation so the expensive enhancement stages
+can be skipped for prints that would not give a usable template.
+
+Metrics, all per print:
+    mask_area           fraction of the image inside the segmentation mask
+    contrast            median standard deviation of the blocks inside the mask relative to the standard
+                        deviation of the whole normalized image, the quantity segmentation thresholds
+    coherence           mean orientation coherence of the blocks inside the mask, see
+                        orientation.calculate_angles_and_coherence
+    frequency_validity  fraction of the blocks inside the mask for which ridge_freq found a frequency
+
+The first three are known once the orientations are, the last one once the ridge frequencies are, so the
+pipeline checks the policy twice. A print is rejected with the reason code of its weakest metric relative
+to the minimum of the policy.
+"""
+from collections import namedtuple
+import numpy as np
+from utils.segmentation import block_sums, block_std
+
+QualityMetrics = namedtuple('QualityMetrics', ['mask_area', 'contrast', 'coherence', 'frequency_validity'],
+                            defaults=[None])
+
+# minimum of every metric, the defaults only reject prints far below the weakest of './sample_inputs/'
+QualityPolicy = namedtuple('QualityPolicy', ['min_mask_area', 'min_contrast', 'min_coherence',
+                                             'min_frequency_validity'],
+                           defaults=[0.15, 0.4, 0.25, 0.08])
+DEFAULT_POLICY = QualityPolicy()
+
+# reason code of every metric
+REASONS = {'mask_area': 'small_mask', 'contrast': 'low_contrast', 'coherence': 'low_coherence',
+           'frequency_validity': 'no_ridge_frequency'}
+
+# score: the weakest metric over its minimum, below 1 the print is rejected with reason
+# after: the last stage run before the check, a rejected print skips every stage after it
+QualityReport = namedtuple('QualityReport', ['score', 'reason', 'metrics', 'after'])
+
+
+def block_coverage(mask, block_size, shape, offset=0):
+    """
+    :param shape: (rows, cols) of a block map whose blocks start offset pixels into the mask
+    :return: fraction of every block inside the mask
+    """
+    sums, _, count = block_sums(np.asarray(mask[offset:, offset:] > 0, np.uint8), block_size)
+    return (sums / count)[:shape[0], :shape[1]]
+
+
+def segmentation_quality(normalized, mask, roi_mask, coherence, block_size):
+    """
+    :param normalized: normalized image
+    :param mask: segmentation mask of the image
+    :param roi_mask: mask over the region of interest the orientations were computed on
+    :param coherence: block coherence of the region of interest, blocks start at pixel 1
+    :return: QualityMetrics without frequency_validity
+    """
+    mask_area = float(np.count_nonzero(mask)) / mask.size
+
+    sums = block_sums(normalized, block_size)
+    (y, x) = normalized.shape
+    mean = sums[0].sum() / (y * x)
+    global_std = np.sqrt(max(sums[1].sum() / (y * x) - mean**2, 0))
+    inside = block_coverage(mask, block_size, sums[0].shape) > .5
+    block_stddev = block_std(normalized, block_size, sums)[inside]
+    contrast = float(np.median(block_stddev) / global_std) if len(block_stddev) and global_std > 0 else 0.
+
+    inside = block_coverage(roi_mask, block_size, coherence.shape, offset=1) > .5
+    coherence = float(coherence[inside].mean()) if inside.any() else 0.
+
+    return QualityMetrics(mask_area, contrast, coherence)
+
+
+def frequency_validity(mask, freq_map, block_size):
+    """
+    :param freq_map: block frequency map from ridge_freq, 0 where no frequency was found
+    :return: fraction of the blocks inside the mask with a frequency
+    """
+    inside = block_coverage(mask, block_size, freq_map.shape) > .5
+    return float(np.count_nonzero(freq_map[inside] > 0)) / max(np.count_nonzero(inside), 1)
+
+
+def assess_quality(metrics, policy=DEFAULT_POLICY, after=None):
+    """
+    :param metrics: QualityMetrics, the metrics left at None are not checked
+    :param after: name of the last stage run before the check
+    :return: QualityReport, reason is None when the print passes
+    """
+    ratios = {}
+    for name, value in metrics._asdict().items():
+        minimum = getattr(policy, 'min_' + name)
+        if value is not None and minimum > 0:
+            ratios[name] = value / minimum
+
+    if not ratios:
+        return QualityReport(float('inf'), None, metrics, after)
+    weakest = min(ratios, key=ratios.get)
+    score = ratios[weakest]
+    return QualityReport(score, REASONS[weakest] if score < 1 else None, metrics, after)
+
+
+class GateSummary:
+    """
+    Running summary of the quality gate over a batch: the prints rejected per reason and the compute the
+    gate saved, estimated for every rejected print as the mean time the accepted prints spent in the
+    stages it skipped.
+    """
+
+    def __init__(self, stages):
+        """
+        :param stages: stage names in pipeline order
+        """
+        self.stages = list(stages)
+        self.accepted = 0
+        self.rejected = {}
+        # stage: [seconds, count] over the accepted prints
+        self.seconds = {stage: [0., 0] for stage in self.stages}
+        # skipped stage: number of rejected prints that skipped it
+        self.skipped = {stage: 0 for stage in self.stages}
+        self.gate_seconds = 0.
+        self.spent = 0.
+
+    def add(self, quality, records):
+        """
+        :param quality: QualityReport of a print
+        :param records: its instrumentation records
+        """
+        for record in records:
+            if record['stage'] in self.seconds:
+                self.spent += record['wall']
+                if quality.reason is None:
+                    self.seconds[record['stage']][0] += record['wall']
+                    self.seconds[record['stage']][1] += 1
+            elif record['stage'].startswith('quality'):
+                self.gate_seconds += record['wall']
+
+        if quality.reason is None:
+            self.accepted += 1
+            return
+        self.rejected[quality.reason] = self.rejected.get(quality.reason, 0) + 1
+        for stage in self.stages[self.stages.index(quality.after) + 1:]:
+            self.skipped[stage] += 1
+
+    def saved_seconds(self):
+        return sum(self.skipped[stage] * seconds / count
+                   for stage, (seconds, count) in self.seconds.items() if count)
+
+    def format(self):
+        rejected = sum(self.rejected.values())
+        total = self.accepted + rejected
+        saved = self.saved_seconds()
+        lines = ['quality gate: %d of %d prints rejected%s' % (
+            rejected, total, ''.join(', %s %d' % item for item in sorted(self.rejected.items())))]
+        lines.append('gate %.1fms, stages %.1fs, saved about %.1fs (%.0f%% of the stages without the gate)' % (
+            1000 * self.gate_seconds, self.spent, saved, 100 * saved / max(self.spent + saved, 1e-9)))
+        return '\n'.join(lines)
@@ -0,0 +1,80 @@
+"""
+Region of interest of a print: the bounding box of the segmentation mask, aligned to the block grid and
+grown by a margin. The stages after segmentation only run on this crop and their outputs are mapped back
+to the full image at the end.
+
+The margin keeps every stage exact inside the mask. It holds the blocks whose gradients see the crop
+border and the 5x5 block neighbourhood of a singular point (ROI_MARGIN blocks), and it is wider than the
+largest gabor filter radius, see roi_margin: 2 blocks (32 px for 16 px blocks) for the default 29 px
+radius of the 15 px maximum wave length.
+"""
+import numpy as np
+
+ROI_MARGIN = 2
+
+
+def roi_margin(block_size, radius):
+    """
+    :param radius: largest filter radius used on the crop, in pixels
+    :return: margin in blocks, at least ROI_MARGIN and more than radius pixels
+    """
+    return max(ROI_MARGIN, radius // block_size + 1)
+
+
+def roi_box(mask, block_size, margin=ROI_MARGIN):
+    """
+    :param margin: number of blocks added around the bounding box of the mask
+    :return: (top, bottom, left, right), top and left are multiples of block_size; the whole image when the
+    mask is empty
+    """
+    (y, x) = mask.shape
+    rows = np.nonzero(mask.any(axis=1))[0]
+    cols = np.nonzero(mask.any(axis=0))[0]
+    if len(rows) == 0:
+        return 0, y, 0, x
+
+    top = max(0, (int(rows[0]) // block_size - margin) * block_size)
+    left = max(0, (int(cols[0]) // block_size - margin) * block_size)
+    bottom = min(y, (int(rows[-1]) // block_size + 1 + margin) * block_size)
+    right = min(x, (int(cols[-1]) // block_size + 1 + margin) * block_size)
+    return top, bottom, left, right
+
+
+def crop(box, *images):
+    """
+    :return: views of the images inside the box, no pixel is copied
+    """
+    top, bottom, left, right = box
+    return tuple(im[top:bottom, left:right] for im in images)
+
+
+def uncrop(cropped, box, shape, fill=0):
+    """
+    Places a cropped image back into a full size image filled with fill.
+    """
+    top, bottom, left, right = box
+    full = np.full(shape, fill, dtype=cropped.dtype)
+    full[top:bottom, left:right] = cropped
+    return full
+
+
+def uncrop_blocks(cropped, box, shape, block_size, fill=0):
+    """
+    Places a block grid computed on the crop back into the block grid of the full image.
+    """
+    top, _, left, _ = box
+    full = np.full(shape, fill, dtype=cropped.dtype)
+    row, col = top // block_size, left // block_size
+    full[row:row + cropped.shape[0], col:col + cropped.shape[1]] = cropped
+    return full
+
+
+def shift_points(points, box):
+    """
+    Moves points with 'x' and 'y' fields, e.g. minutiae, from crop to full image coordinates.
+    """
+    top, _, left, _ = box
+    points = points.copy()
+    points['x'] += left
+    points['y'] += top
+    return points
@@ -13,12 +13,133 @@ optimize the extraction phase of the biometric data.
 """
 import numpy as np
 import cv2 as cv
+from utils.memory import float_dtype
+from utils.tiling import map_row_tiles
 
 
 def normalise(img):
     return (img - np.mean(img))/(np.std(img))
 
 
+def block_sums(im, w):
+    """
+    Sum and sum of squares of every w x w block (blocks on the right and bottom edges may be smaller).
+    uint8 images are summed exactly in integers over a reshape of the image, other images from summed-area
+    tables.
+    :param im: 2d image or (N, H, W) stack of images
+    :return: (sums, sqsums, count), sums and sqsums of shape (ceil(y / w), ceil(x / w)) per image
+    """
+    (y, x) = im.shape[-2:]
+    rows = np.append(np.arange(0, y, w), y)
+    cols = np.append(np.arange(0, x, w), x)
+    count = np.diff(rows)[:, None] * np.diff(cols)[None, :]
+
+    if im.dtype == np.uint8:
+        padded = np.zeros(im.shape[:-2] + ((len(rows) - 1) * w, (len(cols) - 1) * w), np.uint8)
+        padded[..., :y, :x] = im
+        blocks = padded.reshape(im.shape[:-2] + (len(rows) - 1, w, len(cols) - 1, w))
+        sums = blocks.sum(axis=(-3, -1), dtype=np.int64)
+        sqsums = np.square(blocks, dtype=np.uint16).sum(axis=(-3, -1), dtype=np.int64)
+        return sums, sqsums, count
+
+    def block_sum(table):
+        corners = table[rows][:, cols]
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+    if im.ndim == 3:
+        sums = [block_sums(image, w) for image in im]
+        return np.array([s[0] for s in sums]), np.array([s[1] for s in sums]), count
+    integral, sqintegral = cv.integral2(im, sdepth=cv.CV_64F, sqdepth=cv.CV_64F)
+    return block_sum(integral), block_sum(sqintegral), count
+
+
+def block_std(im, w, sums=None):
+    """
+    Standard deviation of every w x w block (blocks on the right and bottom edges may be smaller).
+    :param im: 2d image or (N, H, W) stack of images
+    :param sums: (sums, sqsums, count) from block_sums when the caller already has them
+    :return: (ceil(y / w), ceil(x / w)) array per image
+    """
+    sums, sqsums, count = block_sums(im, w) if sums is None else sums
+    mean = sums / count
+    variance = np.maximum(sqsums / count - mean**2, 0)
+    return np.sqrt(variance)
+
+
+def mean_std(ims):
+    """
+    np.mean and np.std of every image of a stack, one image at a time: a reduction over the whole stack
+    gives the same values but is memory bound and slower
+    :param ims: (N, H, W) stack
+    :return: (means, stds) arrays of N floats
+    """
+    return np.array([np.mean(im) for im in ims]), np.array([np.std(im) for im in ims])
+
+
+def background_lut(im, mask, mean, std):
+    """
+    The 256 possible values of a uint8 image normalized in float64, with the background (mask == 0) of the
+    image at zero mean and unit standard deviation, to be looked up.
+    :param mean: mean of the image, std its standard deviation
+    :return: (256,) array in float_dtype()
+    """
+    values = (np.arange(256) - mean)/std
+    background = values[im[mask==0]]
+    return ((values - np.mean(background))/(np.std(background))).astype(float_dtype())
+
+
+def segment_batch(ims, w, threshold, block_stddev, global_std, executor=None):
+    """
+    segment over a stack of images of the same shape. The block thresholds, the masks and the segmented
+    images are computed for the whole stack at once; the morphological smoothing and the statistics of
+    the background are per image.
+    :param ims: (N, H, W) stack
+    :param block_stddev: (N, rows, cols) block standard deviations
+    :param global_std: (N,) standard deviation of every image
+    :param executor: thread pool smoothing bands of rows of every mask concurrently, see utils.tiling
+    :return: (segmented_images, norm_imgs, masks), (N, H, W) each
+    """
+    (count, y, x) = ims.shape
+    thresholds = np.asarray(global_std, np.float64)[:, None, None]*threshold
+
+    # apply threshold, block by block
+    block_mask = (~(block_stddev < thresholds)).astype(ims.dtype)
+    masks = np.repeat(np.repeat(block_mask, w, axis=1), w, axis=2)[:, :y, :x]
+
+    # smooth mask with a open/close morphological filter
+    # the four erosions and dilations reach w rows each
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE,(w*2, w*2))
+    def smooth(mask):
+        return cv.morphologyEx(cv.morphologyEx(mask, cv.MORPH_OPEN, kernel), cv.MORPH_CLOSE, kernel)
+    for mask in masks:
+        mask[:] = map_row_tiles(executor, smooth, mask, 4*w, align=w)
+
+    # normalize segmented image
+    segmented_images = ims * masks
+    norm_imgs = np.empty(ims.shape, float_dtype())
+    if ims.dtype == np.uint8:
+        means, stds = mean_std(ims)
+        for im, mask, mean, std, norm_img in zip(ims, masks, means, stds, norm_imgs):
+            cv.LUT(im, background_lut(im, mask, mean, std), dst=norm_img)
+    else:
+        for im, mask, norm_img in zip(ims, masks, norm_imgs):
+            im = normalise(im.astype(float_dtype(), copy=False))
+            mean_val = np.mean(im[mask==0])
+            std_val = np.std(im[mask==0])
+            norm_img[:] = (im - mean_val)/(std_val)
+
+    return segmented_images, norm_imgs, masks
+
+
+def segment(im, w, threshold, block_stddev, global_std, executor=None):
+    """
+    segment_batch of a single image
+    """
+    segmented_images, norm_imgs, masks = segment_batch(im[None], w, threshold, block_stddev[None], [global_std],
+                                                       executor)
+    return segmented_images[0], norm_imgs[0], masks[0]
+
+
 def create_segmented_and_variance_images(im, w, threshold=.2):
     """
     Returns mask identifying the ROI. Calculates the standard deviation in each image block and threshold the ROI
@@ -30,32 +151,13 @@ def create_segmented_and_variance_images(im, w, threshold=.2):
     :param threshold: std threshold
     :return: segmented_image
     """
-    (y, x) = im.shape
-    threshold = np.std(im)*threshold
-
-    image_variance = np.zeros(im.shape)
-    segmented_image = im.copy()
-    mask = np.ones_like(im)
-
-    for i in range(0, x, w):
-        for j in range(0, y, w):
-            box = [i, j, min(i + w, x), min(j + w, y)]
-            block_stddev = np.std(im[box[1]:box[3], box[0]:box[2]])
-            image_variance[box[1]:box[3], box[0]:box[2]] = block_stddev
-
-    # apply threshold
-    mask[image_variance < threshold] = 0
-
-    # smooth mask with a open/close morphological filter
-    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE,(w*2, w*2))
-    mask = cv.morphologyEx(mask, cv.MORPH_OPEN, kernel)
-    mask = cv.morphologyEx(mask, cv.MORPH_CLOSE, kernel)
+    return segment(im, w, threshold, block_std(im, w), mean_std(im[None])[1][0])
 
-    # normalize segmented image
-    segmented_image *= mask
-    im = normalise(im)
-    mean_val = np.mean(im[mask==0])
-    std_val = np.std(im[mask==0])
-    norm_img = (im - mean_val)/(std_val)
 
-    return segmented_image, norm_img, mask
+def create_segmented_and_variance_images_batch(ims, w, threshold=.2):
+    """
+    create_segmented_and_variance_images over a (N, H, W) stack of images of the same shape
+    :return: (segmented_images, norm_imgs, masks), (N, H, W) each
+    """
+    ims = np.asarray(ims)
+    return segment_batch(ims, w, threshold, block_std(ims, w), mean_std(ims)[1])
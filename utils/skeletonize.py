@@ -5,44 +5,162 @@ while maintaining the connectivity of the striations ( That is to say that the c
 striaes must be respected, holes must not be inserted). While some papers use Rosenfeld algorithm for its
 simplicity. [https://airccj.org/CSCP/vol7/csit76809.pdf pg.91] I used skimage Zha84 A fast parallel algorithm for
 thinning digital patterns, T. Y. Zhang and C. Y. Suen, Communications of the ACM, March 1984, Volume 27, Number 3.
+
+The thinning itself is pluggable, see THINNING_BACKENDS:
+    'lut'      Zhang-Suen with skimage's lookup table, the same skeleton as 'skimage' but every pass is a
+               correlation and a table lookup in OpenCV and only the area that changed in the last passes
+               is visited again
+    'skimage'  skimage.morphology.skeletonize
+    'opencv'   cv.ximgproc.thinning from opencv-contrib, a different Zhang-Suen variant
 """
+import threading
 import numpy as np
 import cv2 as cv
-from utils.crossing_number import calculate_minutiaes
 from skimage.morphology import skeletonize as skelt
-from skimage.morphology import thin
-def skeletonize(image_input):
+
+# removal candidates of skimage's Zhang-Suen for every 8-neighbourhood code: 1 in the first pass, 2 in the
+# second one, 3 in both. The code of a pixel sums the neighbour weights of ZHANG_SUEN_WEIGHTS.
+ZHANG_SUEN_LUT = np.array([
+    0, 0, 0, 1, 0, 0, 1, 3, 0, 0, 3, 1, 1, 0, 1, 3,
+    0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 2, 0, 3, 0, 3, 3,
+    0, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 3, 0, 2, 2,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    2, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0, 0, 2, 0, 0, 0,
+    3, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0, 0, 3, 0, 2, 0,
+    0, 0, 3, 1, 0, 0, 1, 3, 0, 0, 0, 0, 0, 0, 0, 1,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1,
+    3, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    2, 3, 1, 3, 0, 0, 1, 3, 0, 0, 0, 0, 0, 0, 0, 1,
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    2, 3, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0,
+    3, 3, 0, 1, 0, 0, 0, 0, 2, 2, 0, 0, 2, 0, 0, 0,
+], np.uint8)
+ZHANG_SUEN_WEIGHTS = np.array([[1, 2, 4],
+                               [128, 0, 8],
+                               [64, 32, 16]], np.float32)
+# one 0/1 table per pass, for cv.LUT
+ZHANG_SUEN_PASSES = [((ZHANG_SUEN_LUT & 1) != 0).astype(np.uint8), ((ZHANG_SUEN_LUT & 2) != 0).astype(np.uint8)]
+
+DEFAULT_THINNING = 'lut'
+
+
+class _Workspace(threading.local):
+    """
+    Scratch images of the thinning, one set per thread. They only grow, a call uses their top left corner,
+    so a batch of prints of different sizes allocates them once.
+    """
+
+    def __init__(self):
+        self.buffers = np.zeros((3, 0, 0), np.uint8)
+
+    def get(self, shape):
+        (y, x) = shape
+        if self.buffers.shape[1] < y or self.buffers.shape[2] < x:
+            self.buffers = np.zeros((3, max(y, self.buffers.shape[1]), max(x, self.buffers.shape[2])), np.uint8)
+        return [buffer[:y, :x] for buffer in self.buffers]
+
+
+_workspace = _Workspace()
+
+
+def zhang_suen_thinning(padded, code, removed):
+    """
+    Thins a binary image in place, pass after pass until no pixel can be removed.
+    A pixel only changes when its neighbourhood changed since the last pass of the same kind, so every
+    pass after the first two only visits the bounding box of the pixels removed by the previous two.
+    :param padded: 2d uint8 array of 0 and 1 whose border is 0
+    :param code: scratch array of the same shape
+    :param removed: scratch array of the same shape
+    :return: padded
+    """
+    (y, x) = padded.shape
+    # (x, y, width, height) of the area that changed in the last two passes, everything at first
+    changes = [(1, 1, x - 2, y - 2)] * 2
+    first_pass = True
+    while any(change[2] for change in changes):
+        top = max(1, min(change[1] for change in changes if change[2]) - 1)
+        left = max(1, min(change[0] for change in changes if change[2]) - 1)
+        bottom = min(y - 1, max(change[1] + change[3] for change in changes if change[2]) + 1)
+        right = min(x - 1, max(change[0] + change[2] for change in changes if change[2]) + 1)
+
+        # the window has a one pixel ring around the pixels that are visited
+        window = padded[top - 1:bottom + 1, left - 1:right + 1]
+        window_code = code[top - 1:bottom + 1, left - 1:right + 1]
+        window_removed = removed[top - 1:bottom + 1, left - 1:right + 1]
+        cv.filter2D(window, cv.CV_8U, ZHANG_SUEN_WEIGHTS, dst=window_code, borderType=cv.BORDER_CONSTANT)
+        cv.LUT(window_code, ZHANG_SUEN_PASSES[0 if first_pass else 1], dst=window_removed)
+        cv.bitwise_and(window_removed, window, dst=window_removed)
+        window_removed[[0, -1], :] = 0
+        window_removed[:, [0, -1]] = 0
+
+        change = cv.boundingRect(window_removed)
+        if change[2]:
+            cv.subtract(window, window_removed, dst=window)
+            change = (change[0] + left - 1, change[1] + top - 1, change[2], change[3])
+        changes = [changes[1], change]
+        first_pass = not first_pass
+
+    return padded
+
+
+def thinning_lut(padded, code, removed):
+    return zhang_suen_thinning(padded, code, removed)[1:-1, 1:-1]
+
+
+def thinning_skimage(padded, code, removed):
+    return skelt(padded[1:-1, 1:-1])
+
+
+def thinning_opencv(padded, code, removed):
+    # ximgproc expects the ridges at 255
+    ridges = cv.multiply(padded[1:-1, 1:-1], 255)
+    return cv.ximgproc.thinning(ridges, thinningType=cv.ximgproc.THINNING_ZHANGSUEN)
+
+
+# name -> function of a 0/1 image with a zero border and two scratch images of the same size, returning the
+# skeleton without the border as a non zero on ridges image
+THINNING_BACKENDS = {
+    'lut': thinning_lut,
+    'skimage': thinning_skimage,
+    'opencv': thinning_opencv,
+}
+
+
+def available_backends():
+    """
+    :return: names of the backends that can run here, 'opencv' needs the opencv-contrib build
+    """
+    return [name for name in THINNING_BACKENDS if name != 'opencv' or hasattr(cv, 'ximgproc')]
+
+
+def skeletonize(image_input, mask=None, backend=DEFAULT_THINNING, out=None):
     """
     https://scikit-image.org/docs/dev/auto_examples/edges/plot_skeleton.html
     Skeletonization reduces binary objects to 1 pixel wide representations.
     skeletonize works by making successive passes of the image. On each pass, border pixels are identified
     and removed on the condition that they do not break the connectivity of the corresponding object.
-    :param image_input: 2d array uint8
-    :return:
+    :param image_input: 2d array uint8, ridges are 0
+    :param mask: segmentation mask, ridges outside of it are dropped before thinning
+    :param backend: name of a THINNING_BACKENDS entry
+    :param out: uint8 array receiving the skeleton
+    :return: 2d array uint8, the skeleton is 0 and the background 255
     """
-    image = np.zeros_like(image_input)
-    image[image_input == 0] = 1.0
-    output = np.zeros_like(image_input)
-
-    skeleton = skelt(image)
-
-    """uncomment for testing"""
-    # thinned = thin(image)
-    # thinned_partial = thin(image, max_iter=25)
-    #
-    # def minu_(skeleton, name):
-    #     cv.imshow('thin_'+name, output)
-    #     cv.bitwise_not(output, output)
-    #     minutias = calculate_minutiaes(output, kernel_size=5); cv.imshow('minu_'+name, minutias)
-    # # minu_(output, 'skeleton')
-    # # minu_(output, 'thinned')
-    # # minu_(output, 'thinned_partial')
-    # # cv.waitKeyEx()
-
-    output[skeleton] = 255
-    cv.bitwise_not(output, output)
+    thinning = THINNING_BACKENDS[backend]
+    (y, x) = image_input.shape
+    padded, code, removed = _workspace.get((y + 2, x + 2))
 
-    return output
+    padded[[0, -1], :] = 0
+    padded[:, [0, -1]] = 0
+    ridges = padded[1:-1, 1:-1]
+    cv.threshold(image_input, 0, 1, cv.THRESH_BINARY_INV, dst=ridges)
+    if mask is not None:
+        cv.bitwise_and(ridges, mask.astype(np.uint8, copy=False), dst=ridges)
+
+    skeleton = np.asarray(thinning(padded, code, removed)).view(np.uint8)
+    return cv.compare(skeleton, 0, cv.CMP_EQ, dst=out)
 
 
 def thinning_morph(image, kernel):
@@ -73,14 +191,12 @@ def thinning_morph(image, kernel):
     down[1:-1, :] = thining_image[0:-2, ]
     down_mask = np.subtract(down, thining_image)
     down_mask[0:-2, :] = down_mask[1:-1, ]
-    cv.imshow('down', down_mask)
 
     # shift right and compare one pixel offset
     left = np.zeros_like(thining_image)
     left[:, 1:-1] = thining_image[:, 0:-2]
     left_mask = np.subtract(left, thining_image)
     left_mask[:, 0:-2] = left_mask[:, 1:-1]
-    cv.imshow('left', left_mask)
 
     # combine left and down mask
     cv.bitwise_or(down_mask, down_mask, thining_image)
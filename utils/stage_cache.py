@@ -0,0 +1,268 @@
+"""
+Content addressed on-disk cache of pipeline stage outputs.
+
+The key of a stage is the sha256 of its name, the source of the modules implementing it, the float dtype
+policy, its parameters and the keys of the stages it reads from; the first stage reads the hash of the
+input image bytes. Changing a parameter therefore changes the key of that stage and of everything
+downstream of it, while the stages upstream keep their keys and are loaded instead of recomputed.
+
+Every entry is a directory named after its key holding one .npy file per output array, so structured
+arrays such as minutiae round-trip without pickling. Entries are written under a temporary name and
+renamed, so concurrent workers sharing a directory never read a partial entry. The cache is bounded in
+bytes: a hit touches the entry and the least recently used entries are deleted when the limit is passed.
+"""
+import hashlib
+import inspect
+import os
+import shutil
+import sys
+import threading
+import uuid
+import numpy as np
+from utils.memory import float_dtype
+
+# bump to invalidate every existing entry, e.g. when a dependency outside of the package changes the outputs
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def module_digest(function):
+    """
+    :return: sha256 of the source of the module defining function and of the modules of the same package
+    it uses, directly or not, so editing any of them invalidates the entries of the stage
+    """
+    package = function.__module__.split('.')[0]
+    digest = hashlib.sha256()
+    pending, seen = [function.__module__], set()
+    while pending:
+        name = pending.pop()
+        if name in seen or name not in sys.modules:
+            continue
+        seen.add(name)
+        module = sys.modules[name]
+        digest.update(inspect.getsource(module).encode())
+        for value in vars(module).values():
+            used = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+            if isinstance(used, str) and used.split('.')[0] == package:
+                pending.append(used)
+    return digest.hexdigest()
+
+
+# module digests of the stages, computed once per process
+_digests = {}
+
+
+def input_key(image):
+    """
+    :return: sha256 of the bytes, shape and dtype of an image
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256(image.tobytes())
+    digest.update(repr((image.shape, str(image.dtype))).encode())
+    return digest.hexdigest()
+
+
+def stage_key(function, *parts):
+    """
+    :param function: the stage, the source of its modules is part of the key
+    :param parts: upstream keys and parameters, anything with a stable repr
+    """
+    name = function.__module__ + '.' + function.__qualname__
+    if name not in _digests:
+        _digests[name] = module_digest(function)
+    description = repr((CACHE_VERSION, name, _digests[name], str(float_dtype()), parts))
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+class NullStageCache:
+    """
+    Stands in for a StageCache when caching is off: every lookup misses and nothing is hashed or stored.
+    """
+    enabled = False
+
+    def input_key(self, image):
+        return None
+
+    def key(self, function, *parts):
+        return None
+
+    def get(self, key):
+        return None
+
+    def put(self, key, outputs):
+        pass
+
+
+NULL_STAGE_CACHE = NullStageCache()
+
+
+class StageCache:
+
+    enabled = True
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param directory: shared by every process using the cache, created when missing
+        :param max_bytes: size limit of all the entries together
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def input_key(self, image):
+        return input_key(image)
+
+    def key(self, function, *parts):
+        return stage_key(function, *parts)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: the outputs stored under key, an array or a tuple of arrays, None when missing
+        """
+        path = self._path(key)
+        try:
+            names = os.listdir(path)
+            if 'output.npy' in names:
+                outputs = np.load(os.path.join(path, 'output.npy'))
+            else:
+                outputs = tuple(np.load(os.path.join(path, '%d.npy' % i)) for i in range(len(names)))
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return outputs
+
+    def put(self, key, outputs):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = '%s.part-%s' % (path, uuid.uuid4().hex)
+        os.makedirs(temporary)
+        if isinstance(outputs, tuple):
+            for i, output in enumerate(outputs):
+                np.save(os.path.join(temporary, '%d.npy' % i), output, allow_pickle=False)
+        else:
+            np.save(os.path.join(temporary, 'output.npy'), outputs, allow_pickle=False)
+        size = sum(os.path.getsize(os.path.join(temporary, name)) for name in os.listdir(temporary))
+
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # another worker stored the same entry first
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+
+        with self._lock:
+            self.size += size
+            over_limit = self.size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _entries(self):
+        """
+        :return: list of (last use, path, bytes) of every complete entry
+        """
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            for name in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, name)
+                if '.part-' in name:
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, output)) for output in os.listdir(path))
+                    entries.append((os.path.getmtime(path), path, size))
+                except FileNotFoundError:
+                    # evicted by another process meanwhile
+                    continue
+        return entries
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes again. The directory is
+        rescanned, so entries written by other processes are accounted for.
+        """
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, _, entry_size in entries)
+        for _, path, entry_size in entries:
+            if size <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            size -= entry_size
+        with self._lock:
+            self.size = size
+
+    def clear(self):
+        for _, path, _ in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class MemoryStageCache:
+    """
+    Stage outputs kept in memory under the same keys as StageCache, e.g. to share the upstream stages of
+    one image between several parameter sets. The outputs are made read only since they are handed out
+    to every caller without a copy.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._outputs = {}
+
+    def input_key(self, image):
+        return input_key(image)
+
+    def key(self, function, *parts):
+        return stage_key(function, *parts)
+
+    def get(self, key):
+        outputs = self._outputs.get(key)
+        if outputs is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return outputs
+
+    def put(self, key, outputs):
+        for output in outputs if isinstance(outputs, tuple) else (outputs,):
+            output.flags.writeable = False
+        self._outputs[key] = outputs
+
+    def clear(self):
+        self._outputs.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._outputs)}
+
+
+# one StageCache per directory and process, so workers do not rescan the directory for every image
+_stage_caches = {}
+
+
+def open_stage_cache(directory, max_bytes=DEFAULT_MAX_BYTES):
+    key = (os.path.abspath(directory), max_bytes)
+    if key not in _stage_caches:
+        _stage_caches[key] = StageCache(directory, max_bytes)
+    return _stage_caches[key]
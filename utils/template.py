@@ -0,0 +1,160 @@
+"""
+Binary minutiae templates. A template holds everything a matcher needs from a print: the minutiae
+from crossing_number.extract_minutiae, the singular points from poincare.find_singularities, the
+block size and the shape of the image. Templates are stored as a fixed header followed by the raw
+minutiae and singularity records, so reading one back is a np.frombuffer and never an unpickle.
+
+A gallery packs many templates into one file with an offset index at the end. It is opened with
+np.memmap, so opening a gallery of a million templates only reads its header; templates are paged
+in when they are accessed.
+"""
+from collections import namedtuple
+import numpy as np
+from utils.crossing_number import MINUTIAE_DTYPE
+from utils.poincare import SINGULARITY_DTYPE
+
+TEMPLATE_MAGIC = b'FPT'
+TEMPLATE_VERSION = 1
+TEMPLATE_HEADER_DTYPE = np.dtype([('magic', 'S3'), ('version', 'u1'), ('block_size', '<u2'), ('height', '<u4'),
+                                  ('width', '<u4'), ('n_minutiae', '<u4'), ('n_singularities', '<u4')])
+
+GALLERY_MAGIC = b'FPG'
+GALLERY_VERSION = 1
+GALLERY_HEADER_DTYPE = np.dtype([('magic', 'S3'), ('version', 'u1'), ('count', '<u8'), ('index_offset', '<u8')])
+GALLERY_INDEX_DTYPE = np.dtype([('id', 'S32'), ('offset', '<u8'), ('length', '<u8')])
+
+Template = namedtuple('Template', ['minutiae', 'singularities', 'block_size', 'shape'])
+
+
+def template_to_bytes(template):
+    header = np.zeros(1, TEMPLATE_HEADER_DTYPE)
+    header['magic'] = TEMPLATE_MAGIC
+    header['version'] = TEMPLATE_VERSION
+    header['block_size'] = template.block_size
+    header['height'], header['width'] = template.shape
+    header['n_minutiae'] = len(template.minutiae)
+    header['n_singularities'] = len(template.singularities)
+
+    minutiae = np.asarray(template.minutiae, MINUTIAE_DTYPE)
+    singularities = np.asarray(template.singularities, SINGULARITY_DTYPE)
+    return header.tobytes() + minutiae.tobytes() + singularities.tobytes()
+
+
+def template_from_bytes(buffer):
+    """
+    :param buffer: bytes, or any buffer such as a slice of a memory mapped gallery. The returned arrays
+    are views into it.
+    :return: Template
+    """
+    header = np.frombuffer(buffer, TEMPLATE_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != TEMPLATE_MAGIC:
+        raise ValueError('not a fingerprint template')
+    if header['version'] != TEMPLATE_VERSION:
+        raise ValueError('unsupported template version %d' % header['version'])
+
+    offset = TEMPLATE_HEADER_DTYPE.itemsize
+    minutiae = np.frombuffer(buffer, MINUTIAE_DTYPE, count=int(header['n_minutiae']), offset=offset)
+    offset += minutiae.nbytes
+    singularities = np.frombuffer(buffer, SINGULARITY_DTYPE, count=int(header['n_singularities']), offset=offset)
+
+    return Template(minutiae, singularities, int(header['block_size']), (int(header['height']), int(header['width'])))
+
+
+def save_template(path, template):
+    with open(path, 'wb') as f:
+        f.write(template_to_bytes(template))
+
+
+def load_template(path):
+    with open(path, 'rb') as f:
+        return template_from_bytes(f.read())
+
+
+class GalleryWriter:
+    """
+    Streams templates into a gallery file. The index is written when the writer is closed.
+
+        with GalleryWriter('gallery.fpg') as gallery:
+            gallery.add('101_1', template)
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(np.zeros(1, GALLERY_HEADER_DTYPE).tobytes())
+        self._index = []
+
+    def add(self, template_id, template):
+        """
+        :param template_id: str of at most GALLERY_INDEX_DTYPE['id'].itemsize bytes in utf-8, a longer id
+        would be truncated in the index and could collide with another one
+        """
+        encoded = template_id.encode()
+        if len(encoded) > GALLERY_INDEX_DTYPE['id'].itemsize:
+            raise ValueError('template id %r is longer than %d bytes' % (template_id,
+                                                                         GALLERY_INDEX_DTYPE['id'].itemsize))
+        record = template_to_bytes(template)
+        self._index.append((encoded, self._file.tell(), len(record)))
+        self._file.write(record)
+
+    def close(self):
+        if self._file.closed:
+            return
+        header = np.zeros(1, GALLERY_HEADER_DTYPE)
+        header['magic'] = GALLERY_MAGIC
+        header['version'] = GALLERY_VERSION
+        header['count'] = len(self._index)
+        header['index_offset'] = self._file.tell()
+
+        self._file.write(np.array(self._index, GALLERY_INDEX_DTYPE).tobytes())
+        self._file.seek(0)
+        self._file.write(header.tobytes())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_gallery(path, templates):
+    """
+    :param templates: iterable of (template_id, Template)
+    """
+    with GalleryWriter(path) as gallery:
+        for template_id, template in templates:
+            gallery.add(template_id, template)
+
+
+class Gallery:
+    """
+    Read only, memory mapped view of a gallery file. Opening it costs the same for any number of templates.
+    """
+
+    def __init__(self, path):
+        self._data = np.memmap(path, np.uint8, mode='r')
+        header = self._data[:GALLERY_HEADER_DTYPE.itemsize].view(GALLERY_HEADER_DTYPE)[0]
+        if header['magic'] != GALLERY_MAGIC:
+            raise ValueError('not a fingerprint gallery')
+        if header['version'] != GALLERY_VERSION:
+            raise ValueError('unsupported gallery version %d' % header['version'])
+
+        index_offset = int(header['index_offset'])
+        index_end = index_offset + int(header['count']) * GALLERY_INDEX_DTYPE.itemsize
+        self.index = self._data[index_offset:index_end].view(GALLERY_INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        return template_from_bytes(self._data[offset:offset + int(entry['length'])])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def ids(self):
+        return np.char.decode(self.index['id'])
@@ -0,0 +1,66 @@
+"""
+Intra image parallelism for large single scans. The heavy OpenCV kernels (the Sobel filters of the
+orientation stage, the morphology of segmentation and the gabor convolutions) release the GIL, so bands
+of rows of one image can be filtered concurrently on a thread pool.
+
+Every band is filtered together with a halo of the rows around it, as wide as the reach of the filter,
+and only its own rows are kept, so the stitched image is the same as filtering the whole image at once:
+inside the image the halo provides the neighbours the filter reads, and a band touching the image border
+sees the same border as the whole image. Bands are aligned to the block grid of the stages and are at
+least 8 halos high, so the rows filtered twice stay a small part of the work.
+
+The gabor stage has its own tiles: every orientation is filtered on the block aligned box of the blocks
+using it, grown by the filter radius, and the orientations run concurrently.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# rows per band, before rounding to the block size
+TILE_ROWS = 256
+
+
+def row_tiles(rows, tile_rows=TILE_ROWS, align=1, start=0):
+    """
+    :param align: bands start at start plus a multiple of align, e.g. the block size
+    :return: list of (top, bottom) bands covering [start, rows)
+    """
+    band = max(align, tile_rows // align * align)
+    return [(top, min(top + band, rows)) for top in range(start, rows, band)]
+
+
+def map_row_tiles(executor, function, im, halo, tile_rows=TILE_ROWS, align=1):
+    """
+    Filters bands of rows of im concurrently and stitches the results.
+    :param executor: concurrent.futures executor, None to filter the whole image at once
+    :param function: filter of a 2d image returning an image of the same number of rows, every output row
+    depends on the input rows within halo rows of it only
+    :param halo: reach of function in rows
+    :return: function(im)
+    """
+    rows = im.shape[0]
+    tile_rows = max(tile_rows, 8*halo)
+    if executor is None or rows <= tile_rows:
+        return function(im)
+
+    def filter_tile(tile):
+        top, bottom = tile
+        crop_top, crop_bottom = max(top - halo, 0), min(bottom + halo, rows)
+        return function(im[crop_top:crop_bottom])[top - crop_top:bottom - crop_top]
+
+    return np.concatenate(list(executor.map(filter_tile, row_tiles(rows, tile_rows, align))))
+
+
+# one thread pool per number of workers and process, shared by every image
+_executors = {}
+
+
+def tile_executor(workers):
+    """
+    :param workers: number of threads, None or 0 for no tiling
+    :return: ThreadPoolExecutor, None without workers
+    """
+    if not workers:
+        return None
+    if workers not in _executors:
+        _executors[workers] = ThreadPoolExecutor(workers, thread_name_prefix='tile')
+    return _executors[workers]